@@ -0,0 +1,144 @@
+# Stand-in for gmusicapi's Mobileclient, serving a generated library, so
+# that benchmarks can build a MusicLibrary/GMusicFS without an account.
+#
+# Stream and album art URLs point to base_url, normally a local
+# fakeserver.FakeServer, and every API call can be given a latency to
+# mimic the round trips to Google.
+
+import time
+import hashlib
+import threading
+
+# Title suffixes, in the proportions of a real library, so that the title
+# cleanup does its usual amount of work
+TITLE_SUFFIXES = [u''] * 6 + [u' (Album Version)', u' (feat. Guest %d)',
+                              u' [Remastered Version]', u' (Live)']
+
+# Tracks per page of get_all_songs(incremental=True), like Google's
+PAGE_SIZE = 1000
+
+def make_tracks(count, tracks_per_album=10, albums_per_artist=4, base_url=None):
+    """Return count track dicts shaped like the ones get_all_songs() returns.
+    With a base_url every album gets a cover there"""
+    tracks = []
+    for n in range(count):
+        album = n / tracks_per_album
+        artist = album / albums_per_artist
+        suffix = TITLE_SUFFIXES[n % len(TITLE_SUFFIXES)]
+        if '%d' in suffix:
+            suffix = suffix % (n % 100)
+        track = {
+            'id': hashlib.md5('track %d' % n).hexdigest(),
+            'title': u'Track number %d%s' % (n, suffix),
+            'artist': u'Artist %d' % artist,
+            'albumArtist': u'Artist %d' % artist,
+            'album': u'Album %d: the record' % album,
+            'albumId': u'B%08d' % album,
+            'trackNumber': n % tracks_per_album + 1,
+            'discNumber': 1,
+            'year': 1960 + album % 50,
+            'genre': u'Rock',
+            'estimatedSize': str(4000000 + n),
+            'creationTimestamp': str(1400000000000000 + n),
+            'recentTimestamp': str(1400000000000000 + n),
+            'lastModifiedTimestamp': str(1400000000000000 + n),
+        }
+        if base_url is not None:
+            track['albumArtRef'] = [{'url': '%s/art/B%08d.jpg' % (base_url, album)}]
+        tracks.append(track)
+    return tracks
+
+def make_playlists(tracks, count=10, size=100):
+    """Return count playlists of size tracks each, shaped like the ones
+    get_all_user_playlist_contents() returns"""
+    playlists = []
+    step = max(1, len(tracks) / max(1, count * size))
+    for n in range(count):
+        entries = [{'trackId': tracks[(n + i * step) % len(tracks)]['id']}
+                   for i in range(size)] if tracks else []
+        playlists.append({'id': 'P%04d' % n, 'name': u'Playlist %d' % n,
+                          'deleted': False, 'tracks': entries})
+    return playlists
+
+def artist_id(name):
+    return 'A' + hashlib.md5(name.encode('utf-8')).hexdigest()
+
+class FakeMobileclient(object):
+    """Implements the Mobileclient calls MusicLibrary makes"""
+
+    tracks = []
+    playlists = []
+    base_url = None # Where stream URLs point to
+    latency = 0 # Seconds added to every call
+
+    def __init__(self, debug_logging=False):
+        self.calls = 0
+        self.__index = None
+        self.__lock = threading.Lock()
+
+    def __call(self):
+        with self.__lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __lookup(self, kind, key):
+        """Find a track by 'id', 'albumId' or artist ID"""
+        with self.__lock:
+            if self.__index is None:
+                self.__index = {'id': {}, 'albumId': {}, 'artistId': {}}
+                for t in self.tracks:
+                    self.__index['id'][t['id']] = t
+                    self.__index['albumId'].setdefault(t['albumId'], t)
+                    self.__index['artistId'].setdefault(artist_id(t['albumArtist']), t)
+        return self.__index[kind].get(key, None)
+
+    def login(self, username, password, device_id):
+        self.__call()
+        return True
+
+    def get_all_songs(self, incremental=False, include_deleted=False, updated_after=None):
+        self.__call()
+        if not incremental:
+            return [dict(t) for t in self.tracks]
+        return self.__pages()
+
+    def __pages(self):
+        for start in range(0, len(self.tracks), PAGE_SIZE):
+            if start > 0:
+                self.__call()
+            yield [dict(t) for t in self.tracks[start:start + PAGE_SIZE]]
+
+    def get_all_playlists(self, include_deleted=False):
+        self.__call()
+        return [dict(p, tracks=None) for p in self.playlists]
+
+    def get_all_user_playlist_contents(self):
+        self.__call()
+        return [dict(p, tracks=list(p['tracks'])) for p in self.playlists]
+
+    def get_album_info(self, album_id, include_tracks=True):
+        self.__call()
+        track = self.__lookup('albumId', album_id)
+        if track is None:
+            return {'albumId': album_id}
+        return {'albumId': album_id, 'name': track['album'], 'year': track['year'],
+                'artist': track['albumArtist'],
+                'artistId': [artist_id(track['albumArtist'])]}
+
+    def get_artist_info(self, artist_id, include_albums=True, max_top_tracks=5, max_rel_artist=5):
+        self.__call()
+        track = self.__lookup('artistId', artist_id)
+        if track is None:
+            return {'artistId': artist_id}
+        return {'artistId': artist_id, 'name': track['albumArtist']}
+
+    def get_stream_url(self, song_id, device_id=None):
+        self.__call()
+        if self.base_url is None:
+            return 'http://127.0.0.1:1/%s.mp3' % song_id
+        track = self.__lookup('id', song_id)
+        # Like Google's, the estimated sizes are a bit off
+        size = int(track['estimatedSize']) * 99 / 100 if track is not None else 4000000
+        return '%s/stream/%s.mp3?size=%d&expire=%d' % (
+            self.base_url, song_id, size, int(time.time()) + 3600)
@@ -0,0 +1,121 @@
+# Local HTTP server standing in for the Google Music stream and album art
+# servers, see fakeapi.
+#
+#   /stream/<id>.mp3?size=N   N bytes of audio, with Range requests
+#   /art/<id>.jpg             a cover of ART_SIZE bytes
+#
+# Content is generated, the same bytes for the same URL. Connections are
+# kept alive (HTTP/1.1) and every response can be delayed, to mimic the
+# time to first byte of a remote server.
+
+import re
+import time
+import socket
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+ART_SIZE = 64 * 1024
+
+# Served bytes are slices of this pattern
+_PATTERN = ''.join(chr(n % 251) for n in range(1024 * 1024 + 251))
+_RANGE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+def content(offset, size):
+    """Return the generated bytes [offset, offset + size) of a resource"""
+    chunks = []
+    while size > 0:
+        start = offset % 251
+        chunk = _PATTERN[start:start + min(size, 1024 * 1024)]
+        chunks.append(chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.__respond(body=False)
+
+    def do_GET(self):
+        self.__respond(body=True)
+
+    def __respond(self, body):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlparse.urlparse(self.path)
+        if url.path.startswith('/stream/'):
+            query = urlparse.parse_qs(url.query)
+            try:
+                total = int(query['size'][0])
+            except (KeyError, ValueError):
+                self.send_error(404)
+                return
+        elif url.path.startswith('/art/'):
+            total = ART_SIZE
+        else:
+            self.send_error(404)
+            return
+
+        start, end = 0, total
+        match = _RANGE.match(self.headers.get('range', ''))
+        if match is not None:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(total, int(match.group(2)) + 1)
+            if start >= total:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % total)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, total))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg' if total != ART_SIZE else 'image/jpeg')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if not body:
+            return
+        offset = start
+        try:
+            while offset < end:
+                size = min(256 * 1024, end - offset)
+                self.wfile.write(content(offset, size))
+                offset += size
+        except socket.error:
+            # The client closed the connection (eg. a seek)
+            self.close_connection = 1
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves in a background thread on 127.0.0.1, at self.url.
+    latency is in seconds"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever, name='fakeserver')
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # Clients drop their connections (seeks, end of a benchmark)
+        pass
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+# Micro-benchmark of gmusicfs.fifo.Buffer: one producer thread writing
+# 64 KB chunks, the main thread reading 128 KB chunks, like the
+# read-ahead pipeline does. Reports throughput and CPU time per MB.
+#
+#   python benchmarks/fifo_bench.py [total MB] [buffer KB]
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gmusicfs'))
+import fifo
+
+WRITE_CHUNK = 64 * 1024
+READ_CHUNK = 128 * 1024
+
+def run(total_mb, buffer_kb, readinto=False):
+    buf = fifo.Buffer(max_size=buffer_kb * 1024)
+    chunk = os.urandom(WRITE_CHUNK)
+    total = total_mb * 1024**2
+
+    def produce():
+        for i in range(total / WRITE_CHUNK):
+            buf.write(chunk)
+        buf.close()
+
+    producer = threading.Thread(target=produce)
+    cpu_start = os.times()
+    start = time.time()
+    producer.start()
+    received = 0
+    target = bytearray(READ_CHUNK)
+    while True:
+        if readinto:
+            count = buf.readinto(target)
+        else:
+            count = len(buf.read(READ_CHUNK))
+        if count == 0:
+            break
+        received += count
+    producer.join()
+    elapsed = time.time() - start
+    cpu_end = os.times()
+    cpu = (cpu_end[0] - cpu_start[0]) + (cpu_end[1] - cpu_start[1])
+    assert received == total, (received, total)
+    return total_mb / elapsed, cpu * 1000.0 / total_mb
+
+def main():
+    total_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    buffer_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    for name, readinto in (('read', False), ('readinto', True)):
+        mb_per_sec, cpu_ms_per_mb = run(total_mb, buffer_kb, readinto)
+        print '%-9s %8.1f MB/s %8.3f ms CPU/MB  (%d MB through a %d KB buffer)' % (
+            name, mb_per_sec, cpu_ms_per_mb, total_mb, buffer_kb)
+
+if __name__ == '__main__':
+    main()
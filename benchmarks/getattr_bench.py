@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+# getattr() throughput on a generated library, resolved through the path
+# index. Needs the gmusicfs dependencies (fusepy, gmusicapi, eyeD3)
+# installed, but no Google account: the library comes from fakeapi.
+#
+#   python benchmarks/getattr_bench.py [tracks]
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gmusicfs'))
+import logging
+import gmusicfs
+import fakeapi
+
+# gmusicfs logs everything at import time, keep the results readable
+logging.getLogger().setLevel(logging.WARNING)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    fakeapi.FakeMobileclient.tracks = fakeapi.make_tracks(count)
+    gmusicfs.GoogleMusicAPI = fakeapi.FakeMobileclient
+
+    start = time.time()
+    fs = gmusicfs.GMusicFS('/mnt', username='bench', password='bench',
+                           cache_dir=None, lowercase=False)
+    print 'Library of %d tracks built in %.2fs' % (count, time.time() - start)
+
+    # Every path as readdir lists it
+    paths = []
+    for artist_dir, st, offset in fs.readdir('/artists', None)[2:]:
+        artist_path = '/artists/%s' % artist_dir
+        paths.append(artist_path)
+        for album_dir, st, offset in fs.readdir(artist_path, None)[2:]:
+            album_path = '%s/%s' % (artist_path, album_dir)
+            paths.append(album_path)
+            paths.extend('%s/%s' % (album_path, name)
+                         for name, st, offset in fs.readdir(album_path, None)[2:])
+    paths = [p.encode('utf-8') for p in paths]
+    # Sizes are computed by the first getattr of a track, leave that out
+    for path in paths:
+        fs.getattr(path)
+    random.shuffle(paths)
+    missing = ['%s-missing' % p for p in paths[:len(paths) / 10]]
+
+    for name, batch in (('existing paths', paths), ('missing paths', missing)):
+        start = time.time()
+        for path in batch:
+            try:
+                fs.getattr(path)
+            except gmusicfs.FuseOSError:
+                pass
+        elapsed = time.time() - start
+        print '%-15s %8d calls %10.0f getattr/sec' % (name, len(batch), len(batch) / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python2
+# Track title/artist normalization throughput: the regex rules as they
+# were written in MusicLibrary (compiled on every call) against the
+# normalize module (precompiled, fast path, memoized).
+#
+#   python benchmarks/normalize_bench.py [titles file]
+#
+# The titles file has one "title<TAB>artist" per line (eg. exported from
+# a library); without one, a corpus following the usual naming
+# conventions of the Google Music catalog is generated.
+
+import os
+import re
+import sys
+import time
+import random
+import codecs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gmusicfs'))
+import normalize
+
+# --- The previous implementation, for reference -----------------------------
+
+def old_format_names(string_from):
+    string_from = string_from.replace(": ", " - ")
+    string_from = string_from.replace(":", "-")
+    string_from = re.sub("[/]", '-', string_from)
+    string_from = re.sub("[\?\"\`]", '', string_from)
+    return string_from
+
+def old_cleanup_artist(artist):
+    if artist.startswith("featuring"):
+        artist = artist[len("featuring"):].strip()
+    if artist.startswith("feat"):
+        artist = artist[len("feat"):].strip()
+    return artist
+
+def old_cleanup_name(name, track):
+    for bracket in (('\[', '\]'), ('\{', '\}'), ('\(', '\)')):
+        match = re.compile('^(?P<name>(.*))([ ]+[%s-]([^%s]*)[Vv]ersion[%s]?[ ]*)$' % (bracket[0], bracket[1], bracket[1])).match(name)
+        if match is not None:
+            name = match.groupdict()['name']
+            name, track = old_cleanup_name(name, track)
+        match = re.compile('^(?P<name>(.*))([ ]+[%s][ ]*[Ff]eat[\.]?[ ]*(?P<artist>(.*))[%s]+)(?P<postfix>(.*))$' % (bracket[0], bracket[1])).match(name)
+        if match is not None:
+            name = match.groupdict()['name']
+            artist = match.groupdict()['artist']
+            if match.groupdict().has_key('postfix') and match.groupdict()['postfix'] is not None:
+                name += match.groupdict()['postfix']
+            artist = artist.strip()
+            if artist[-1] in ")}]":
+                artist = artist[:-1]
+            if artist.find(" and ") > -1 or artist.find(" & ") > -1:
+                artist = artist.replace(', ', ';')
+            artist = artist.replace(' & ', ';')
+            artist = artist.replace(' and ', ';')
+            for artist in artist.split(';'):
+                track['artist'].append(artist.strip())
+            name, track = old_cleanup_name(name, track)
+        match = re.compile('^(?P<name>(.*))([ ]*[%s][ ]?[%s][ ]*)$' % (bracket[0], bracket[1])).match(name)
+        if match is not None:
+            name = match.groupdict()['name']
+            name, track = old_cleanup_name(name, track)
+    return name.strip(), track
+
+def old_prepare(track):
+    artist = track['artist']
+    if artist.find(" and ") > -1 or artist.find(" & ") > -1:
+        artist = artist.replace(', ', ';')
+    artist = artist.replace(' & ', ';').replace(' and ', ';')
+    track['artist'] = artist.split(';')
+    track['title'], track = old_cleanup_name(track['title'], track)
+    track['artist'] = [old_cleanup_artist(a) for a in track['artist']]
+    return track, old_format_names(track['title'])
+
+def new_prepare(track):
+    artists = normalize.split_artists(track['artist'])
+    track['title'], featured = normalize.cleanup_title(track['title'])
+    artists.extend(featured)
+    track['artist'] = [normalize.cleanup_artist(a) for a in artists]
+    return track, normalize.format_name(track['title'])
+
+# --- Corpus -----------------------------------------------------------------
+
+WORDS = (u'love night heart fire dream blue summer road home light time rain '
+         u'girl city river wild gold shadow song dance way world star').split()
+SUFFIXES = [u'', u'', u'', u'', u' (Album Version)', u' [Remastered Version]',
+            u' - Radio Version', u' (feat. {a})', u' (feat. {a} & {b})',
+            u' [feat. {a}] (Live Version)', u' (Live)', u' ()', u': Part {n}',
+            u' (Demo Version)', u' {{feat {a}}}']
+
+def generate_corpus(count):
+    rnd = random.Random(42)
+    artists = [u'%s %s' % (rnd.choice(WORDS).title(), rnd.choice(WORDS).title())
+               for i in range(count / 20 + 1)]
+    corpus = []
+    for i in range(count):
+        title = u' '.join(rnd.choice(WORDS) for j in range(rnd.randint(1, 5))).title()
+        title += rnd.choice(SUFFIXES).format(a=rnd.choice(artists), b=rnd.choice(artists),
+                                             n=rnd.randint(1, 4))
+        artist = rnd.choice(artists)
+        if rnd.random() < 0.1:
+            artist += u' & ' + rnd.choice(artists)
+        corpus.append((title, artist))
+    # A library lists albums of the same artists, sync and readdir see the
+    # same titles again: repeat part of the corpus
+    corpus += corpus[:count / 2]
+    rnd.shuffle(corpus)
+    return corpus
+
+def load_corpus(path):
+    corpus = []
+    for line in codecs.open(path, encoding='utf-8'):
+        title, _, artist = line.rstrip(u'\n').partition(u'\t')
+        corpus.append((title, artist))
+    return corpus
+
+def run(prepare, corpus):
+    start = time.time()
+    results = [prepare({'title': title, 'artist': artist}) for title, artist in corpus]
+    return len(corpus) / (time.time() - start), results
+
+def main():
+    if len(sys.argv) > 1:
+        corpus = load_corpus(sys.argv[1])
+    else:
+        corpus = generate_corpus(100000)
+    old_rate, old_results = run(old_prepare, corpus)
+    normalize.cleanup_title.memo.clear()
+    normalize.format_name.memo.clear()
+    new_rate, new_results = run(new_prepare, corpus)
+    assert old_results == new_results, 'normalize gives different results'
+    warm_rate, warm_results = run(new_prepare, corpus)
+    print '%d titles' % len(corpus)
+    print 'before        %10.0f tracks/sec' % old_rate
+    print 'after (cold)  %10.0f tracks/sec  x%.1f' % (new_rate, new_rate / old_rate)
+    print 'after (warm)  %10.0f tracks/sec  x%.1f' % (warm_rate, warm_rate / old_rate)
+
+if __name__ == '__main__':
+    main()
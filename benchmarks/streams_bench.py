@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+# Many tracks open at once, like a media server serving many clients:
+# every track is opened and read a little, then they are read in turns.
+# Reports the threads the process runs, the read throughput and the
+# read-ahead hit rate.
+# The HTTP server runs in a child process, so its threads do not count.
+# Needs the gmusicfs dependencies (fusepy, gmusicapi, eyeD3).
+#
+#   python benchmarks/streams_bench.py [open files] [rounds] [latency ms]
+
+import os
+import sys
+import time
+import signal
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gmusicfs'))
+import logging
+import gmusicfs
+import fakeapi
+import fakeserver
+
+# gmusicfs logs everything at import time, keep the results readable
+logging.getLogger().setLevel(logging.WARNING)
+
+READ_SIZE = 128 * 1024
+
+def start_server(latency):
+    """Run a FakeServer in a child process, returns (pid, url)"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        server = fakeserver.FakeServer(latency)
+        os.write(w, server.url)
+        os.close(w)
+        while True:
+            time.sleep(3600)
+    os.close(w)
+    url = os.read(r, 1024)
+    os.close(r)
+    return pid, url
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    latency = float(sys.argv[3]) / 1000.0 if len(sys.argv) > 3 else 0.02
+
+    pid, url = start_server(latency)
+    try:
+        fakeapi.FakeMobileclient.tracks = fakeapi.make_tracks(count, base_url=url)
+        fakeapi.FakeMobileclient.base_url = url
+        gmusicfs.GoogleMusicAPI = fakeapi.FakeMobileclient
+        fs = gmusicfs.GMusicFS('/mnt', username='bench', password='bench',
+                               cache_dir=None, lowercase=False, warmup_depth=0)
+        paths = []
+        for artist, st, offset in fs.readdir('/artists', None)[2:]:
+            for album, st, offset in fs.readdir('/artists/' + artist, None)[2:]:
+                album_path = u'/artists/%s/%s' % (artist, album)
+                paths.extend(u'%s/%s' % (album_path, name)
+                             for name, st, offset in fs.readdir(album_path, None)[2:]
+                             if name.endswith('.mp3'))
+        threads = threading.active_count()
+
+        handles = []
+        start = time.time()
+        for path in paths:
+            fh = fs.open(path, os.O_RDONLY)
+            fs.read(path, READ_SIZE, 0, fh)
+            handles.append((path, fh))
+        print '%d tracks open and started in %.2fs' % (len(handles), time.time() - start)
+        print '  threads          %6d (%d before opening them)' % (threading.active_count(), threads)
+
+        hits, misses = fs.readahead_stats.hits, fs.readahead_stats.misses
+        start = time.time()
+        nbytes = 0
+        for n in range(1, rounds + 1):
+            for path, fh in handles:
+                nbytes += len(fs.read(path, READ_SIZE, n * READ_SIZE, fh))
+        elapsed = time.time() - start
+        hits, misses = fs.readahead_stats.hits - hits, fs.readahead_stats.misses - misses
+        print '  read in turns    %6.1f MB/s (%d MB)' % (nbytes / elapsed / 1024**2, nbytes / 1024**2)
+        print '  read-ahead hits  %6.1f%%' % (100.0 * hits / max(hits + misses, 1))
+        for path, fh in handles:
+            fs.release(path, fh)
+        fs.cleanup()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python2
+# Benchmark suite on generated libraries, without a Google account: the
+# API is fakeapi.FakeMobileclient and streams/covers come from a local
+# fakeserver.FakeServer. GMusicFS methods are called directly, nothing is
+# mounted. Needs the gmusicfs dependencies (fusepy, gmusicapi, eyeD3).
+#
+#   python benchmarks/suite.py [--tracks 1000,10000,100000] [--latency MS]
+#                              [--api-latency MS] [--read-tracks N]
+#
+# For each library size: scan time, memory used by the library,
+# readdir/getattr calls per second and read throughput in MB/s. Every
+# size runs in its own process, so memory numbers do not add up.
+
+import os
+import sys
+import stat
+import time
+import types
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gmusicfs'))
+import logging
+import gmusicfs
+import transport
+import fakeapi
+import fakeserver
+
+# gmusicfs logs everything at import time, keep the results readable
+logging.getLogger().setLevel(logging.WARNING)
+
+READ_SIZE = 128 * 1024 # What the kernel asks for with FUSE big_writes/max_read
+
+def rss():
+    """Resident memory of this process, in bytes"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def deep_size(obj, seen):
+    """Return the memory taken by an object and everything it references
+    that is not in seen yet, in bytes. Classes and modules are left out"""
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif hasattr(obj, '__slots__'):
+            pending.extend(getattr(obj, key) for key in obj.__slots__ if hasattr(obj, key))
+    return size
+
+def rate(count, elapsed):
+    return count / elapsed if elapsed > 0 else float('inf')
+
+def walk(fs):
+    """Return (directories, files, readdir calls per second) as readdir
+    lists them, attributes included"""
+    directories, files = [], []
+    pending = ['/']
+    elapsed = 0.0
+    while pending:
+        path = pending.pop()
+        directories.append(path)
+        start = time.time()
+        entries = fs.readdir(path, None)
+        elapsed += time.time() - start
+        for name, st, offset in entries[2:]:
+            child = (path.rstrip('/') + '/' + name).encode('utf-8') \
+                if isinstance(name, unicode) else path.rstrip('/') + '/' + name
+            if st['st_mode'] & stat.S_IFDIR:
+                pending.append(child)
+            else:
+                files.append(child)
+    return directories, files, rate(len(directories), elapsed)
+
+def timed(calls, func):
+    start = time.time()
+    for args in calls:
+        func(*args)
+    return rate(len(calls), time.time() - start)
+
+def read_file(fs, path):
+    """Read a whole file sequentially, return the number of bytes read"""
+    size = fs.getattr(path)['st_size']
+    fh = fs.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            data = fs.read(path, READ_SIZE, offset, fh)
+            if not data:
+                break
+            offset += len(data)
+    finally:
+        fs.release(path, fh)
+    return offset
+
+def run(args, count):
+    server = fakeserver.FakeServer(args.latency / 1000.0)
+    fakeapi.FakeMobileclient.tracks = fakeapi.make_tracks(count, base_url=server.url)
+    fakeapi.FakeMobileclient.playlists = fakeapi.make_playlists(fakeapi.FakeMobileclient.tracks)
+    fakeapi.FakeMobileclient.base_url = server.url
+    fakeapi.FakeMobileclient.latency = args.api_latency / 1000.0
+    gmusicfs.GoogleMusicAPI = fakeapi.FakeMobileclient
+    print '%d tracks' % count
+
+    memory = rss()
+    start = time.time()
+    fs = gmusicfs.GMusicFS('/mnt', username='bench', password='bench',
+                           cache_dir=None, lowercase=False)
+    print '  scan             %10.2f s' % (time.time() - start)
+    print '  memory           %10.1f MB (%d bytes/track)' % (
+        (rss() - memory) / 1024.0**2, (rss() - memory) / max(count, 1))
+
+    # What the tracks themselves take, the strings they share with each
+    # other counted once
+    tracks = [fs.library.get_track(t['id']) for t in fakeapi.FakeMobileclient.tracks]
+    print '  track objects    %10.0f bytes/track' % (
+        (deep_size(tracks, set()) - sys.getsizeof(tracks)) / float(max(count, 1)))
+
+    # The first listing of every directory, with the attributes of the
+    # entries: the getattr calls that follow are answered from the cache
+    directories, files, readdir_rate = walk(fs)
+    print '  readdir (cold)   %10.0f calls/sec (%d directories)' % (readdir_rate, len(directories))
+    paths = [(p,) for p in directories + files]
+    print '  getattr (listed) %10.0f calls/sec (%d paths)' % (timed(paths, fs.getattr), len(paths))
+    fs.stat_cache.clear()
+    print '  getattr (uncached)%9.0f calls/sec' % timed(paths, fs.getattr)
+
+    # Tracks of the first albums, as a player would go through them
+    tracks = [p for p in files if p.startswith('/artists/') and p.endswith('.mp3')]
+    tracks = sorted(tracks)[:args.read_tracks]
+    start = time.time()
+    nbytes = sum(read_file(fs, path) for path in tracks)
+    elapsed = time.time() - start
+    print '  read             %10.1f MB/s (%d tracks, %.1f MB)' % (
+        rate(nbytes, elapsed) / 1024.0**2, len(tracks), nbytes / 1024.0**2)
+    print '  %r, %d API calls, %d server requests' % (
+        transport.shared, fs.library.api.calls, server.requests)
+    fs.cleanup()
+    server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='GMusicFS benchmarks on generated libraries')
+    parser.add_argument('--tracks', default='1000,10000,100000',
+                        help='Library sizes, comma separated (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Stream server time to first byte in ms (default: %(default)s)')
+    parser.add_argument('--api-latency', type=float, default=0,
+                        help='Time of every API call in ms (default: %(default)s)')
+    parser.add_argument('--read-tracks', type=int, default=5,
+                        help='Tracks read for the read throughput (default: %(default)s)')
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.tracks.split(',')]
+    if len(sizes) == 1:
+        run(args, sizes[0])
+        return
+    for count in sizes:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               '--tracks', str(count), '--latency', str(args.latency),
+                               '--api-latency', str(args.api_latency),
+                               '--read-tracks', str(args.read_tracks)])
+
+if __name__ == '__main__':
+    main()
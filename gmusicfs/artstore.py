@@ -0,0 +1,136 @@
+# Process wide store of album art, keyed by the albumArtRef URL.
+#
+# Albums (and every disc of a multi-disc album) sharing a cover share one
+# image: it is downloaded once, kept in a size bounded memory LRU as a
+# single string that all the tags and cover.jpg reads use, and written to
+# a directory so that later mounts do not download it again.
+
+import os
+import hashlib
+import tempfile
+import threading
+import logging
+
+import lru
+import stats
+import transport
+import workers
+
+log = logging.getLogger('gmusicfs')
+
+class ArtStore(object):
+    """Album art by URL, from memory, then disk, then the network"""
+
+    def __init__(self, directory=None, max_size=32 * 1024**2, concurrency=8):
+        self.directory = directory
+        self.concurrency = concurrency
+        self.downloads = 0
+        self.__images = lru.LRUCache(max_size, sizeof=len) # URL -> image data
+        self.__sizes = {} # URL -> image size, kept for evicted images too
+        self.__pending = {} # URL -> threading.Event() set once downloaded
+        self.__lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+    def __path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def __load(self, url):
+        """Return the image from memory or disk, or None"""
+        data = self.__images.get(url)
+        if data is not None or self.directory is None:
+            return data
+        try:
+            f = open(self.__path(url), 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        self.__remember(url, data)
+        return data
+
+    def __remember(self, url, data):
+        self.__images.put(url, data)
+        with self.__lock:
+            self.__sizes[url] = len(data)
+
+    def __download(self, url):
+        with stats.shared.timed('art.download'):
+            data = transport.shared.get_data(url)
+        stats.shared.count('art.bytes', len(data))
+        with self.__lock:
+            self.downloads += 1
+        if self.directory is not None:
+            # Write to a temporary file first, readers never see a partial image
+            tmpfd, tmpfile = tempfile.mkstemp(dir=self.directory, prefix='.art-')
+            try:
+                f = os.fdopen(tmpfd, 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                os.rename(tmpfile, self.__path(url))
+            except (IOError, OSError), e:
+                log.warning('Could not store album art %s: %s' % (url, e))
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+        return data
+
+    def get(self, url):
+        """Return the image at url, downloading it at most once"""
+        while True:
+            data = self.__load(url)
+            if data is not None:
+                return data
+            with self.__lock:
+                pending = self.__pending.get(url, None)
+                if pending is None:
+                    pending = self.__pending[url] = threading.Event()
+                    break
+            # Another thread is downloading it, use its result
+            pending.wait()
+        try:
+            data = self.__download(url)
+            self.__remember(url, data)
+            return data
+        finally:
+            with self.__lock:
+                del self.__pending[url]
+            pending.set()
+
+    def get_size(self, url, fetch=True):
+        """Return the size of the image at url, without reading it if known.
+        Without fetch, returns None rather than downloading the image"""
+        with self.__lock:
+            size = self.__sizes.get(url, None)
+        if size is not None:
+            return size
+        if self.directory is not None:
+            try:
+                size = os.path.getsize(self.__path(url))
+            except OSError:
+                pass
+            else:
+                with self.__lock:
+                    self.__sizes[url] = size
+                return size
+        if not fetch:
+            return None
+        return len(self.get(url))
+
+    def __is_stored(self, url):
+        if url in self.__images:
+            return True
+        return self.directory is not None and os.path.exists(self.__path(url))
+
+    def prefetch(self, urls):
+        """Download all the images not stored yet, concurrently"""
+        missing = [url for url in set(urls) if not self.__is_stored(url)]
+        if not missing:
+            return
+        log.info('Prefetching %d album covers...' % len(missing))
+        pool = workers.WorkerPool(self.concurrency, name='art')
+        fetched = pool.map(lambda url: len(self.get(url)), missing)
+        log.info('Prefetched %d album covers.' % len(fetched))
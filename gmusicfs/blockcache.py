@@ -0,0 +1,319 @@
+# Persistent cache of track audio, in fixed size blocks.
+#
+# Every block lives in its own file, <directory>/<track id>/<block index>,
+# so a track that was only partly read (a seek, an indexer reading the
+# first few KB) is partly cached. A block file starts with a small header
+# (data length and CRC32) and is written to a temporary file then renamed
+# into place: a crash leaves at worst a temporary file, which is removed at
+# the next start, and a damaged block is detected and fetched again.
+#
+# The total size of the blocks is capped. Eviction is a segmented LRU,
+# which takes how often blocks are read into account: a block enters a
+# probation segment and moves to a protected one when it is read again.
+# The least recently used blocks of the probation segment go first, so a
+# single pass over many tracks (a media indexer) cannot push out the
+# tracks that are played again and again. Use order survives restarts
+# through the files' mtime; all blocks start over in probation.
+
+import os
+import re
+import struct
+import zlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger('gmusicfs')
+
+BLOCK_SIZE = 256 * 1024
+BLOCK_HEADER = struct.Struct('!II') # Data length, CRC32 of the data
+TEMP_PREFIX = '.block-'
+# Share of the cache the protected segment may take, see __protect
+PROTECTED_SHARE = 0.8
+
+class BlockCache(object):
+    """
+    >>> import shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> c = BlockCache(directory, max_size=9, block_size=4)
+    >>> c.put('track', 0, 'abcd')
+    >>> c.put('track', 1, 'ef')
+    >>> c.get('track', 0) == 'abcd'
+    True
+    >>> c.put('other', 0, 'wxyz')
+    >>> c.get('track', 1) is None
+    True
+    >>> c = BlockCache(directory, max_size=9, block_size=4)
+    >>> c.size, c.get('other', 0) == 'wxyz'
+    (8, True)
+
+    A block read again outlives blocks read only once, even more recent:
+
+    >>> c = BlockCache(directory, max_size=12, block_size=4)
+    >>> c.get('track', 0) == 'abcd'
+    True
+    >>> for index in range(4):
+    ...     c.put('scan', index, 'data')
+    >>> c.get('track', 0) == 'abcd', c.get('other', 0), c.has('scan', 3)
+    (True, None, True)
+    >>> shutil.rmtree(directory)
+    """
+    def __init__(self, directory, max_size, block_size=BLOCK_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.block_size = block_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # (track dir, block index) -> data length, least recently used first
+        self.__probation = OrderedDict() # Blocks read at most once since stored
+        self.__protected = OrderedDict() # Blocks read again
+        self.__protected_size = 0
+        self.__lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.__load_index()
+
+    def __track_dir(self, trackid):
+        return re.sub('[^A-Za-z0-9_.-]', '_', trackid)
+
+    def __path(self, key):
+        return os.path.join(self.directory, key[0], str(key[1]))
+
+    def __load_index(self):
+        """Rebuild the index from the block files, oldest use first"""
+        found = []
+        for name in os.listdir(self.directory):
+            track_dir = os.path.join(self.directory, name)
+            if not os.path.isdir(track_dir):
+                continue
+            for block in os.listdir(track_dir):
+                path = os.path.join(track_dir, block)
+                if block.startswith(TEMP_PREFIX) or not block.isdigit():
+                    # Left behind by a crash during a write
+                    os.unlink(path)
+                    continue
+                st = os.stat(path)
+                found.append((st.st_mtime, (name, int(block)),
+                              st.st_size - BLOCK_HEADER.size))
+        found.sort()
+        for mtime, key, length in found:
+            self.__probation[key] = length
+            self.size += length
+        log.info('Block cache: %d blocks, %d MB in %s'
+                 % (len(self.__probation), self.size / 1024**2, self.directory))
+        self.__evict()
+
+    def __evict(self):
+        """Remove the least recently used blocks until under max_size, the
+        ones in probation first"""
+        evicted = []
+        with self.__lock:
+            while self.size > self.max_size and (self.__probation or self.__protected):
+                if self.__probation:
+                    key, length = self.__probation.popitem(last=False)
+                else:
+                    key, length = self.__protected.popitem(last=False)
+                    self.__protected_size -= length
+                self.size -= length
+                evicted.append(key)
+        for key in evicted:
+            self.__remove(key)
+
+    def __protect(self, key, length):
+        """Move a block read again to the protected segment, with the lock
+        held. Beyond its share, its least recently used blocks go back to
+        probation, where they get a last chance to be read again"""
+        self.__protected[key] = length
+        self.__protected_size += length
+        while self.__protected_size > self.max_size * PROTECTED_SHARE and len(self.__protected) > 1:
+            old_key, old_length = self.__protected.popitem(last=False)
+            self.__protected_size -= old_length
+            self.__probation[old_key] = old_length
+
+    def __pop(self, key):
+        """Remove a block from the index, with the lock held. Returns its
+        length and whether it was protected, (None, False) if unknown"""
+        length = self.__protected.pop(key, None)
+        if length is not None:
+            self.__protected_size -= length
+            return length, True
+        return self.__probation.pop(key, None), False
+
+    def __remove(self, key):
+        try:
+            os.unlink(self.__path(key))
+        except OSError:
+            pass
+        try:
+            os.rmdir(os.path.join(self.directory, key[0]))
+        except OSError:
+            pass # Other blocks of the track are still cached
+
+    def has(self, trackid, index):
+        """Tell whether a block is cached, without reading it"""
+        key = (self.__track_dir(trackid), index)
+        with self.__lock:
+            return key in self.__probation or key in self.__protected
+
+    def get(self, trackid, index):
+        """Return the cached data of a block, or None"""
+        key = (self.__track_dir(trackid), index)
+        with self.__lock:
+            length, protected = self.__pop(key)
+            if length is None:
+                self.misses += 1
+                return None
+            self.__protect(key, length)
+        path = self.__path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                header = f.read(BLOCK_HEADER.size)
+                data = f.read()
+            finally:
+                f.close()
+            os.utime(path, None)
+        except (IOError, OSError), e:
+            log.debug('Block cache: cannot read %s: %s' % (path, e))
+            data = header = None
+        if header is None or len(header) != BLOCK_HEADER.size \
+                or BLOCK_HEADER.unpack(header) != (len(data), zlib.crc32(data) & 0xffffffff):
+            log.warning('Block cache: dropping damaged block %s' % path)
+            self.__forget(key)
+            with self.__lock:
+                self.misses += 1
+            return None
+        with self.__lock:
+            self.hits += 1
+        return data
+
+    def __forget(self, key):
+        with self.__lock:
+            length, protected = self.__pop(key)
+            if length is not None:
+                self.size -= length
+        self.__remove(key)
+
+    def put(self, trackid, index, data):
+        """Store a block. Only the last block of a track may be short."""
+        if not data or len(data) > self.max_size:
+            return
+        key = (self.__track_dir(trackid), index)
+        track_dir = os.path.join(self.directory, key[0])
+        try:
+            if not os.path.isdir(track_dir):
+                os.makedirs(track_dir, 0700)
+            tmpfd, tmpfile = tempfile.mkstemp(dir=track_dir, prefix=TEMP_PREFIX)
+            try:
+                f = os.fdopen(tmpfd, 'wb')
+                try:
+                    f.write(BLOCK_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+                    f.write(data)
+                finally:
+                    f.close()
+                os.rename(tmpfile, self.__path(key))
+            except:
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+                raise
+        except (IOError, OSError), e:
+            # A full or read-only disk must not break reads
+            log.warning('Block cache: cannot store %s: %s' % (self.__path(key), e))
+            return
+        with self.__lock:
+            old, protected = self.__pop(key)
+            if old is not None:
+                self.size -= old
+            if protected:
+                self.__protect(key, len(data))
+            else:
+                self.__probation[key] = len(data)
+            self.size += len(data)
+        self.__evict()
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        return '<BlockCache blocks=%d protected=%d size=%d hits=%d misses=%d (%.1f%% hit)>' % (
+            len(self.__probation) + len(self.__protected), len(self.__protected),
+            self.size, self.hits, self.misses,
+            100.0 * self.hits / total if total else 0)
+
+class CachedStream(object):
+    """Random access reader for a track that goes through a BlockCache.
+
+    open_stream is only called on the first cache miss, so reading a
+    track that is fully cached makes no request at all. Missing blocks are
+    read whole from the stream (a RangeStream or ReadAhead) and stored.
+
+    A short read is only stored when it ends the stream, at length (the
+    exact size of the stream, if known) or at the length the stream
+    reports: a connection closed early must not leave a truncated last
+    block in the cache.
+
+    >>> import shutil
+    >>> class Stream(object):
+    ...     length = None
+    ...     def read(self, offset, size):
+    ...         return '0123456789'[offset:min(offset + size, 6)]
+    >>> directory = tempfile.mkdtemp()
+    >>> c = BlockCache(directory, max_size=100, block_size=4)
+    >>> s = CachedStream(c, 'track', Stream)
+    >>> s.read(0, 10), c.get('track', 0), c.get('track', 1)
+    ('012345', '0123', None)
+    >>> s = CachedStream(c, 'track', Stream, length=6)
+    >>> s.read(4, 10), c.get('track', 1)
+    ('45', '45')
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, cache, trackid, open_stream, length=None):
+        self.cache = cache
+        self.trackid = trackid
+        self.open_stream = open_stream
+        self.length = length
+        self.__stream = None
+        # The block read last, FUSE reads it in several pieces: they count
+        # as one read of the block for its eviction (see BlockCache)
+        self.__last = (None, None)
+
+    def __get_block(self, index):
+        if self.__last[0] == index:
+            return self.__last[1]
+        data = self.cache.get(self.trackid, index)
+        if data is None:
+            if self.__stream is None:
+                self.__stream = self.open_stream()
+            offset = index * self.cache.block_size
+            data = self.__stream.read(offset, self.cache.block_size)
+            if len(data) == self.cache.block_size or \
+                    offset + len(data) == (self.length or getattr(self.__stream, 'length', None)):
+                self.cache.put(self.trackid, index, data)
+            else:
+                # Not kept either, the next read of the block tries again
+                return data
+        self.__last = (index, data)
+        return data
+
+    def read(self, offset, size):
+        """Return up to size bytes at offset, fewer only at the end of the stream"""
+        block_size = self.cache.block_size
+        chunks = []
+        end = offset + size
+        while offset < end:
+            index, start = divmod(offset, block_size)
+            data = self.__get_block(index)[start:start + end - offset]
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+            if start + len(data) < block_size:
+                # Short block: end of the track
+                break
+        return ''.join(chunks)
+
+    def close(self):
+        if self.__stream is not None:
+            self.__stream.close()
+            self.__stream = None
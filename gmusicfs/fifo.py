@@ -1,13 +1,22 @@
-# 'Efficient FIFO Buffer' from http://ben.timby.com/?p=139
-# Modified to be a blocking buffer, for use in gmusicfs
+# Blocking FIFO buffer, for use in gmusicfs.
+# Originally based on 'Efficient FIFO Buffer' from http://ben.timby.com/?p=139,
+# now a bounded ring buffer: readers wait for data and writers wait for
+# room on condition variables instead of polling. The ring starts small
+# and only grows up to the bound as data piles up, so the many buffers
+# that never fill up (a track barely read, a read-ahead restarted by a
+# seek) cost little.
 
 import threading
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+import time
 
 MAX_BUFFER = 1024**2*4
+INITIAL_SIZE = 64 * 1024
+
+class BufferTimeout(Exception):
+    pass
+
+class BufferClosed(ValueError):
+    pass
 
 class Buffer(object):
     """
@@ -26,85 +35,188 @@ class Buffer(object):
     True
     >>> b.read() == ''
     True
+
+    Reads wrap around the end of the ring, and block until enough data
+    was written or the buffer is closed:
+
+    >>> b = Buffer(max_size=8)
+    >>> b.write('abcdef')
+    >>> b.read(4) == 'abcd'
+    True
+    >>> b.write('ghijkl')
+    >>> len(b)
+    8
+    >>> b.write('m', timeout=0.01)
+    Traceback (most recent call last):
+    ...
+    BufferTimeout: Buffer full
+    >>> b.close()
+    >>> b.read(100) == 'efghijkl'
+    True
+    >>> b.read(100) == ''
+    True
+    >>> b.write('n')
+    Traceback (most recent call last):
+    ...
+    BufferClosed: Buffer closed
+
+    The ring grows with the data:
+
+    >>> b = Buffer(max_size=20, initial_size=4)
+    >>> b.write('abc'); b.capacity
+    4
+    >>> b.read(2) == 'ab'
+    True
+    >>> b.write('defghijklmnopq'); b.capacity
+    15
+    >>> b.read(6) == 'cdefgh'
+    True
+    >>> b.write('rstuvwxyz'); b.capacity
+    20
+    >>> b.read(18) == 'ijklmnopqrstuvwxyz'
+    True
     """
-    def __init__(self, max_size=MAX_BUFFER):
-        self.buffers = []
+    def __init__(self, max_size=MAX_BUFFER, initial_size=INITIAL_SIZE):
         self.max_size = max_size
-        self.lock = threading.Lock()
+        self.initial_size = min(initial_size, max_size)
+        self.capacity = self.initial_size # Size of the ring, up to max_size
+        self.__ring = bytearray(self.capacity)
+        self.__view = memoryview(self.__ring)
+        self.__start = 0 # Position of the first unread byte
+        self.__length = 0 # Number of unread bytes
         self.eof = False
-        self.read_pos = 0
-        self.write_pos = 0
-        self.done_first_write = False
-        # Acquire the lock immediately, so that the first write occurs
-        # before the first read:
-        self.lock.acquire()
-
-    def write(self, data):
-        # Don't acquire the lock for the first write:
-        if self.done_first_write:
-            self.lock.acquire()
-        try:
-            if not self.buffers:
-                self.buffers.append(StringIO())
-                self.write_pos = 0
-            buffer = self.buffers[-1]
-            buffer.seek(self.write_pos)
-            buffer.write(data)
-            if buffer.tell() >= self.max_size:
-                buffer = StringIO()
-                self.buffers.append(buffer)
-            self.write_pos = buffer.tell()
-        finally:
-            self.lock.release()
-        self.done_first_write = True
-
-    def read(self, length=-1):
-        read_buf = StringIO()
+        self.__lock = threading.Lock()
+        self.__write_lock = threading.Lock() # Keeps concurrent writes whole
+        self.__readable = threading.Condition(self.__lock)
+        self.__writable = threading.Condition(self.__lock)
+
+    def __wait(self, condition, deadline):
+        """Wait on condition, returns False once the deadline has passed"""
+        if deadline is None:
+            condition.wait()
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        condition.wait(remaining)
+        return True
+
+    def __resize(self, capacity):
+        """Move the unread bytes to a new ring, with the lock held"""
+        ring = bytearray(capacity)
+        first = min(self.__length, self.capacity - self.__start)
+        ring[0:first] = self.__view[self.__start:self.__start + first]
+        if self.__length > first:
+            ring[first:self.__length] = self.__view[0:self.__length - first]
+        self.__ring = ring
+        self.__view = memoryview(ring)
+        self.capacity = capacity
+        self.__start = 0
+
+    def write(self, data, timeout=None):
+        """Append data, waiting for the reader to make room when the buffer is full.
+
+        Raises BufferTimeout if there is still not enough room after
+        timeout seconds (the part of data that did fit stays written), and
+        BufferClosed once the buffer was closed."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        data = memoryview(data)
+        written = 0
+        with self.__write_lock:
+            with self.__lock:
+                while written < len(data):
+                    if self.eof:
+                        raise BufferClosed('Buffer closed')
+                    free = self.max_size - self.__length
+                    if free == 0:
+                        if not self.__wait(self.__writable, deadline):
+                            raise BufferTimeout('Buffer full')
+                        continue
+                    count = min(free, len(data) - written)
+                    if self.__length + count > self.capacity:
+                        # Doubling keeps the copies linear in the data
+                        self.__resize(min(self.max_size,
+                                          max(2 * self.capacity, self.__length + count)))
+                    end = (self.__start + self.__length) % self.capacity
+                    first = min(count, self.capacity - end)
+                    self.__view[end:end + first] = data[written:written + first]
+                    if count > first:
+                        self.__view[0:count - first] = data[written + first:written + count]
+                    self.__length += count
+                    written += count
+                    self.__readable.notify_all()
+
+    def __take(self, length):
+        """Remove length bytes from the front of the ring, with the lock held"""
+        first = min(length, self.capacity - self.__start)
+        data = self.__view[self.__start:self.__start + first].tobytes()
+        if length > first:
+            data += self.__view[0:length - first].tobytes()
+        self.__start = (self.__start + length) % self.capacity
+        self.__length -= length
+        if self.__length == 0:
+            self.__start = 0
+        self.__writable.notify_all()
+        return data
+
+    def read(self, length=-1, timeout=None):
+        """Read length bytes, waiting until they were written.
+
+        Returns fewer bytes only once the buffer is closed, or when
+        timeout seconds have passed. Without length, returns whatever is
+        buffered right now without waiting."""
+        if length < 0:
+            with self.__lock:
+                return self.__take(self.__length)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        chunks = []
         remaining = length
-        while True:
-            self.lock.acquire()
-            try:
-                # Read will block forever until we close the file:
-                if self.eof and len(self.buffers) == 0:
+        with self.__lock:
+            while remaining > 0:
+                if self.__length > 0:
+                    data = self.__take(min(remaining, self.__length))
+                    chunks.append(data)
+                    remaining -= len(data)
+                elif self.eof or not self.__wait(self.__readable, deadline):
+                    break
+        return ''.join(chunks)
+
+    def readinto(self, target, timeout=None):
+        """Read into a writable buffer (eg. a bytearray) without intermediate
+        copies. Returns the number of bytes read, see read() for blocking."""
+        target = memoryview(target)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        done = 0
+        with self.__lock:
+            while done < len(target):
+                if self.__length > 0:
+                    count = min(len(target) - done, self.__length)
+                    first = min(count, self.capacity - self.__start)
+                    target[done:done + first] = self.__view[self.__start:self.__start + first]
+                    if count > first:
+                        target[done + first:done + count] = self.__view[0:count - first]
+                    self.__start = (self.__start + count) % self.capacity
+                    self.__length -= count
+                    done += count
+                    self.__writable.notify_all()
+                elif self.eof or not self.__wait(self.__readable, deadline):
                     break
-                elif len(self.buffers) == 0:
-                    continue
-                buffer = self.buffers[0]
-                buffer.seek(self.read_pos)
-                read_buf.write(buffer.read(remaining))
-                self.read_pos = buffer.tell()
-                if length == -1:
-                    # we did not limit the read, we exhausted the buffer, so delete it.
-                    # keep reading from remaining buffers.
-                    del self.buffers[0]
-                    self.read_pos = 0
-                else:
-                    #we limited the read so either we exhausted the buffer or not:
-                    remaining = length - read_buf.tell()
-                    if remaining > 0:
-                        # exhausted, remove buffer, read more.
-                        # keep reading from remaining buffers.
-                        del self.buffers[0]
-                        self.read_pos = 0
-                    else:
-                        break
-            finally:
-                self.lock.release()
-        return read_buf.getvalue()
+        return done
 
     def __len__(self):
-        len = 0
-        self.lock.acquire()
-        try:
-            for buffer in self.buffers:
-                buffer.seek(0, 2)
-                if buffer == self.buffers[0]:
-                    len += buffer.tell() - self.read_pos
-                else:
-                    len += buffer.tell()
-            return len
-        finally:
-            self.lock.release()
+        with self.__lock:
+            return self.__length
 
     def close(self):
-        self.eof = True
+        """Mark the end of the data. Readers get what is left then EOF,
+        blocked and later writers get BufferClosed"""
+        with self.__lock:
+            self.eof = True
+            self.__readable.notify_all()
+            self.__writable.notify_all()
@@ -1,10 +1,8 @@
 #!/usr/bin/env python2
 
 import os
-import re
 import sys
 import struct
-import urllib2
 import ConfigParser
 from errno import ENOENT
 from stat import S_IFDIR, S_IFREG
@@ -16,15 +14,38 @@ import tempfile
 import threading
 import logging
 import pprint
+import itertools
+import select
+import signal
+import fcntl
+import datetime
 
 from eyed3.id3 import Tag
 from eyed3.id3 import ID3_V1_0, ID3_V1_1, ID3_V2_3, ID3_V2_4
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
+from fuse import c_stat, set_st_attrs
 from gmusicapi import Mobileclient as GoogleMusicAPI
 from gmusicapi import Webclient as GoogleMusicWebAPI
 
 import fifo
+import stream
+import streamengine
+import snapshot
+import workers
+import lru
+import blockcache
+import artstore
+import pathindex
+import streamurls
+import warmup
+import sizeprobe
+import localstore
+import prefetch
+import transport
+import normalize
+import stats
+from track import Track
 
 reload(sys) # Reload does the trick
 sys.setdefaultencoding('UTF-8')
@@ -39,18 +60,79 @@ pp = pprint.PrettyPrinter(indent=4) # For debug logging
 # The read function will read size bytes - 128 since we have to generate this 128 bytes.
 ID3V1_TRAILER_SIZE = 128
 
-def formatNames(string_from):
-<<<<<<< HEAD
-    """Format a name to make it suitable to use as a filename"""
-    return re.sub('/', '-', string_from)
-
-=======
-    string_from = string_from.replace(": ", " - ")
-    string_from = string_from.replace(":", "-")
-    string_from = re.sub("[/]", '-', string_from)
-    string_from = re.sub("[\?\"\`]", '', string_from)
-    return string_from
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
+# How many times a failing album/artist info request is retried during a scan
+SCAN_RETRIES = 3
+
+# Space reserved for the ID3v2 tag (cover included) of a track stat'ed before
+# the size of its cover is known. The size reported then stays for the whole
+# mount: the tag is padded to fill the space, or rendered without the cover
+# when it does not fit (see Album.calc_size)
+ESTIMATED_TAG_SIZE = 256 * 1024
+
+# While the library is scanned in the background, the part already read is
+# installed at least this often, in seconds (see MusicLibrary.rescan)
+PUBLISH_INTERVAL = 10
+
+# How long a lookup under /artists or /playlists waits for the library
+# being scanned to get there before it fails, in seconds
+LOOKUP_WAIT = 2
+
+# Entries returned by a readdir call on an open directory, FUSE asks for
+# the next ones from where it stopped (see GMusicFS.readdir)
+READDIR_PAGE = 256
+
+# Sizes probed in the background are saved with the snapshot at most this
+# often, in seconds (all of them are saved at unmount anyway)
+SNAPSHOT_INTERVAL = 60
+
+# Parts of the album and artist info from Google that are used, only
+# these are kept
+ALBUM_INFO_KEYS = ('name', 'year', 'artistId')
+ARTIST_INFO_KEYS = ('name',)
+
+# Size reported for /.stats, its content is generated when it is opened.
+# A short read tells FUSE where the file really ends
+STATS_SIZE = 1024**2
+
+# Format a name to make it suitable to use as a filename
+formatNames = normalize.format_name
+
+def only_keys(info, keys):
+    """Return the part of a dict with the given keys"""
+    return dict((key, info[key]) for key in keys if key in info)
+
+def stream_size(track):
+    """Return the size of a track without its ID3v2 tag (ID3v1 included)"""
+    if 'bytes' in track:
+        return int(track['bytes'])
+    return int(track['estimatedSize']) + ID3V1_TRAILER_SIZE
+
+def set_stream_size(track, size):
+    """Record the exact size of a track stream, as returned by a HEAD
+    request. A tag size already computed from the estimate follows it"""
+    old_size = stream_size(track)
+    track['bytes'] = size + ID3V1_TRAILER_SIZE
+    if track.has_key('tagSize'):
+        track['tagSize'] = int(track['tagSize']) - old_size + stream_size(track)
+
+def render_id3v1(tag):
+    """Render the 128 bytes ID3v1.1 trailer of an eyeD3 tag"""
+    def field(value, length):
+        if value is None:
+            value = u''
+        return unicode(value).encode('latin_1', 'replace')[:length].ljust(length, '\0')
+
+    year = ''
+    if tag.recording_date is not None and tag.recording_date.year:
+        year = str(tag.recording_date.year)
+    track_num = tag.track_num[0] or 0
+    # Google genres are rarely ID3v1 genres, use Other unless it matches:
+    genre = 12
+    if tag.genre is not None and tag.genre.id is not None and tag.genre.id < 256:
+        genre = tag.genre.id
+    return struct.pack('!3s30s30s30s4s28sBBB', 'TAG', field(tag.title, 30),
+                       field(tag.artist, 30), field(tag.album, 30), field(year, 4),
+                       field(u'', 28), 0, min(track_num, 255), genre)
 
 class NoCredentialException(Exception):
     pass
@@ -58,9 +140,8 @@ class NoCredentialException(Exception):
 class Playlist(object):
     """This class manages playlist information"""
 
-    def __init__(self, library, pldata):
+    def __init__(self, library, pldata, tracks):
         self.library = library
-        self.__filename_re = re.compile('^([0-9]+) - [^/]+\.mp3$')
 
         self.realname = pldata['name']
         self.dirname = formatNames(self.realname).strip()
@@ -68,39 +149,46 @@ class Playlist(object):
 
         self.__tracks = []
         for entry in pldata['tracks']:
-            log.debug('Playlist entry: %s' % pp.pformat(entry))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('Playlist entry: %s' % pp.pformat(entry))
             if 'track' in entry:
                 track = entry['track']
+                if isinstance(track, tuple):
+                    # The state of a Track, from a library snapshot
+                    track = Track.from_state(track)
                 track['id'] = entry['trackId']
             else:
-                track = self.library.get_track(entry['trackId'])
+                track = tracks.get(entry['trackId'], None)
+                if track is None:
+                    log.debug('Playlist entry not in library: %s' % entry['trackId'])
+                    continue
             self.__tracks.append(track)
 
     def get_tracks(self, get_size=False):
-        """Return the list of tracks, in order, that comprise the playlist"""
-        # TODO Converge implementation by creating a Track class?
-        #      It could get the size only on demand per-track
-        # Retrieve and remember the filesize of each track:
-        if get_size and self.library.true_file_size:
-            for t in self.__tracks:
-                if not 'bytes' in t:
-                    r = urllib2.Request(self.get_track_stream(t)[0])
-                    r.get_method = lambda: 'HEAD'
-                    u = urllib2.urlopen(r)
-                    t['bytes'] = int(u.headers['Content-Length']) + ID3V1_TRAILER_SIZE
+        """Return the list of tracks, in order, that comprise the playlist.
+        With get_size, their exact sizes are probed in the background"""
+        if get_size:
+            self.library.probe_sizes(self.__tracks)
         return self.__tracks
 
-    def get_track(self, filename):
-        """Return the track that corresponds to a filename from this playlist"""
-        m = self.__filename_re.match(filename)
-        if m:
-            tracknum = int(m.groups()[0])
-            return self.__tracks[tracknum - 1]
-        return None
-
-    def get_track_stream(self, track):
-        """Return the track stream URL"""
-        return self.library.api.get_stream_url(track['id'], deviceId)
+    def get_track_stream(self, track, refused=None):
+        """Return the track stream URL (see StreamURLCache.get)"""
+        return self.library.stream_urls.get(track['id'], refused)
+
+    def get_track_filename(self, tracknum, track):
+        """Return the filename of the track at a position (from 1) of the playlist"""
+        return formatNames(u'%03d - %s - %s - %s.mp3' % (
+            tracknum, ', '.join(track['artist']), track['album'], track['title']))
+
+    def get_state(self):
+        """Return the playlist as plain data for the library snapshot"""
+        entries = []
+        for track in self.__tracks:
+            if self.library.get_track(track['id']) is track:
+                entries.append({'trackId': track['id']})
+            else:
+                entries.append({'trackId': track['id'], 'track': self.library.get_track_state(track)})
+        return {'name': self.realname, 'tracks': entries}
 
     def __repr__(self):
         return u'<Playlist \'{name}\'>'.format(name=self.realname)
@@ -118,6 +206,10 @@ class Artist(object):
         """Add an album to the artist"""
         self.__albums[album.normtitle.lower()] = album
 
+    def remove_album(self, album):
+        """Remove an album from the artist"""
+        self.__albums.pop(album.normtitle.lower(), None)
+
     def get_albums(self):
         """Return a list of all the albums by the artist"""
         return self.__albums.values()
@@ -126,25 +218,17 @@ class Artist(object):
         """Return a specific album from the set that belongs to the artist"""
         return self.__albums.get(title.lower(), None)
 
+    def get_state(self):
+        """Return the artist as plain data for the library snapshot"""
+        return {'name': self.realname,
+                'albums': [album.get_state() for album in self.__albums.values()]}
+
     def __repr__(self):
         return u'<Artist \'{name}\'>'.format(name=self.realname)
 
 class Album(object):
-<<<<<<< HEAD
     """This class manages album information"""
 
-    def __init__(self, library, title):
-        self.library = library
-        self.realtitle = title
-        self.normtitle = formatNames(self.realtitle)
-        self.__tracks = []
-        self.__sorted = True
-        self.__filename_re = re.compile("^[0-9]+ - (.*)\.mp3$")
-
-    def add_track(self, track):
-        """Add a track to the album"""
-=======
-    'Keep record of Album information'
     def __init__(self, library, normtitle, artist, album, year):
         self.library = library
         self.normtitle = formatNames(normtitle)
@@ -153,22 +237,19 @@ class Album(object):
         self.year = year
         self.__tracks = []
         self.__sorted = True
-        self.__filename_re = re.compile("^[0-9]{2}_(.*)\.mp3$")
-        self.__art = None
-        self.__art_size = None
-        self.__art_url = None
+        # Serializes the lazy tag work, so concurrent FUSE threads do it once
+        self.__lock = threading.Lock()
         self.__discs = []
         self.show_discnum = False
 
     def gen_tag(self, track, fake_art=False):
+        """Build the ID3 tag for a track of this album"""
         tag = Tag()
 
         if track.has_key('album'):
             tag.album = track['album']
         if track.has_key('artist'):
             tag.artist = " / ".join(track['artist'])
-            if len(track['artist']) == 2:
-                print track['artist']
         if track.has_key('title'):
             tag.title = track['title']
         if track.has_key('discNumber') and self.show_discnum:
@@ -181,23 +262,37 @@ class Album(object):
             tag.setTextFrame('TPE2', track['albumArtist'])
         if track.has_key('year') and int(track['year']) != 0:
             tag.recording_date = track['year']
-        if track.has_key('albumArtRef'):
+        if track.has_key('albumArtUrl'):
             art = None
-            if self.__art is None:
+            art_url = self.get_cover_url()
+            if art_url is not None:
                 if fake_art:
-                    art = '\0' * self.__art_size
+                    # Only the size matters to compute the tag size
+                    art = '\0' * self.library.art_store.get_size(art_url)
                 else:
-                    if self.load_art():
-                        art = self.__art
-                    else:
-                        art = None
-            else:
-                art = self.__art
+                    art = self.library.art_store.get(art_url)
             if art is not None:
                 tag.images.set(0x03, art, 'image/jpeg', u'Front cover')
         return tag
 
-    def render_tag(self, tag, version):
+    def render_tag(self, tag, version, size=0):
+        """Serialize a tag to the bytes that will be prepended/appended to the stream.
+
+        With a size, an ID3v2 tag that is shorter is padded to it"""
+        if version[0] == 1:
+            return render_id3v1(tag)
+        try:
+            # Render in memory, exactly like Tag.save() does for a new file,
+            # or over an existing tag of the given size
+            try:
+                rewrite_required, tag_data, padding = tag._render(version, size, None)
+            except TypeError:
+                # eyeD3 < 0.7.5 has no max_padding argument
+                rewrite_required, tag_data, padding = tag._render(version, size)
+            return tag_data + padding
+        except AttributeError:
+            pass
+        # Fall back to saving the tag to a temporary file
         tmpfd, tmpfile = tempfile.mkstemp()
         os.close(tmpfd)
         tag.save(tmpfile, version)
@@ -205,118 +300,141 @@ class Album(object):
         rendered_tag = tmpfd.read()
         tmpfd.close()
         os.unlink(tmpfile)
-        return rendered_tag
-
-    def calc_size(self, track):
-        if not track.has_key('tagSize'):
-            if self.__art_url is None and track.has_key('albumArtRef'):
-                self.__art_url = "%s" % track['albumArtRef'][0]['url']
-                r = urllib2.Request(self.__art_url)
-                r.get_method = lambda: 'HEAD'
-                u = urllib2.urlopen(r)
-                self.__art_size = int(u.headers['Content-Length'])
-                u.close()
-
-            tag = self.gen_tag(track, fake_art=True)
-            id3data = self.render_tag(tag, ID3_V2_4)
-            track['tagSize'] = str(int(track['estimatedSize']) + 128 + len(id3data))
-            del id3data
-            for frame in tag.frame_set.getAllFrames():
-                if hasattr(frame, 'text'):
-                    print frame.id, frame.text
-                else:
-                    print frame.id
-            del tag
-            for tnum in range(0, len(self.__tracks)):
-                if self.__tracks[tnum]['id'] == track['id']:
-                    self.__tracks[tnum]['tagSize'] = track['tagSize']
+        # Players skip the zeros between the tag and the first frame
+        return rendered_tag + '\0' * (size - len(rendered_tag))
+
+    def get_rendered_tags(self, track):
+        """Return the (id3v1, id3v2) bytes of a track, rendered once and cached"""
+        cache = self.library.tag_cache
+        # The ID3v2 tag fills exactly the space counted in tagSize
+        space = int(track['tagSize']) - stream_size(track)
+        signature = (track.get('lastModifiedTimestamp'), space) + self.get_signature()
+        cached = cache.get(track['id'])
+        if cached is not None and cached[0] == signature:
+            return cached[1], cached[2]
+        with self.__lock:
+            cached = cache.get(track['id'])
+            if cached is not None and cached[0] == signature:
+                # Rendered by another thread in the meantime
+                return cached[1], cached[2]
+            with stats.shared.timed('tags.render'):
+                tag = self.gen_tag(track)
+                id3v1data = self.render_tag(tag, ID3_V1_1)
+                id3v2data = self.render_tag(tag, ID3_V2_4, space)
+                if len(id3v2data) > space and tag.images:
+                    # A reserved space too small for the cover (see calc_size)
+                    log.info('Cover left out of the tag of %s' % track['id'])
+                    tag.images.remove(u'Front cover')
+                    id3v2data = self.render_tag(tag, ID3_V2_4, space)
+            cache.put(track['id'], (signature, id3v1data, id3v2data))
+        return id3v1data, id3v2data
+
+    def calc_size(self, track, fetch_art=True):
+        """Compute and remember the size of a track including its ID3 tags.
+
+        Without fetch_art nothing is downloaded: when the size of the cover
+        is not known yet, ESTIMATED_TAG_SIZE is reserved for the tag instead,
+        until the end of the mount (see MusicLibrary.reserved_sizes)"""
+        if track.has_key('tagSize'):
+            return track
+        reserve = False
+        if not fetch_art and track.has_key('albumArtUrl'):
+            art_url = self.get_cover_url()
+            reserve = art_url is not None and \
+                self.library.art_store.get_size(art_url, fetch=False) is None
+        with self.__lock:
+            if track.has_key('tagSize'):
+                # Computed by another thread in the meantime
+                return track
+            if reserve:
+                tag_size = str(stream_size(track) + ESTIMATED_TAG_SIZE)
+                self.library.reserved_sizes.add(track['id'])
+            else:
+                tag = self.gen_tag(track, fake_art=True)
+                id3data = self.render_tag(tag, ID3_V2_4)
+                tag_size = str(stream_size(track) + len(id3data))
+                del id3data
+                del tag
+            # A single assignment, readers see either no size or the final one
+            for t in self.__tracks:
+                if t['id'] == track['id']:
+                    t['tagSize'] = tag_size
+            track['tagSize'] = tag_size
         return track
 
+    def set_stream_size(self, track, size):
+        """Record the exact size of a track stream (see set_stream_size)"""
+        with self.__lock:
+            # Not while calc_size is computing the tag size from the estimate
+            set_stream_size(track, size)
+
     def add_track(self, track):
-        'Add a track to the Album'
+        """Add a track to the album"""
         if track.has_key('discNumber') and int(track['discNumber']) not in self.__discs:
             self.__discs.append(int(track['discNumber']))
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
         self.__tracks.append(track)
         self.__sorted = False
 
-    def copy_art_to(self, new_album):
-        'Copies art information to another album'
-        new_album.set_art(self.__art_url, self.__art_size, self.__art)
-
-    def set_art(self, art_url, art_size, art_data):
-        'Sets art data to values.  If you think you need this, you probably do not'
-        self.__art_url = art_url
-        self.__art_size = art_size
-        self.__art = art_data
-
-    def load_art(self):
-        if self.__art_url is not None:
-            u = urllib2.urlopen(self.__art_url)
-            self.__art = ""
-            data = u.read()
-            while data != "":
-                self.__art += data
-                data = u.read()
-            return True
-        else:
-            return False
+    def get_art(self):
+        """Return the album cover image data, downloading it if needed"""
+        art_url = self.get_cover_url()
+        if art_url is None:
+            return None
+        return self.library.art_store.get(art_url)
 
     def get_tracks(self, get_size=False):
         """Return a sorted list of tracks in the album"""
-        # Re-sort by track number
+        # Re-sort by track number. The sorted list replaces the old one, an
+        # in-place sort would make it look empty to other threads meanwhile
         if not self.__sorted:
-            self.__tracks.sort(key=lambda t: t.get('track'))
-<<<<<<< HEAD
-        # Retrieve and remember the filesize of each track
-        if get_size and self.library.true_file_size:
-            for t in self.__tracks:
-                if not 'bytes' in t:
-                    r = urllib2.Request(self.get_track_stream(t))
-                    r.get_method = lambda: 'HEAD'
-                    u = urllib2.urlopen(r)
-                    t['bytes'] = int(u.headers['Content-Length']) + ID3V1_TRAILER_SIZE
-=======
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
+            self.__tracks = sorted(self.__tracks, key=lambda t: t.get('trackNumber'))
+            self.__sorted = True
+        # Have the exact size of each track probed in the background
+        if get_size:
+            self.library.probe_sizes(self.__tracks)
         return self.__tracks
 
-    def get_track(self, filename):
-        """Get the track name corresponding to a filename
-        (eg. '001 - brilliant track name.mp3')"""
-        m = self.__filename_re.match(filename)
-        if m:
-            title = m.groups()[0]
-            for track in self.get_tracks():
-<<<<<<< HEAD
-                if formatNames(track['title'].lower()) == title.lower():
-=======
-                if formatNames(track['title']) == title:
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-                    return track
-        return None
+    def get_track_stream(self, track, refused=None):
+        """Return the track stream URL (see StreamURLCache.get)"""
+        return self.library.stream_urls.get(track['id'], refused)
+
+    def get_dirname(self):
+        """Return the name of the album directory (eg. '1999_album title')"""
+        return u'%04d_%s' % (self.get_year(), self.normtitle)
 
-    def get_track_stream(self, track):
-        """Return the track stream URL"""
-        return self.library.api.get_stream_url(track['id'], deviceId)
+    def get_track_filename(self, track):
+        """Return the filename of a track (eg. '01_brilliant track name.mp3')"""
+        return u'%02d_%s.mp3' % (track.get('trackNumber', 0), formatNames(track['title']))
+
+    def get_key(self):
+        """Return an identifier of the album, the same across syncs: its id
+        and its title, which tells the discs of an album apart"""
+        tracks = self.__tracks
+        return u'%s|%s' % (tracks[0].get('albumKey', u'') if tracks else u'', self.normtitle)
 
     def get_cover_url(self):
         """Return the album cover image URL"""
-        try:
-            # Assume the first track has the right cover URL
-            url = "%s" % self.__tracks[0]['albumArtRef'][0]['url']
-        except:
-            url = None
-        return url
-        
+        if not self.__tracks:
+            return None
+        # Assume the first track has the right cover URL
+        return self.__tracks[0].get('albumArtUrl', None)
+
+    def get_signature(self):
+        """Return what the tags of the album tracks depend on besides the
+        tracks themselves: the disc number shown and the cover"""
+        return (self.show_discnum, self.get_cover_url())
+
     def get_cover_size(self):
-        """Return the album cover size"""
-	if self.library.true_file_size:
-	    r = urllib2.Request(self.get_cover_url())
-	    r.get_method = lambda: 'HEAD'
-	    u = urllib2.urlopen(r)
-	    return int(u.headers['Content-Length'])
-	return None
-	    
+        """Return the album cover size, None if it is not known (yet)"""
+        if self.library.true_file_size:
+            art_url = self.get_cover_url()
+            if art_url is not None:
+                size = self.library.art_store.get_size(art_url, fetch=False)
+                if size is None:
+                    self.library.probe_cover_size(art_url)
+                return size
+        return None
+
     def get_year(self):
         """Get the year of the album.
         Aggregate all the track years and pick the most popular year
@@ -330,7 +448,7 @@ class Album(object):
         top_years = sorted(years.items(),
                            key=operator.itemgetter(1), reverse=True)
         try:
-            top_year = top_years[0][0]
+            top_year = int(top_years[0][0])
         except IndexError:
             top_year = 0
         return top_year
@@ -344,6 +462,23 @@ class Album(object):
     def get_discs(self):
         return self.__discs
 
+    def get_state(self):
+        """Return the album as plain data for the library snapshot"""
+        return {'normtitle': self.normtitle,
+                'artist': self.artist,
+                'album': self.album,
+                'year': self.year,
+                'show_discnum': self.show_discnum,
+                'discs': self.__discs,
+                'tracks': [t['id'] for t in self.__tracks]}
+
+    def set_state(self, state, tracks):
+        """Restore the album from a library snapshot, tracks maps IDs to tracks"""
+        self.show_discnum = state['show_discnum']
+        self.__discs = list(state['discs'])
+        self.__tracks = [tracks[tid] for tid in state['tracks']]
+        self.__sorted = False
+
     def __repr__(self):
         return u'<Album \'{title}\'>'.format(title=self.normtitle)
 
@@ -351,35 +486,485 @@ class MusicLibrary(object):
     """This class reads information about your Google Play Music library"""
 
     def __init__(self, username=None, password=None,
-                 true_file_size=False, scan=True, verbose=0):
+                 true_file_size=False, scan=True, verbose=0,
+                 snapshot_path=None, use_snapshot=True, scan_workers=8,
+                 tag_cache_size=64 * 1024**2, art_dir=None, art_cache_size=32 * 1024**2,
+                 lazy_scan=False, local_dir=None):
         self.verbose = False
         if verbose > 1:
             self.verbose = True
 
         self.__login_and_setup(username, password)
 
-        self.__artists = {} # 'artist name' -> {'album name' : Album(), ...}
-        self.__galbums = {}
-        self.__gartists = {}
-        self.__albums = [] # [Album(), ...]
-        self.__tracks = {}
-        self.__playlists = {}
+        self.__galbums = {} # 'albumId' -> album info from Google
+        self.__gartists = {} # 'artistId' -> artist info from Google
+        # The library content is replaced as a whole (see __install), so
+        # lookups never see a half built library while a sync is running:
+        self.__content = self.__empty_content()
+        self.__build_index(self.__content)
+        self.generation = 0
+        self.__sync_lock = threading.Lock()
+        self.__sync_time = None # Time of the last sync, in microseconds
+        # True while the library is scanned in the background, lookups of
+        # paths that are not there yet wait for it (see wait_lookup)
+        self.loading = False
+        self.__installed = threading.Condition() # Notified by __install
+        self.true_file_size = true_file_size
+        # 'trackId' -> (signature, id3v1, id3v2), see Album.get_rendered_tags
+        self.tag_cache = lru.LRUCache(tag_cache_size,
+                                      sizeof=lambda entry: len(entry[1]) + len(entry[2]))
+        # IDs of the tracks whose tagSize is a reservation (see Album.calc_size):
+        # it is not saved in the snapshot, the next mount computes the exact size
+        self.reserved_sizes = set()
+        # Album covers, shared by all the albums using the same image
+        self.art_store = artstore.ArtStore(art_dir, art_cache_size, concurrency=scan_workers)
+        # Whole tracks downloaded by `gmusicfs prefetch`, served without the network
+        self.local_store = None
+        if local_dir is not None:
+            self.local_store = localstore.LocalStore(local_dir)
+        # Signed stream URLs by track ID, they are only valid for a while
+        self.stream_urls = streamurls.StreamURLCache(
+            lambda trackid: self.api.get_stream_url(trackid, deviceId))
+        self.scan_workers = scan_workers
+        self.size_progress = (0, 0) # (done, total) of the running compute_sizes
+        # Exact sizes for --truefilesize, probed in the background (see probe_sizes)
+        self.size_prober = sizeprobe.SizeProber(scan_workers, on_idle=self.__sizes_probed)
+        self.__snapshot_time = 0 # When the snapshot was last saved
+        self.snapshot_path = snapshot_path
+        self.__loaded = False
+        self.__sync_pending = False
         if scan:
+            if use_snapshot and self.__load_snapshot():
+                # Serve the snapshot now, sync it once the filesystem is up
+                self.__sync_pending = True
+            elif lazy_scan:
+                # Mount an empty library, it fills up once the filesystem is up
+                self.loading = True
+            else:
+                self.rescan()
+
+    def __empty_content(self):
+        return {'artists': {}, # 'artist name' -> Artist()
+                'albums': [], # [Album(), ...]
+                'tracks': {}, # 'trackId' -> track
+                'track_albums': {}, # 'trackId' -> Album()
+                'playlists': {}, # 'playlist name' -> Playlist()
+                'index': pathindex.PathIndex()} # See __build_index
+
+    def rescan(self, progressive=False):
+        """Scan the Google Play Music library.
+
+        The songs are read page by page and only their Tracks are kept, the
+        whole API response is never held at once. With progressive, the
+        library is installed as it fills up, whenever the number of tracks
+        doubled (rebuilding it then costs at most twice a single build) or
+        PUBLISH_INTERVAL passed. Playlists come last, they need all the tracks"""
+        try:
+            with self.__sync_lock:
+                sync_time = int(time.time() * 1000000)
+                log.info('Gathering track information...')
+                tracks = []
+                published = 0
+                published_time = time.time()
+                for page in self.api.get_all_songs(incremental=True):
+                    album_ids = set()
+                    for track in page:
+                        if log.isEnabledFor(logging.DEBUG):
+                            log.debug('track = %s' % pp.pformat(track))
+                        track = self.__prepare_track(track)
+                        tracks.append(track)
+                        if track.has_key('albumId'):
+                            album_ids.add(track['albumId'])
+                    # Page by page, so that the albums are ready when installed
+                    self.__enrich(album_ids)
+                    if progressive and (len(tracks) >= 2 * published or
+                                        time.time() - published_time >= PUBLISH_INTERVAL):
+                        # Albums split into discs as they fill up, the tracks
+                        # of each install are copies so their tag sizes follow
+                        content = self.__aggregate_albums(self.__copy_tracks(tracks), [])
+                        self.__carry_over_sizes(content)
+                        self.__install(content)
+                        published = len(tracks)
+                        published_time = time.time()
+                        log.info('%d tracks loaded...' % published)
+                content = self.__aggregate_albums(self.__copy_tracks(tracks),
+                                                  self.__fetch_playlists())
+                self.__carry_over_sizes(content)
+                self.__install(content, sync_time)
+        finally:
+            if self.loading:
+                with self.__installed:
+                    self.loading = False
+                    self.__installed.notify_all()
+        self.save_snapshot()
+
+    def sync(self):
+        """Apply the tracks and playlists changed since the last sync.
+
+        The changes are applied to a copy of the library that replaces the
+        current one once complete, the current one is never modified, so open
+        files and running lookups are not affected"""
+        if self.__sync_time is None:
             self.rescan()
-        self.true_file_size = true_file_size
+            return
+        with self.__sync_lock:
+            start = time.time()
+            since = self.__sync_time
+            sync_time = int(start * 1000000)
+            old = self.__content
+
+            changed = self.__fetch_changed_tracks(since)
+            tracks = dict(old['tracks'])
+            updated = 0
+            deleted = 0
+            for track in changed:
+                self.tag_cache.pop(track['id'])
+                if track.get('deleted', False):
+                    if tracks.pop(track['id'], None) is not None:
+                        deleted += 1
+                    continue
+                track = self.__prepare_track(track)
+                tracks[track['id']] = track
+                updated += 1
+
+            playlists_changed = self.__playlists_changed(since)
+            if updated == 0 and deleted == 0 and not playlists_changed:
+                self.__sync_time = sync_time
+                log.info('Library sync: nothing changed.')
+                return
+            if playlists_changed:
+                playlists = self.__fetch_playlists()
+            else:
+                playlists = [p.get_state() for p in old['playlists'].values()]
+
+            content = self.__aggregate_albums(self.__copy_tracks(tracks.values()), playlists)
+            self.__carry_over_sizes(content)
+            self.__install(content, sync_time)
+            log.info('Library sync: %d tracks updated, %d deleted in %.2fs' % (
+                updated, deleted, time.time() - start))
+        self.save_snapshot()
 
-    def rescan(self):
-        """Scan the Google Play Music library"""
-        self.__artists = {} # 'artist name' -> {'album name' : Album(), ...}
-        self.__albums = [] # [Album(), ...]
-<<<<<<< HEAD
-        self.__tracks = {}
-        self.__playlists = {}
-=======
-        self.__galbums = {}
-        self.__gartists = {}
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-        self.__aggregate_albums()
+    def __fetch_changed_tracks(self, since):
+        """Return the tracks changed (or deleted) since a time in microseconds"""
+        try:
+            return self.api.get_all_songs(include_deleted=True,
+                updated_after=datetime.datetime.utcfromtimestamp(since / 1000000.0))
+        except TypeError:
+            # Older gmusicapi cannot filter on the server side
+            tracks = self.api.get_all_songs(include_deleted=True)
+            return [t for t in tracks if int(t.get('lastModifiedTimestamp', 0)) > since]
+
+    def __playlists_changed(self, since):
+        """Tell whether any playlist changed since a time in microseconds"""
+        try:
+            playlists = self.api.get_all_playlists(include_deleted=True)
+        except Exception, e:
+            log.warning('Could not list playlists: %s' % e)
+            return True
+        for pldata in playlists:
+            if int(pldata.get('lastModifiedTimestamp', 0)) > since:
+                return True
+        return False
+
+    def __fetch_playlists(self):
+        """Download the contents of all the playlists"""
+        playlists = self.api.get_all_user_playlist_contents()
+        for pldata in playlists:
+            for entry in pldata['tracks']:
+                if 'track' in entry:
+                    entry['track'] = self.__prepare_track(entry['track'])
+        return playlists
+
+    def __copy_tracks(self, tracks):
+        """Return copies of tracks for a new content, without their tag
+        sizes: the tracks of the current content are left as they are, and
+        the tag sizes are carried over by __carry_over_sizes when still right"""
+        copies = []
+        for track in tracks:
+            track = track.copy()
+            if 'tagSize' in track:
+                del track['tagSize']
+            copies.append(track)
+        return copies
+
+    def __carry_over_sizes(self, content):
+        """Keep the sizes already computed for tracks that did not change.
+        The stream size only depends on the track, its tag size also on its
+        album (see Album.get_signature), which a sync may have changed
+        (eg. a new disc, or a new cover)"""
+        old_tracks = self.__content['tracks']
+        old_albums = self.__content['track_albums']
+        track_albums = content['track_albums']
+        for trackid, track in content['tracks'].iteritems():
+            old = old_tracks.get(trackid, None)
+            if old is None or old.get('lastModifiedTimestamp') != track.get('lastModifiedTimestamp'):
+                continue
+            if 'bytes' in old and 'bytes' not in track:
+                track['bytes'] = old['bytes']
+            if 'tagSize' not in old or 'tagSize' in track:
+                continue
+            old_album = old_albums.get(trackid, None)
+            album = track_albums.get(trackid, None)
+            if old_album is not None and album is not None and \
+                    old_album.get_signature() == album.get_signature():
+                track['tagSize'] = old['tagSize']
+
+    def __set_local_sizes(self, content):
+        """Give the tracks stored locally (see prefetch_main) their exact
+        size, whatever the snapshot or the sync said"""
+        if self.local_store is None:
+            return
+        tracks = content['tracks']
+        for trackid, size in self.local_store.sizes(tracks).iteritems():
+            track = tracks[trackid]
+            if stream_size(track) != size + ID3V1_TRAILER_SIZE:
+                set_stream_size(track, size)
+
+    def __build_index(self, content):
+        """Add every path of the filesystem to the index of a content"""
+        index = content['index']
+        for path in (u'/', u'/artists', u'/playlists'):
+            index.add(path, pathindex.DIR, path)
+        # Not listed, reading the second one also resets the counters
+        index.add(u'/.stats', pathindex.STATS, False)
+        index.add(u'/.stats-reset', pathindex.STATS, True)
+        for artist in content['artists'].values():
+            artist_path = u'/artists/%s' % artist.dirname
+            index.add(artist_path, pathindex.ARTIST, artist)
+            for album in artist.get_albums():
+                album_path = u'%s/%s' % (artist_path, album.get_dirname())
+                index.add(album_path, pathindex.ALBUM, album)
+                for track in album.get_tracks():
+                    index.add(u'%s/%s' % (album_path, album.get_track_filename(track)),
+                              pathindex.TRACK, album, track)
+                if album.get_cover_url() is not None:
+                    index.add(album_path + u'/cover.jpg', pathindex.COVER, album)
+        track_albums = content['track_albums']
+        for playlist in content['playlists'].values():
+            playlist_path = u'/playlists/%s' % playlist.dirname
+            index.add(playlist_path, pathindex.PLAYLIST, playlist)
+            for tracknum, track in enumerate(playlist.get_tracks(), 1):
+                index.add(u'%s/%s' % (playlist_path, playlist.get_track_filename(tracknum, track)),
+                          pathindex.PLAYLIST_TRACK, track_albums.get(track['id'], None), track,
+                          playlist, tracknum)
+
+    def __install(self, content, sync_time=None):
+        """Replace the library content by a freshly built one"""
+        start = time.time()
+        self.__set_local_sizes(content)
+        self.__build_index(content)
+        log.debug('Indexed %d paths in %.2fs' % (len(content['index']), time.time() - start))
+        with self.__installed:
+            self.__content = content
+            self.generation += 1
+            self.__installed.notify_all()
+        if sync_time is not None:
+            self.__sync_time = sync_time
+        self.__loaded = True
+
+    def start_sync(self, interval=0, wakeup_fd=None):
+        """Keep the library in sync from a background thread.
+
+        With a lazy scan, the library is scanned first (see rescan). A sync
+        runs right away if the library was loaded from a snapshot, then every `interval` seconds (0 disables it) and whenever wakeup_fd
+        becomes readable (see install_sync_signal). Missing album covers are
+        prefetched and missing track sizes computed after every sync."""
+        if not self.__loaded and not self.__sync_pending and not self.loading:
+            # Library scanning is disabled
+            return
+
+        def run():
+            pending = self.__sync_pending
+            self.__sync_pending = False
+            if self.loading:
+                try:
+                    self.rescan(progressive=True)
+                except Exception:
+                    log.exception('Library scan failed')
+            while True:
+                if pending:
+                    try:
+                        self.sync()
+                    except Exception:
+                        log.exception('Library sync failed')
+                self.prefetch_art()
+                self.compute_sizes()
+                if not interval and wakeup_fd is None:
+                    return
+                fds = []
+                if wakeup_fd is not None:
+                    fds.append(wakeup_fd)
+                try:
+                    readable = select.select(fds, [], [], interval or None)[0]
+                except select.error:
+                    # Interrupted by a signal, the wakeup fd will tell which
+                    continue
+                if readable:
+                    os.read(wakeup_fd, 512)
+                    log.info('Library sync requested')
+                pending = True
+
+        thread = threading.Thread(target=run, name='library-sync')
+        thread.daemon = True
+        thread.start()
+
+    def prefetch_art(self):
+        """Download the covers of all the albums that are not stored yet"""
+        urls = []
+        for album in self.__content['albums']:
+            url = album.get_cover_url()
+            if url is not None:
+                urls.append(url)
+        try:
+            self.art_store.prefetch(urls)
+        except Exception:
+            log.exception('Album art prefetch failed')
+
+    def probe_sizes(self, tracks):
+        """With --truefilesize, have the exact sizes of tracks probed in the
+        background, until then their sizes are estimated"""
+        if not self.true_file_size:
+            return
+        for track in tracks:
+            if not track.has_key('bytes'):
+                self.size_prober.submit(track['id'], lambda track=track: self.__probe_size(track))
+
+    def __probe_size(self, track):
+        size = None
+        if self.local_store is not None:
+            size = self.local_store.size(track['id'])
+        if size is None:
+            size = transport.shared.get_size(self.stream_urls.get(track['id']))
+        album = self.get_track_album(track['id'])
+        if album is not None:
+            album.set_stream_size(track, size)
+        else:
+            set_stream_size(track, size)
+
+    def probe_cover_size(self, url):
+        """With --truefilesize, have the size of a cover found in the background"""
+        if self.true_file_size:
+            self.size_prober.submit(url, lambda: self.art_store.get_size(url))
+
+    def __sizes_probed(self):
+        """Save the probed sizes with the library snapshot, not too often"""
+        if time.time() - self.__snapshot_time >= SNAPSHOT_INTERVAL:
+            self.save_snapshot()
+
+    def compute_sizes(self):
+        """Compute the tagSize of every track that has none yet, concurrently,
+        then save them with the snapshot so that later mounts have them all"""
+        todo = []
+        for album in self.__content['albums']:
+            for track in album.get_tracks():
+                if not track.has_key('tagSize'):
+                    todo.append((album, track))
+        if not todo:
+            return
+        log.info('Computing the size of %d tracks...' % len(todo))
+        start = time.time()
+        self.size_progress = (0, len(todo))
+
+        def progress(done, total):
+            self.size_progress = (done, total)
+            if done % 1000 and done != total:
+                return
+            elapsed = time.time() - start
+            rate = done / elapsed if elapsed > 0 else 0
+            log.info('Track sizes: %d/%d (%.0f%%), %.0f tracks/sec, ETA %ds' % (
+                done, total, 100.0 * done / total, rate,
+                (total - done) / rate if rate > 0 else 0))
+
+        def calc_size(n):
+            album, track = todo[n]
+            album.calc_size(track)
+        pool = workers.WorkerPool(self.scan_workers, name='sizes')
+        # Items must be hashable, hence the indexes
+        pool.map(calc_size, range(len(todo)), progress=progress)
+        log.info('Computed the size of %d tracks in %.2fs' % (len(todo), time.time() - start))
+        self.save_snapshot()
+
+    def get_track_state(self, track):
+        """Return a track as plain data for the snapshot, without a reserved tagSize"""
+        if track['id'] in self.reserved_sizes and track.has_key('tagSize'):
+            track = track.copy()
+            del track['tagSize']
+        return track.get_state()
+
+    def __get_state(self):
+        """Return the whole library as plain data for the snapshot"""
+        content = self.__content
+        return {'username': self.__username,
+                'sync_time': self.__sync_time,
+                'tracks': [self.get_track_state(track) for track in content['tracks'].values()],
+                'artists': [artist.get_state() for artist in content['artists'].values()],
+                'playlists': [playlist.get_state() for playlist in content['playlists'].values()],
+                'galbums': self.__galbums,
+                'gartists': self.__gartists}
+
+    def __build_from_state(self, state):
+        """Rebuild the library content from a snapshot state"""
+        content = self.__empty_content()
+        tracks = content['tracks']
+        for track_state in state['tracks']:
+            track = Track.from_state(track_state)
+            tracks[track['id']] = track
+        artists = content['artists']
+        albums = content['albums']
+        track_albums = content['track_albums']
+        for artist_state in state['artists']:
+            artist = Artist(self, artist_state['name'])
+            artists[artist.dirname.lower()] = artist
+            for album_state in artist_state['albums']:
+                album = Album(self, album_state['normtitle'], album_state['artist'],
+                              album_state['album'], album_state['year'])
+                album.set_state(album_state, tracks)
+                for track in album.get_tracks():
+                    track_albums[track['id']] = album
+                artist.add_album(album)
+                albums.append(album)
+        playlists = content['playlists']
+        for pldata in state['playlists']:
+            playlist = Playlist(self, pldata, tracks)
+            playlists[playlist.dirname.lower()] = playlist
+        return content
+
+    def __load_snapshot(self):
+        """Load the library from the snapshot, returns False if there is no usable one"""
+        if self.snapshot_path is None:
+            return False
+        start = time.time()
+        try:
+            state = snapshot.load(self.snapshot_path)
+        except IOError:
+            log.info('No library snapshot at %s' % self.snapshot_path)
+            return False
+        except snapshot.SnapshotError, e:
+            log.warning('Ignoring library snapshot: %s' % e)
+            return False
+        if state.get('username') != self.__username:
+            log.info('Library snapshot belongs to another account, ignoring it')
+            return False
+        self.__galbums = state['galbums']
+        self.__gartists = state['gartists']
+        self.__install(self.__build_from_state(state), state.get('sync_time'))
+        log.info('Loaded library snapshot (%d tracks) in %.2fs' % (
+            len(self.__content['tracks']), time.time() - start))
+        return True
+
+    def save_snapshot(self):
+        """Save the library to the snapshot file"""
+        if self.snapshot_path is None or not self.__loaded or self.__sync_time is None:
+            # Nothing, or only part of the library (see rescan), is loaded yet
+            return
+        start = time.time()
+        try:
+            snapshot.save(self.snapshot_path, self.__get_state())
+        except (IOError, OSError, ValueError), e:
+            log.warning('Could not save library snapshot: %s' % e)
+            return
+        self.__snapshot_time = time.time()
+        log.info('Saved library snapshot in %.2fs' % (time.time() - start))
 
     def __login_and_setup(self, username=None, password=None):
         # If credentials are not specified, get them from $HOME/.gmusicfs
@@ -412,13 +997,15 @@ class MusicLibrary(object):
             if deviceId.startswith("0x"):
                 deviceId = deviceId[2:]
 
-        self.api = GoogleMusicAPI(debug_logging=self.verbose)
+        self.__username = username
+        # Every API call is timed, see /.stats
+        self.api = stats.TimedCalls(GoogleMusicAPI(debug_logging=self.verbose), 'api.')
         log.info('Logging in...')
         self.api.login(username, password, deviceId)
         log.info('Login successful.')
 
     def __set_key_from_ginfo(self, track, ginfo, key, to_key=None):
-        'Set track key from either album_info or artist_info'
+        """Set track key from either album_info or artist_info"""
         if to_key is None:
             to_key = key
 
@@ -432,109 +1019,75 @@ class MusicLibrary(object):
 
         return track
 
-    def __cleanup_artist(self, artist):
-        if artist.startswith("featuring"):
-            artist = artist[len("featuring"):].strip()
-        if artist.startswith("feat"):
-            artist = artist[len("feat"):].strip()
-        return artist
-
-    def __cleanup_name(self, name, track):
-        for bracket in (('\[', '\]'), ('\{', '\}'), ('\(', '\)')):
-            # Remove (xxx Album Version) from track names
-            match = re.compile('^(?P<name>(.*))([ ]+[%s-]([^%s]*)[Vv]ersion[%s]?[ ]*)$' % (bracket[0], bracket[1], bracket[1])).match(name)
-            if match is not None:
-                name = match.groupdict()['name']
-                name, track = self.__cleanup_name(name, track)
-
-            # Pull (feat. <artist>) out of name and add to artist list
-            match = re.compile('^(?P<name>(.*))([ ]+[%s][ ]*[Ff]eat[\.]?[ ]*(?P<artist>(.*))[%s]+)(?P<postfix>(.*))$' % (bracket[0], bracket[1])).match(name)
-            if match is not None:
-                name = match.groupdict()['name']
-                artist = match.groupdict()['artist']
-                if match.groupdict().has_key('postfix') and match.groupdict()['postfix'] is not None:
-                    name += match.groupdict()['postfix']
-                artist = artist.strip()
-                if artist[-1] in ")}]": # I hate regex's.  The one above doesn't catch the last parenthesis if there's one
-                    artist = artist[:-1]
-                if artist.find(" and ") > -1 or artist.find(" & ") > -1:
-                    artist = artist.replace(', ', ';')
-                artist = artist.replace(' & ', ';')
-                artist = artist.replace(' and ', ';')
-                alist = artist.split(';')
-                for artist in alist:
-                     track['artist'].append(artist.strip())
-                name, track = self.__cleanup_name(name, track)
-
-            # Remove () or ( ) from track names
-            match = re.compile('^(?P<name>(.*))([ ]*[%s][ ]?[%s][ ]*)$' % (bracket[0], bracket[1])).match(name)
-            if match is not None:
-                name = match.groupdict()['name']
-                name, track = self.__cleanup_name(name, track)
-
-        # Strip any extra whitespace from the name
-        name = name.strip()
-        return name, track
-
-    def __cleanup_track(self, track):
-        name = track['title']
-        name, track = self.__cleanup_name(name, track)
-        track['title'] = name
-        for anum in range(0, len(track['artist'])):
-            track['artist'][anum] = self.__cleanup_artist(track['artist'][anum])
-        return track
-
-    def __aggregate_albums(self):
-<<<<<<< HEAD
-        """Get all the tracks and playlists in the library, parse into relevant dicts"""
-        log.info('Gathering track information...')
-        tracks = self.api.get_all_songs()
-        for track in tracks:
-            log.debug('track = %s' % pp.pformat(track))
-
-            # Prefer the album artist over the track artist if there is one
-            artist_name = formatNames(track['albumArtist'])
-            if artist_name.strip() == '':
-                artist_name = formatNames(track['artist'])
-            if artist_name.strip() == '':
-                artist_name = 'Unknown'
-
-            # Get the Artist object, or create one if it doesn't exist
-            artist = self.__artists.get(artist_name.lower(), None)
-            if not artist:
-                artist = Artist(self, artist_name)
-                self.__artists[artist_name.lower()] = artist
-
-            # Get the Album object, or create one if it doesn't exist
-            album = artist.get_album(formatNames(track['album']))
-            if not album:
-                album = Album(self, track['album'])
-                self.__albums.append(album) # NOTE: Current no purpose other than to count
-                artist.add_album(album)
-
-            # Add track to album
-            album.add_track(track)
+    def __prepare_track(self, track):
+        """Turn a track dict of the API into a Track, with the artist field
+        split into a list and the title cleaned up"""
+        if track.has_key('artist'):
+            artists = normalize.split_artists(track['artist'])
+        else:
+            artists = []
+        # Artists featured in the title, eg. 'Title (feat. Artist)', are moved to the list
+        track['title'], featured = normalize.cleanup_title(track['title'])
+        artists.extend(featured)
+        track['artist'] = [normalize.cleanup_artist(artist) for artist in artists]
+        return Track.from_dict(track)
+
+    def __album_artist_id(self, album_info):
+        """Return the Google artist ID of an album info, or None"""
+        if album_info.has_key('artistId') and len(album_info['artistId']) > 0 and album_info['artistId'][0] != "":
+            return album_info['artistId'][0]
+        return None
 
-            # Add track to list of all tracks, indexable by track ID
-            if 'id' in track:
-                self.__tracks[track['id']] = track
-=======
-        'Get all the tracks in the library, parse into artist and album dicts'
+    def __enrich(self, album_ids):
+        """Download the album and artist information that is not known yet.
+        All the albums are resolved first, then their artists, each through
+        a bounded pool of concurrent requests"""
+        start = time.time()
+        pool = workers.WorkerPool(self.scan_workers, name='enrich')
+
+        album_ids = [aid for aid in album_ids if aid not in self.__galbums]
+        log.info('Downloading album info for %d albums...' % len(album_ids))
+        self.__galbums.update(pool.map(
+            lambda aid: only_keys(self.api.get_album_info(aid, include_tracks=False),
+                                  ALBUM_INFO_KEYS),
+            album_ids, retries=SCAN_RETRIES))
+        album_time = time.time() - start
+
+        artist_ids = set()
+        for aid in album_ids:
+            artist_id = self.__album_artist_id(self.__galbums.get(aid, {}))
+            if artist_id is not None and artist_id not in self.__gartists:
+                artist_ids.add(artist_id)
+        log.info('Downloading artist info for %d artists...' % len(artist_ids))
+        self.__gartists.update(pool.map(
+            lambda aid: only_keys(self.api.get_artist_info(aid, include_albums=False, max_top_tracks=0,
+                                                           max_rel_artist=0),
+                                  ARTIST_INFO_KEYS),
+            artist_ids, retries=SCAN_RETRIES))
+
+        elapsed = time.time() - start
+        log.info('Enrichment of %d albums and %d artists took %.2fs (%.1f albums/sec)' % (
+            len(album_ids), len(artist_ids), elapsed,
+            len(album_ids) / album_time if album_time > 0 else 0))
+
+    def __aggregate_albums(self, tracks, playlists):
+        """Parse the (prepared) tracks and the playlists into a new library content"""
         all_artist_albums = {}
-        log.info('Gathering track information...')
-        tracks = self.api.get_all_songs()
+        content = self.__empty_content()
+        artists = content['artists']
+        albums = content['albums']
+        all_tracks = content['tracks']
+        track_albums = content['track_albums']
+        all_playlists = content['playlists']
+        album_ids = set()
         for track in tracks:
-            if track.has_key('artist'):
-                if track['artist'].find(" and ") > -1 or track['artist'].find(" & ") > -1:
-                    track['artist'] = track['artist'].replace(', ', ';')
-                track['artist'] = track['artist'].replace(' & ', ';')
-                track['artist'] = track['artist'].replace(' and ', ';')
-                track['artist'] = track['artist'].split(';')
-            else:
-                track['artist'] = []
+            if track.has_key('albumId'):
+                album_ids.add(track['albumId'])
 
-            track = self.__cleanup_track(track)
+        # Get album and artist information from Google, concurrently
+        self.__enrich(album_ids)
 
+        for track in tracks:
             if track.has_key('albumArtist') and track['albumArtist'] != "":
                 albumartist = track['albumArtist']
             elif len(track['artist']) == 1 and track['artist'][0] != "":
@@ -542,27 +1095,13 @@ class MusicLibrary(object):
             else:
                 albumartist = "Unknown"
 
-            # Get album and artist information from Google
+            album_info = {}
+            artist_info = {}
             if track.has_key('albumId'):
-                if self.__galbums.has_key(track['albumId']):
-                    album_info = self.__galbums[track['albumId']]
-                else:
-                    print "Downloading album info for '%s'" % track['album']
-                    album_info = self.__galbums[track['albumId']] = self.api.get_album_info(track['albumId'], include_tracks=False)
-                if album_info.has_key('artistId') and len(album_info['artistId']) > 0 and album_info['artistId'][0] != "":
-                    artist_id = album_info['artistId'][0]
-                    if self.__gartists.has_key(artist_id):
-                        artist_info = self.__gartists[artist_id]
-                    else:
-                        print "Downloading artist info for '%s'" % album_info['albumArtist']
-                        if album_info['albumArtist'] == "Various":
-                            print album_info
-                        artist_info = self.__gartists[artist_id] = self.api.get_artist_info(artist_id, include_albums=False, max_top_tracks=0, max_rel_artist=0)
-                else:
-                    artist_info = {}
-            else:
-                album_info = {}
-                artist_info = {}
+                album_info = self.__galbums.get(track['albumId'], {})
+                artist_id = self.__album_artist_id(album_info)
+                if artist_id is not None:
+                    artist_info = self.__gartists.get(artist_id, {})
 
             track = self.__set_key_from_ginfo(track, album_info, 'album', 'name')
             track = self.__set_key_from_ginfo(track, album_info, 'year')
@@ -571,105 +1110,186 @@ class MusicLibrary(object):
             # Fix for odd capitalization issues
             if artist_info.has_key('name') and track['albumArtist'].lower() == artist_info['name'].lower() and track['albumArtist'] != artist_info['name']:
                 track['albumArtist'] = artist_info['name']
-            for anum in range(0, len(track['artist'])):
-                if artist_info.has_key('name') and track['artist'][anum].lower() == artist_info['name'].lower() and track['artist'][anum] != artist_info['name']:
-                    track['artist'][anum] = artist_info['name']
+            if artist_info.has_key('name'):
+                track['artist'] = [artist_info['name'] if artist.lower() == artist_info['name'].lower() else artist
+                                   for artist in track['artist']]
 
             if not track.has_key('albumId'):
                 track['albumKey'] = "%s|||%s" % (albumartist, track['album'])
             else:
                 track['albumKey'] = track['albumId']
-            album = all_artist_albums.get(track['albumKey'], None)
 
+            # Prefer the album artist over the track artist if there is one
+            artist_name = track.get('albumArtist', '')
+            if artist_name.strip() == '':
+                artist_name = albumartist
+
+            # Get the Artist object, or create one if it doesn't exist
+            artist = artists.get(formatNames(artist_name).lower(), None)
+            if not artist:
+                artist = Artist(self, artist_name)
+                artists[artist.dirname.lower()] = artist
+
+            # Get the Album object, or create one if it doesn't exist
+            album = all_artist_albums.get(track['albumKey'], None)
             if not album:
                 album = all_artist_albums[track['albumKey']] = Album(
-                    self, formatNames(track['album']), track['albumArtist'], track['album'], track['year'] )
-                self.__albums.append(album)
-                artist_albums = self.__artists.get(track['albumArtist'], None)
-                if artist_albums:
-                    artist_albums[formatNames(album.normtitle)] = album
-                else:
-                    self.__artists[track['albumArtist']] = {album.normtitle: album}
-                    artist_albums = self.__artists[track['albumArtist']]
+                    self, formatNames(track['album']), artist_name, track['album'], track.get('year', 0))
+                albums.append(album) # NOTE: Current no purpose other than to count
+                artist.add_album(album)
+
+            # Add track to album
             album.add_track(track)
 
+            # Add track to list of all tracks, indexable by track ID
+            if 'id' in track:
+                all_tracks[track['id']] = track
+                track_albums[track['id']] = album
+
         # Separate multi-disc albums
-        for artist in self.__artists.values():
-            for key in artist.keys():
-                album = artist[key]
+        for artist in artists.values():
+            for album in artist.get_albums():
                 if album.get_disc_count() > 1:
                     for d in album.get_discs():
                         new_name = "%s - Disc %i" % (album.album, d)
                         new_album = Album(album.library, formatNames(new_name), album.artist, new_name, album.year)
-                        album.copy_art_to(new_album)
                         new_album.show_discnum = True
-                        new_key = None
                         for t in album.get_tracks():
                             if int(t['discNumber']) == d:
                                 new_album.add_track(t)
-                        artist[formatNames(new_name)] = new_album
-                    del artist[key]
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
+                                track_albums[t['id']] = new_album
+                        artist.add_album(new_album)
+                        albums.append(new_album)
+                    artist.remove_album(album)
+                    albums.remove(album)
 
         log.debug('%d tracks loaded.' % len(tracks))
-        log.debug('%d artists loaded.' % len(self.__artists))
-        log.debug('%d albums loaded.' % len(self.__albums))
+        log.debug('%d artists loaded.' % len(artists))
+        log.debug('%d albums loaded.' % len(albums))
 
         # Add all playlists
-        playlists = self.api.get_all_user_playlist_contents()
         for pldata in playlists:
-            playlist = Playlist(self, pldata)
-            self.__playlists[playlist.dirname.lower()] = playlist
-        log.debug('%d playlists loaded.' % len(self.__playlists))
+            playlist = Playlist(self, pldata, all_tracks)
+            all_playlists[playlist.dirname.lower()] = playlist
+        log.debug('%d playlists loaded.' % len(all_playlists))
+
+        return content
 
     def get_artists(self):
         """Return list of all artists in the library"""
-        return self.__artists.values()
+        return self.__content['artists'].values()
 
     def get_artist(self, name):
         """Return the artist from the library with the specified name"""
-        return self.__artists.get(name.lower(), None)
+        return self.__content['artists'].get(name.lower(), None)
 
     def get_playlists(self):
         """Return list of all playlists in the library"""
-        return self.__playlists.values()
+        return self.__content['playlists'].values()
 
     def get_playlist(self, name):
         """Return the playlist from the library with the specified name"""
-        return self.__playlists.get(name.lower(), None)
+        return self.__content['playlists'].get(name.lower(), None)
 
     def get_track(self, trackid):
         """Return the track from the library with the specified track ID"""
-        return self.__tracks.get(trackid, None)
+        return self.__content['tracks'].get(trackid, None)
+
+    def get_track_count(self):
+        """Return the number of tracks in the library"""
+        return len(self.__content['tracks'])
+
+    def get_node_tracks(self, node):
+        """Return the tracks found under a node (see pathindex), as a list
+        of (album, track), album is None for playlist tracks outside the library"""
+        kind = node[0]
+        if kind == pathindex.DIR:
+            albums, playlists = [], []
+            if node[1] in (u'/', u'/artists'):
+                albums = self.__content['albums']
+            if node[1] in (u'/', u'/playlists'):
+                playlists = self.get_playlists()
+            nodes = [(pathindex.ALBUM, album) for album in albums] + \
+                    [(pathindex.PLAYLIST, playlist) for playlist in playlists]
+            return [item for n in nodes for item in self.get_node_tracks(n)]
+        if kind == pathindex.ARTIST:
+            return [(album, track) for album in node[1].get_albums()
+                    for track in album.get_tracks()]
+        if kind == pathindex.ALBUM:
+            return [(node[1], track) for track in node[1].get_tracks()]
+        if kind == pathindex.PLAYLIST:
+            return [(self.get_track_album(track['id']), track) for track in node[1].get_tracks()]
+        if kind in (pathindex.TRACK, pathindex.PLAYLIST_TRACK):
+            return [(node[1], node[2])]
+        return []
+
+    def get_track_album(self, trackid):
+        """Return the album holding the track with the specified track ID"""
+        return self.__content['track_albums'].get(trackid, None)
+
+    def lookup(self, path):
+        """Return the node of a filesystem path (see pathindex), or None"""
+        return self.__content['index'].lookup(path)
+
+    def wait_lookup(self, path, timeout=LOOKUP_WAIT):
+        """Like lookup, but while the library is loading, give a path under
+        /artists or /playlists the next install (or timeout seconds) to show
+        up. Other paths are all there from the start, the ones missing (eg.
+        desktop.ini, .hidden) will never be"""
+        if not path.startswith((u'/artists/', u'/playlists/')):
+            return self.lookup(path)
+        with self.__installed:
+            node = self.lookup(path)
+            if node is None and self.loading:
+                self.__installed.wait(timeout)
+                node = self.lookup(path)
+        return node
 
     def cleanup(self):
-        pass
+        # Remember the tag sizes computed while mounted for the next mount
+        self.save_snapshot()
 
 class GMusicFS(LoggingMixIn, Operations):
     """Google Music Filesystem"""
 
     def __init__(self, path, username=None, password=None,
                  true_file_size=False, verbose=0, scan_library=True,
-                 lowercase=True):
+                 lowercase=True, cache_dir=None, use_snapshot=True,
+                 scan_workers=8, sync_interval=0, sync_fd=None,
+                 tag_cache_size=64 * 1024**2, readahead_high=2 * 1024**2,
+                 readahead_low=512 * 1024, block_cache_size=1024**3,
+                 stat_cache_size=65536, url_prefetch=5, warmup_depth=1,
+                 warmup_size=256 * 1024, warmup_budget=8 * 1024**2, lazy_scan=False):
         Operations.__init__(self)
-        self.artist_dir = re.compile('^/artists/(?P<artist>[^/]+)$')
-        self.artist_album_dir = re.compile(
-            '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4})_(?P<album>[^/]+)$')
-        self.artist_album_track = re.compile(
-<<<<<<< HEAD
-            '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4}) - (?P<album>[^/]+)/(?P<track>[^/]+\.mp3)$')
-        self.artist_album_image = re.compile(
-            '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4}) - (?P<album>[^/]+)/(?P<image>[^/]+\.jpg)$')
-        self.playlist_dir = re.compile('^/playlists/(?P<playlist>[^/]+)$')
-        self.playlist_track = re.compile(
-            '^/playlists/(?P<playlist>[^/]+)/(?P<track>[^/]+\.mp3)$')
-=======
-            '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4})_(?P<album>[^/]+)/(?P<track>[^/]+\.mp3)$')
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-
-        self.__open_files = {} # path -> urllib2_obj
-        self.__urls = {}       # path -> url
+        # Open file handles. FUSE may call us from several threads: the dicts
+        # are only changed with __handles_lock held, and reads on the same
+        # handle are serialized by its own lock (streams are not thread safe)
+        self.__open_files = {} # fh -> stream
+        self.__urls = {}       # fh -> (album, track)
         self.__tags = {}       # fh -> (id3v1, id3v2)
+        self.__read_locks = {} # fh -> threading.Lock()
+        self.__contents = {}   # fh -> generated file content (/.stats)
+        self.__listings = {}   # directory fh -> [(name, node), ...], see readdir
+        self.__handles_lock = threading.Lock()
+        self.__next_fh = itertools.count(1)
+
+        self.sync_interval = sync_interval
+        self.sync_fd = sync_fd
+
+        # Read-ahead watermarks in bytes, 0 disables read-ahead
+        self.readahead_high = readahead_high
+        self.readahead_low = readahead_low
+        # Stream URLs resolved ahead of time when a directory is opened
+        self.url_prefetch = url_prefetch
+        # Number of tracks prepared ahead when a track is opened, see warmup
+        self.warmup_depth = warmup_depth
+        self.warmer = None
+        if warmup_depth > 0 and warmup_size > 0:
+            self.warmer = warmup.Warmer(warmup_size, warmup_budget)
+        self.readahead_stats = stream.ReadAheadStats()
+
+        # unicode path -> (library generation, stat dict or None for ENOENT)
+        self.stat_cache = lru.LRUCache(stat_cache_size)
 
         # Define transformation based on whether lowercase filenames will be used or not
         if lowercase:
@@ -677,39 +1297,156 @@ class GMusicFS(LoggingMixIn, Operations):
         else:
             self.transform = lambda x: x
 
+        snapshot_path = None
+        art_dir = None
+        local_dir = None
+        self.block_cache = None
+        if cache_dir is not None:
+            snapshot_path = os.path.join(cache_dir, 'library.snapshot')
+            art_dir = os.path.join(cache_dir, 'art')
+            local_dir = os.path.join(cache_dir, 'tracks')
+            if block_cache_size > 0:
+                self.block_cache = blockcache.BlockCache(os.path.join(cache_dir, 'blocks'),
+                                                         block_cache_size)
+
         # Login to Google Play Music and parse the tracks:
         self.library = MusicLibrary(username, password,
-                                    true_file_size=true_file_size, verbose=verbose, scan=scan_library)
+                                    true_file_size=true_file_size, verbose=verbose, scan=scan_library,
+                                    snapshot_path=snapshot_path, use_snapshot=use_snapshot,
+                                    scan_workers=scan_workers, tag_cache_size=tag_cache_size,
+                                    art_dir=art_dir, lazy_scan=lazy_scan,
+                                    local_dir=local_dir)
         log.info("Filesystem ready : %s" % path)
 
+    def init(self, path):
+        """Called once the filesystem is mounted (and daemonized)"""
+        # Threads do not survive daemonizing, so start them only now
+        self.library.start_sync(self.sync_interval, self.sync_fd)
+
     def cleanup(self):
         self.library.cleanup()
+        transport.shared.close()
+
+    def __call__(self, op, *args):
+        # Every FUSE operation goes through here, time them all
+        with stats.shared.timed('fuse.' + op):
+            return super(GMusicFS, self).__call__(op, *args)
+
+    def render_stats(self, reset=False):
+        """Return the content of /.stats: the timings and counters since the
+        last reset, and the state of the caches since the filesystem started"""
+        caches = {
+            'stat': {'entries': len(self.stat_cache), 'hits': self.stat_cache.hits,
+                     'misses': self.stat_cache.misses},
+            'tags': {'size': self.library.tag_cache.size, 'hits': self.library.tag_cache.hits,
+                     'misses': self.library.tag_cache.misses},
+            'stream_urls': {'hits': self.library.stream_urls.hits,
+                            'misses': self.library.stream_urls.misses},
+            'readahead': {'hits': self.readahead_stats.hits, 'misses': self.readahead_stats.misses,
+                          'restarts': self.readahead_stats.restarts,
+                          'bytes': self.readahead_stats.bytes,
+                          'streams': len(streamengine.shared)},
+        }
+        if self.block_cache is not None:
+            caches['blocks'] = {'size': self.block_cache.size, 'hits': self.block_cache.hits,
+                                'misses': self.block_cache.misses}
+        if self.library.true_file_size:
+            caches['size_probes'] = {'probed': self.library.size_prober.probed,
+                                     'failed': self.library.size_prober.failed,
+                                     'pending': self.library.size_prober.pending}
+        if self.warmer is not None:
+            caches['warmup'] = {'warmed': self.warmer.warmed, 'hits': self.warmer.hits,
+                                'misses': self.warmer.misses}
+        done, total = self.library.size_progress
+        library = {'generation': self.library.generation,
+                   'loading': self.library.loading,
+                   'tracks': self.library.get_track_count(),
+                   'sizes_computed': done, 'sizes_total': total}
+        http = {'requests': transport.shared.requests,
+                'connections': transport.shared.connections,
+                'reused': transport.shared.reused}
+        return stats.shared.render(reset, caches=caches, library=library, http=http)
+
+    def __calc_size(self, album, track, fetch_art=True):
+        """Make sure the tagSize of a track is known (see Album.calc_size)"""
+        if album is not None:
+            return album.calc_size(track, fetch_art)
+        if not track.has_key('tagSize'):
+            # Tracks outside the library are streamed without an ID3v2 tag
+            track['tagSize'] = str(stream_size(track))
+        return track
 
-    def track_to_stat(self, track, st = {}):
-        """Construct and results stat information based on a track"""
-        # TODO This could be moved into a Track class in the future
-        st['st_mode'] = (S_IFREG | 0444)
-        st['st_size'] = int(track['estimatedSize'])
-        if 'bytes' in track:
-            st['st_size'] = int(track['bytes'])
-        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = 0
-        if 'creationTimestamp' in track:
-            st['st_ctime'] = st['st_mtime'] = int(track['creationTimestamp']) / 1000000
-        if 'recentTimestamp' in track:
-            st['st_atime'] = int(track['recentTimestamp']) / 1000000
-        return st
+    def __size_is_final(self, track):
+        """Tell whether the size of a track is exact, and if not, have it
+        computed in the background"""
+        if not track.has_key('tagSize'):
+            return False
+        if self.library.true_file_size and not track.has_key('bytes'):
+            self.library.probe_sizes([track])
+            return False
+        return True
+
+    def __lookup(self, path):
+        """Return the node of a path (see pathindex), ENOENT if there is none"""
+        node = self.library.lookup(path)
+        if node is None and self.library.loading:
+            # It may be in a part of the library that is not loaded yet
+            node = self.library.wait_lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        return node
 
     def getattr(self, path, fh=None):
         """Get information about a file or directory"""
-        artist_dir_m = self.artist_dir.match(path)
-        artist_album_dir_m = self.artist_album_dir.match(path)
-        artist_album_track_m = self.artist_album_track.match(path)
-<<<<<<< HEAD
-        artist_album_image_m = self.artist_album_image.match(path)
-        playlist_dir_m = self.playlist_dir.match(path)
-        playlist_track_m = self.playlist_track.match(path)
-=======
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
+        st = self.__cached_stat(path)
+        if st is None:
+            raise FuseOSError(ENOENT)
+        return dict(st)
+
+    def __cached_stat(self, path, node=None):
+        """Return the stat information of a path, None if it does not exist.
+        The answers are remembered, missing paths included, until the library
+        changes. readdir passes the node of every entry it lists"""
+        if isinstance(path, str):
+            path = path.decode('utf-8', 'replace')
+        generation = self.library.generation
+        cached = self.stat_cache.get(path)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        try:
+            if node is None:
+                node = self.__lookup(path)
+            st, final = self.__stat(path, node)
+        except FuseOSError, e:
+            if e.errno != ENOENT:
+                raise
+            st, final = None, True
+        if final:
+            self.stat_cache.put(path, (generation, st))
+        return st
+
+    def __inode(self, node):
+        """Return the inode number of a node, derived from the ids of the
+        tracks, albums, artists and playlists so that it never changes"""
+        kind = node[0]
+        if kind in (pathindex.ARTIST, pathindex.PLAYLIST):
+            key = node[1].dirname.lower()
+        elif kind in (pathindex.ALBUM, pathindex.COVER):
+            key = node[1].get_key()
+        elif kind == pathindex.TRACK:
+            key = node[2]['id']
+        elif kind == pathindex.PLAYLIST_TRACK:
+            # The same track can be in a playlist more than once
+            key = u'%s|%d|%s' % (node[3].dirname.lower(), node[4], node[2]['id'])
+        else:
+            key = node[1]
+        return pathindex.inode(kind, key)
+
+    def __stat(self, path, node):
+        """Build the stat information of a path, never waiting for the network.
+        Returns (stat, final), final is False when the size is an estimate"""
+        kind = node[0]
+        final = True
 
         # Default to a directory
         st = {
@@ -719,150 +1456,222 @@ class GMusicFS(LoggingMixIn, Operations):
         date = 0 # Make the date really old, so that cp -u works correctly.
         st['st_ctime'] = st['st_mtime'] = st['st_atime'] = date
 
-        if path == '/':
-            pass
-        elif path == '/artists':
-<<<<<<< HEAD
-            pass
-        elif path == '/playlists':
-            pass
-=======
-            st['st_size'] = len(self.library.get_artists())
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-        elif artist_dir_m:
-            try:
-                albums = self.library.get_artist_albums(
-                    artist_dir_m.groupdict()['artist'])
-            except KeyError:
-                raise FuseOSError(ENOENT)
-            st['st_size'] = len(albums)
-        elif artist_album_dir_m:
-            parts = artist_album_dir_m.groupdict()
-            try:
-                album = self.library.get_artists()[
-                    parts['artist']][parts['album']]
-            except KeyError:
-                raise FuseOSError(ENOENT)
-            st['st_size'] = album.get_track_count()
-        elif artist_album_track_m:
-            parts = artist_album_track_m.groupdict()
-<<<<<<< HEAD
-            artist = self.library.get_artist(parts['artist'])
-            album = artist.get_album(parts['album'])
-            track = album.get_track(parts['track'])
-            st = self.track_to_stat(track)
-        elif artist_album_image_m:
-            parts = artist_album_image_m.groupdict()
-            artist = self.library.get_artist(parts['artist'])
-            album = artist.get_album(parts['album'])
-            cover_size = album.get_cover_size()
+        if kind == pathindex.DIR:
+            if node[1] == u'/artists':
+                st['st_size'] = len(self.library.get_artists())
+            elif node[1] == u'/playlists':
+                st['st_size'] = len(self.library.get_playlists())
+        elif kind == pathindex.ARTIST:
+            st['st_size'] = len(node[1].get_albums())
+        elif kind == pathindex.ALBUM:
+            st['st_size'] = node[1].get_track_count()
+        elif kind == pathindex.TRACK:
+            album, track = node[1], node[2]
+            track = album.calc_size(track, fetch_art=False)
+            st = track.to_stat()
+            final = self.__size_is_final(track)
+        elif kind == pathindex.COVER:
+            cover_size = node[1].get_cover_size()
             if cover_size is None:
-            	cover_size = 10000000
+                final = not self.library.true_file_size
+                cover_size = 10000000
             st = {
                 'st_mode' : (S_IFREG | 0444),
-                'st_size' : cover_size }
-        elif playlist_dir_m:
-            pass
-        elif playlist_track_m:
-            parts = playlist_track_m.groupdict()
-            playlist = self.library.get_playlist(parts['playlist'])
-            track = playlist.get_track(parts['track'])
-            st = self.track_to_stat(track)
-=======
-            try:
-                album = self.library.get_artists()[
-                    parts['artist']][parts['album']]
-                track = album.get_track(parts['track'])
-            except KeyError:
-                raise FuseOSError(ENOENT)
-
-            if not track.has_key('tagSize'):
-                track = album.calc_size(track)
+                'st_size' : cover_size,
+                'st_nlink' : 1,
+                'st_ctime' : date,
+                'st_mtime' : date,
+                'st_atime' : date }
+        elif kind == pathindex.PLAYLIST:
+            st['st_size'] = len(node[1].get_tracks())
+        elif kind == pathindex.PLAYLIST_TRACK:
+            album, track = node[1], node[2]
+            track = self.__calc_size(album, track, fetch_art=False)
+            st = track.to_stat()
+            final = self.__size_is_final(track)
+        elif kind == pathindex.STATS:
             st = {
-                'st_mode' : (S_IFREG | 0644),
-                'st_size' : int(track['tagSize']),
+                'st_mode' : (S_IFREG | 0444),
+                'st_size' : STATS_SIZE,
                 'st_nlink' : 1,
-                'st_ctime' : int(track['creationTimestamp']) / 1000000,
-                'st_mtime' : int(track['creationTimestamp']) / 1000000,
-                'st_atime' : int(track['recentTimestamp']) / 1000000}
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-        else:
-            raise FuseOSError(ENOENT)
+                'st_ctime' : date,
+                'st_mtime' : date,
+                'st_atime' : date }
 
-        return st
+        st['st_ino'] = self.__inode(node)
+        return st, final
 
     def _open(self, path, fh):
         album_track = self.__urls.get(fh, None)
         if album_track is None:
             raise RuntimeError('unexpected path: %r' % path)
         (album, track) = album_track
-        url = album.get_track_stream(track)
-        u = self.__open_files[fh] = urllib2.urlopen(url)
-        u.bytes_read = 0
+        local_store = self.library.local_store
+        u = local_store.open(track['id']) if local_store is not None else None
+        if u is not None:
+            # Prefetched, see prefetch_main
+            with self.__handles_lock:
+                self.__open_files[fh] = u
+            return fh
+        get_url = lambda refused=None: self.library.stream_urls.get(track['id'], refused)
+        if self.readahead_high > 0:
+            open_stream = lambda: stream.ReadAhead(get_url, self.readahead_high,
+                                                   self.readahead_low, self.readahead_stats)
+        else:
+            open_stream = lambda: stream.RangeStream(get_url)
+        if self.warmer is not None:
+            head = self.warmer.get_head(track['id'])
+            if head is not None:
+                open_network = open_stream
+                open_stream = lambda: warmup.HeadStream(head[0], head[1], open_network)
+        if self.block_cache is not None:
+            length = None
+            if 'bytes' in track:
+                length = stream_size(track) - ID3V1_TRAILER_SIZE
+            u = blockcache.CachedStream(self.block_cache, track['id'], open_stream, length)
+        else:
+            u = open_stream()
+        with self.__handles_lock:
+            self.__open_files[fh] = u
         return fh
 
-    def open(self, path, fh):
+    def open(self, path, flags):
         """Open a file (track or cover image) and return a filehandle"""
-
-        artist_album_track_m = self.artist_album_track.match(path)
-<<<<<<< HEAD
-        artist_album_image_m = self.artist_album_image.match(path)
-        playlist_track_m = self.playlist_track.match(path)
-=======
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-
-        if artist_album_track_m:
-            parts = artist_album_track_m.groupdict()
-            artist = self.library.get_artist(parts['artist'])
-            album = artist.get_album(parts['album'])
-            track = album.get_track(parts['track'])
-<<<<<<< HEAD
-            url = album.get_track_stream(track)
-        elif artist_album_image_m:
-            parts = artist_album_image_m.groupdict()
-            artist = self.library.get_artist(parts['artist'])
-            album = artist.get_album(parts['album'])
-            url = album.get_cover_url()
-        elif playlist_track_m:
-            parts = playlist_track_m.groupdict()
-            playlist = self.library.get_playlist(parts['playlist'])
-            track = playlist.get_track(parts['track'])
-            url = self.library.api.get_stream_url(track['id'], deviceId)
-=======
-            if not track.has_key('tagSize'):
-                track = album.calc_size(track)
-
-            self.__urls[fh] = (album, track)
-            self.__tags[fh] = (album.gen_tag(track))
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
+        node = self.__lookup(path)
+        kind = node[0]
+        if kind == pathindex.TRACK:
+            album, track = node[1], node[2]
+            self.__set_local_size(album, track)
+            track = album.calc_size(track)
+            tags = album.get_rendered_tags(track)
+        elif kind == pathindex.COVER:
+            album = node[1]
+            track = tags = None
+        elif kind == pathindex.PLAYLIST_TRACK:
+            album, track = node[1], node[2]
+            self.__set_local_size(album, track)
+            track = self.__calc_size(album, track)
+            tags = None
+            if album is not None:
+                tags = album.get_rendered_tags(track)
+        elif kind == pathindex.STATS:
+            # The counters as they are now, reads of this handle all see them
+            content = self.render_stats(reset=node[1])
+            with self.__handles_lock:
+                fh = self.__next_fh.next()
+                self.__contents[fh] = content
+            return fh
         else:
-            RuntimeError('unexpected opening of path: %r' % path)
+            raise RuntimeError('unexpected opening of path: %r' % path)
+        if track is not None:
+            self.__warm_next(node)
 
+        with self.__handles_lock:
+            # Every open gets its own handle, even for the same path and flags
+            fh = self.__next_fh.next()
+            self.__urls[fh] = (album, track)
+            if tags is not None:
+                self.__tags[fh] = tags
+            self.__read_locks[fh] = threading.Lock()
         return fh
 
+    def __set_local_size(self, album, track):
+        """Give a track prefetched while mounted its exact size, the ones
+        stored before get it when the library is installed"""
+        local_store = self.library.local_store
+        size = local_store.size(track['id']) if local_store is not None else None
+        if size is None or stream_size(track) == size + ID3V1_TRAILER_SIZE:
+            return
+        if album is not None:
+            album.set_stream_size(track, size)
+        else:
+            set_stream_size(track, size)
+        # The paths of the track were stat'ed with the old size
+        self.stat_cache.clear()
+
+    def __warm_next(self, node):
+        """Warm up the tracks following an opened one in its album or playlist"""
+        if self.warmer is None:
+            return
+        if node[0] == pathindex.TRACK:
+            album, track = node[1], node[2]
+            tracks = album.get_tracks()
+            for position, t in enumerate(tracks):
+                if t is track:
+                    break
+            else:
+                return
+            following = [(album, t) for t in
+                         tracks[position + 1:position + 1 + self.warmup_depth]]
+        else:
+            # Playlist positions start from 1, so this is the next one
+            playlist, position = node[3], node[4]
+            following = [(self.library.get_track_album(t['id']), t) for t in
+                         playlist.get_tracks()[position:position + self.warmup_depth]]
+        for album, track in following:
+            self.warmer.warm(track['id'], self.__warmup_job(album, track))
+
+    def __warmup_job(self, album, track):
+        """Return the job preparing a track, see warmup.Warmer"""
+        def job(head_size):
+            if album is not None:
+                album.get_rendered_tags(album.calc_size(track))
+            local_store = self.library.local_store
+            if local_store is not None and local_store.has(track['id']):
+                return None
+            get_url = lambda refused=None: self.library.stream_urls.get(track['id'], refused)
+            get_url()
+            if self.block_cache is not None and self.block_cache.has(track['id'], 0):
+                # The head is on disk already
+                return None
+            u = stream.RangeStream(get_url)
+            try:
+                return u.read(0, head_size)
+            finally:
+                u.close()
+        return job
+
     def release(self, path, fh):
-        for clear_item in (self.__open_files, self.__urls, self.__tags):
-            u = clear_item.get(fh, None)
-            if u:
-                if hasattr(u, 'close'):
-                    u.close()
-                del clear_item[fh]
+        with self.__handles_lock:
+            read_lock = self.__read_locks.pop(fh, None)
+            self.__contents.pop(fh, None)
+            self.__urls.pop(fh, None)
+            self.__tags.pop(fh, None)
+        if read_lock is None:
+            return
+        # Wait for a read still running on the handle before closing its stream
+        with read_lock:
+            with self.__handles_lock:
+                u = self.__open_files.pop(fh, None)
+            if u is not None:
+                log.debug('Read-ahead: %r' % self.readahead_stats)
+                if self.block_cache is not None:
+                    log.debug('Block cache: %r' % self.block_cache)
+                if self.warmer is not None:
+                    log.debug('Warmup: %r' % self.warmer)
+                log.debug('HTTP: %r' % transport.shared)
+                u.close()
 
     def read(self, path, size, offset, fh):
-        album_track = self.__urls.get(fh, None)
+        with self.__handles_lock:
+            content = self.__contents.get(fh, None)
+            album_track = self.__urls.get(fh, None)
+            tags = self.__tags.get(fh, None)
+            read_lock = self.__read_locks.get(fh, None)
+        if content is not None:
+            return content[offset:offset + size]
         if album_track is None:
             raise RuntimeError('unexpected path: %r' % path)
         (album, track) = album_track
 
-        tag = self.__tags.get(fh, None)
-        if tag is None:
-            id3v1data = '\0' * 128
-            id3v2data = ''
-        else:
-            id3v1data = album.render_tag(tag, ID3_V1_1)
-            id3v2data = album.render_tag(tag, ID3_V2_4)
+        if track is None:
+            # Cover image
+            art = album.get_art() or ''
+            return art[offset:offset + size]
+
+        id3v1data, id3v2data = tags or ('\0' * ID3V1_TRAILER_SIZE, '')
 
-        start_id3v1tag = int(track['tagSize']) - 128
+        start_id3v1tag = int(track['tagSize']) - ID3V1_TRAILER_SIZE
         end_id3v2tag = len(id3v2data)
         buf = ""
 
@@ -878,125 +1687,141 @@ class GMusicFS(LoggingMixIn, Operations):
         if size <= 0:
             return buf
 
-        u = self.__open_files.get(fh, None)
-        if u is None:
-<<<<<<< HEAD
-            raise RuntimeError('unexpected path: %r' % path)
-        artist_album_track_m = self.artist_album_track.match(path)
-        if artist_album_track_m and (int(u.headers['Content-Length']) < (offset + size)):
-            parts = artist_album_track_m.groupdict()
-            artist = self.library.get_artist(parts['artist'])
-            album = artist.get_album(parts['album'])
-            track = album.get_track(parts['track'])
-            # Genre tag is always set to Other as Google MP3 genre tags are not id3v1 id.
-            id3v1 = struct.pack("!3s30s30s30s4s30sb", 'TAG', str(track['title']), str(track['artist']),
-        	                str(track.get('album','')), str(0), str(track.get('comment','')), 12)
-            buf = u.read(size - ID3V1_TRAILER_SIZE) + id3v1
-        else:
-            buf = u.read(size)
-            
-        try:
-            u.bytes_read += size
-        except AttributeError:
-            # Only urllib2 files need this attribute, harmless to
-            # ignore it.
-            pass
-=======
-            if self.__urls.get(fh, None) is None:
-                raise RuntimeError('unexpected path: %r' % path)
-            else:
+        # Audio bytes, offsets in the stream exclude the ID3v2 prefix
+        audio_size = min(size, start_id3v1tag - offset)
+        with read_lock:
+            u = self.__open_files.get(fh, None)
+            if u is None:
                 self._open(path, fh)
                 u = self.__open_files.get(fh, None)
                 if u is None:
                     raise RuntimeError('unexpected path: %r' % path)
+            temp_buf = u.read(offset - end_id3v2tag, audio_size)
+        if len(temp_buf) < audio_size:
+            # The stream is shorter than its estimated size
+            temp_buf += '\0' * (audio_size - len(temp_buf))
+        buf += temp_buf
 
         if offset + size > start_id3v1tag:
-            temp_buf = u.read(start_id3v1tag - offset)
-            if len(temp_buf) < start_id3v1tag - offset:
-                diff = start_id3v1tag - offset - len(temp_buf)
-                temp_buf += '\0' * diff
-            buf += temp_buf
-            buf += id3v1data[:size - (start_id3v1tag - offset)]
-            try:
-                u.bytes_read += (start_id3v1tag - offset)
-            except AttributeError:
-                pass
-        else:
-            temp_buf = u.read(size)
-            if len(temp_buf) < size:
-                diff = size - len(temp_buf)
-                temp_buf += '\0' * diff
-            buf += temp_buf
-            try:
-                u.bytes_read += size
-            except AttributeError:
-                # Only urllib2 files need this attribute, harmless to
-                # ignore it.
-                pass
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
+            buf += id3v1data[:size - audio_size]
         return buf
 
-    def readdir(self, path, fh):
-        artist_dir_m = self.artist_dir.match(path)
-        artist_album_dir_m = self.artist_album_dir.match(path)
-        artist_album_track_m = self.artist_album_track.match(path)
-<<<<<<< HEAD
-        artist_album_image_m = self.artist_album_image.match(path)
-        playlist_dir_m = self.playlist_dir.match(path)
-=======
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-
-        if path == '/':
-            return ['.', '..', 'artists', 'playlists']
-        elif path == '/artists':
-            artist_dirs = map((lambda a: self.transform(a.dirname)), self.library.get_artists())
-            return  ['.','..'] + artist_dirs
-        elif path == '/playlists':
-            playlist_dirs = map((lambda p: self.transform(p.dirname)), self.library.get_playlists())
-            return  ['.','..'] + playlist_dirs
-        elif artist_dir_m:
+    def opendir(self, path):
+        """Resolve the stream URLs of the first tracks of an album or playlist
+        in the background, a player is likely to open them next"""
+        node = self.library.lookup(path)
+        if node is not None and self.url_prefetch > 0:
+            if node[0] in (pathindex.ALBUM, pathindex.PLAYLIST):
+                tracks = node[1].get_tracks()[:self.url_prefetch]
+                self.library.stream_urls.prefetch([t['id'] for t in tracks])
+        with self.__handles_lock:
+            return self.__next_fh.next()
+
+    def releasedir(self, path, fh):
+        with self.__handles_lock:
+            self.__listings.pop(fh, None)
+        return 0
+
+    def readdir(self, path, fh, offset=0):
+        """List a directory as (name, stat, offset of the next entry) tuples.
+
+        FUSE fills its buffer page by page, asking again from the offset it
+        stopped at (see GMusicFUSE): the listing is built on the first call
+        for a directory handle and kept until it is released, so a large
+        directory is not listed again for every page. Through a handle, a
+        call returns READDIR_PAGE entries at most, a page only needs a few
+        dozen.
+
+        The stat of every entry returned is looked up now, from the node
+        already at hand: only its inode number and file type reach the
+        kernel (see GMusicFUSE), but it is in the stat cache when the
+        getattr calls for the entries follow, without a path lookup each"""
+        entries = None
+        if offset:
+            with self.__handles_lock:
+                entries = self.__listings.get(fh, None)
+        if entries is None:
+            entries = self.__listing(path)
+            if fh:
+                with self.__handles_lock:
+                    self.__listings[fh] = entries
+        end = min(offset + READDIR_PAGE, len(entries)) if fh else len(entries)
+        return self.__entries(path, entries, offset, end)
+
+    def __entries(self, path, entries, start, end):
+        """Return the entries from start to end with their stat"""
+        if isinstance(path, str):
+            path = path.decode('utf-8', 'replace')
+        parent = path.rstrip(u'/')
+        result = []
+        for position in xrange(start, end):
+            name, node = entries[position]
+            st = None
+            if node is not None:
+                entry_path = path if name == '.' else u'%s/%s' % (parent, name)
+                st = self.__cached_stat(entry_path, node)
+            result.append((name, st, position + 1))
+        return result
+
+    def __listing(self, path):
+        """Return the entries of a directory as (name, node) pairs"""
+        node = self.__lookup(path)
+        kind = node[0]
+        files = [('.', node), ('..', None)]
+
+        if kind == pathindex.DIR:
+            if node[1] == u'/':
+                files += [(name, self.library.lookup(u'/' + name))
+                          for name in (u'artists', u'playlists')]
+            elif node[1] == u'/artists':
+                files += [(self.transform(a.dirname), (pathindex.ARTIST, a))
+                          for a in self.library.get_artists()]
+            elif node[1] == u'/playlists':
+                files += [(self.transform(p.dirname), (pathindex.PLAYLIST, p))
+                          for p in self.library.get_playlists()]
+        elif kind == pathindex.ARTIST:
             # Artist directory, lists albums.
-            parts = artist_dir_m.groupdict()
-            artist = self.library.get_artist(parts['artist'])
-            albums = artist.get_albums()
-            # Sort albums by year:
-<<<<<<< HEAD
-            album_dirs = [u'{year:04d} - {name}'.format(
-                year=a.get_year(), name=self.transform(a.normtitle)) for a in albums]
-=======
-            album_dirs = []
-            for a in albums.values():
-                album_dirs.append(u'{year:04d}_{name}'.format(year=a.get_year(), name=formatNames(a.normtitle)))
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-            return ['.','..'] + album_dirs
-        elif artist_album_dir_m:
+            files += [(self.transform(a.get_dirname()), (pathindex.ALBUM, a))
+                      for a in node[1].get_albums()]
+        elif kind == pathindex.ALBUM:
             # Album directory, lists tracks.
-            parts = artist_album_dir_m.groupdict()
-            artist = self.library.get_artist(parts['artist'])
-            album = artist.get_album(parts['album'])
-            files = ['.','..']
+            album = node[1]
             for track in album.get_tracks(get_size=True):
-<<<<<<< HEAD
-                files.append('%03d - %s.mp3' %
-                    (track['trackNumber'], self.transform(formatNames(track['title']))))
+                files.append((self.transform(album.get_track_filename(track)),
+                              (pathindex.TRACK, album, track)))
             # Include cover image:
-            cover = album.get_cover_url()
-            if cover:
-                files.append('cover.jpg')
-=======
-                track = album.calc_size(track)
-                files.append('%02d_%s.mp3' % (track['trackNumber'], formatNames(track['title'])))
->>>>>>> 556157a0ec707fed62dd1323aa55ccebd3fe31a6
-            return files
-        elif playlist_dir_m:
-            parts = playlist_dir_m.groupdict()
-            playlist = self.library.get_playlist(parts['playlist'])
-            files = ['.', '..']
-            tracknum = 1
-            for track in playlist.get_tracks():
-                files.append(self.transform(formatNames('%03d - %s - %s - %s.mp3' % (tracknum, track['artist'], track['album'], track['title']))))
-                tracknum += 1
-            return files
+            if album.get_cover_url():
+                files.append(('cover.jpg', (pathindex.COVER, album)))
+        elif kind == pathindex.PLAYLIST:
+            playlist = node[1]
+            for tracknum, track in enumerate(playlist.get_tracks(get_size=True), 1):
+                files.append((self.transform(playlist.get_track_filename(tracknum, track)),
+                              (pathindex.PLAYLIST_TRACK, self.library.get_track_album(track['id']),
+                               track, playlist, tracknum)))
+        else:
+            raise FuseOSError(ENOENT)
+        return files
+
+class GMusicFUSE(FUSE):
+    """FUSE, passing the offset of readdir calls on to the filesystem.
+
+    fusepy drops it and expects the whole listing on every call, while the
+    kernel asks for a large directory a page at a time. The stat of the
+    entries is passed on as well, but libfuse 2 has no readdirplus: the
+    kernel only gets their inode number and file type from it, and still
+    calls getattr for each entry a listing like `ls -l` looks at"""
+
+    def readdir(self, path, buf, filler, offset, fip):
+        path = path.decode(self.encoding)
+        for name, attrs, next_offset in self.operations('readdir', path,
+                                                         fip.contents.fh, offset):
+            st = None
+            if attrs:
+                st = c_stat()
+                set_st_attrs(st, attrs)
+            if filler(buf, name.encode(self.encoding), st, next_offset) != 0:
+                break
+        return 0
 
 
 def getDeviceId(verbose=False):
@@ -1031,7 +1856,81 @@ def getDeviceId(verbose=False):
         if device['id'][1]=='x':
             print '%s : %s' % (device['name'], device['id'])
 
+def install_sync_signal():
+    """Make SIGHUP trigger a library sync.
+    Returns a file descriptor that becomes readable when SIGHUP is received"""
+    sync_r, sync_w = os.pipe()
+    fcntl.fcntl(sync_w, fcntl.F_SETFL, fcntl.fcntl(sync_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+    # The handler itself has nothing to do, the main thread may be stuck in
+    # the FUSE loop anyway. Python writes to the wakeup fd from C instead.
+    signal.signal(signal.SIGHUP, lambda signum, frame: None)
+    signal.set_wakeup_fd(sync_w)
+    return sync_r
+
+def prefetch_main(argv):
+    """gmusicfs prefetch: download artists, albums or playlists into the
+    cache directory, mounts using it then play them without the network"""
+    parser = argparse.ArgumentParser(prog='gmusicfs prefetch',
+                                     description='Download tracks for offline use')
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help='What to download, as found in the filesystem'
+                        ' (eg. /artists/Foo, /artists/Foo/2001_bar, /playlists/Baz)')
+    parser.add_argument('-v', '--verbose', help='Be a little verbose',
+                        action='store_true', dest='verbose')
+    parser.add_argument('--cachedir', help='Where to keep the downloaded tracks'
+                        ' (default: %(default)s)',
+                        default=os.path.join(os.path.expanduser('~'), '.cache', 'gmusicfs'),
+                        dest='cachedir')
+    parser.add_argument('-j', '--concurrency', help='Number of tracks downloaded at'
+                        ' once (default: %(default)s)',
+                        type=int, default=4, dest='concurrency', metavar='N')
+    parser.add_argument('--limit', help='Download at most KB per second in all,'
+                        ' 0 for no limit (default: %(default)s)',
+                        type=int, default=0, dest='limit', metavar='KB')
+    args = parser.parse_args(argv)
+
+    log.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('gmusicapi').setLevel(logging.WARNING)
+    logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
+
+    library = MusicLibrary(snapshot_path=os.path.join(args.cachedir, 'library.snapshot'),
+                           art_dir=os.path.join(args.cachedir, 'art'),
+                           local_dir=os.path.join(args.cachedir, 'tracks'))
+    tracks = {} # 'trackId' -> (album, track)
+    order = []
+    for path in args.paths:
+        node = library.lookup(path.rstrip('/') or '/')
+        if node is None:
+            parser.error('no such path: %s' % path)
+        for album, track in library.get_node_tracks(node):
+            if track['id'] not in tracks:
+                tracks[track['id']] = (album, track)
+                order.append(track['id'])
+
+    def prepare(trackid):
+        album, track = tracks[trackid]
+        if album is not None:
+            # Downloads the cover into the cache directory too
+            album.calc_size(track)
+
+    prefetcher = prefetch.Prefetcher(library.local_store, library.stream_urls.get,
+                                     args.concurrency, args.limit * 1024)
+    sizes = prefetcher.run([(trackid, stream_size(tracks[trackid][1])) for trackid in order],
+                           prepare)
+    # Mounts report the exact sizes of the downloaded tracks
+    for trackid, size in sizes.iteritems():
+        album, track = tracks[trackid]
+        if album is not None:
+            album.set_stream_size(track, size)
+        else:
+            set_stream_size(track, size)
+    library.cleanup()
+    return 0 if len(sizes) == len(order) else 1
+
 def main():
+    if sys.argv[1:2] == ['prefetch']:
+        sys.exit(prefetch_main(sys.argv[2:]))
+
     log.setLevel(logging.WARNING)
     logging.getLogger('gmusicapi').setLevel(logging.WARNING)
     logging.getLogger('fuse').setLevel(logging.WARNING)
@@ -1056,7 +1955,7 @@ def main():
     parser.add_argument('-vv', '--veryverbose', help='Be very verbose',
                         action='store_true', dest='veryverbose')
     parser.add_argument('-t', '--truefilesize', help='Report true filesizes'
-                        ' (slower directory reads)',
+                        ' (probed in the background, estimated until then)',
                         action='store_true', dest='true_file_size')
     parser.add_argument('--allusers', help='Allow all system users access to files'
                         ' (Requires user_allow_other set in /etc/fuse.conf)',
@@ -1067,6 +1966,64 @@ def main():
                         action='store_true', dest='deviceId')
     parser.add_argument('-l', '--lowercase', help='Convert all path elements to lowercase',
                         action='store_true', dest='lowercase')
+    parser.add_argument('--cachedir', help='Where to keep the library snapshot'
+                        ' (default: %(default)s)',
+                        default=os.path.join(os.path.expanduser('~'), '.cache', 'gmusicfs'),
+                        dest='cachedir')
+    parser.add_argument('--rescan', help='Ignore the library snapshot and rescan at launch',
+                        action='store_true', dest='rescan')
+    parser.add_argument('--lazyscan', help='When there is no library snapshot to load, mount'
+                        ' right away and fill the library in the background',
+                        action='store_true', dest='lazyscan')
+    parser.add_argument('--scanworkers', help='Number of concurrent album/artist info'
+                        ' requests during a scan (default: %(default)s)',
+                        type=int, default=8, dest='scanworkers')
+    parser.add_argument('--syncinterval', help='Sync the library with Google Music every'
+                        ' N minutes, 0 to only sync on SIGHUP (default: %(default)s)',
+                        type=int, default=0, dest='syncinterval')
+    parser.add_argument('--tagcache', help='Memory used to cache rendered ID3 tags,'
+                        ' in MB (default: %(default)s)',
+                        type=int, default=64, dest='tagcache')
+    parser.add_argument('--readahead', help='Stream up to N KB ahead of the reader,'
+                        ' 0 to disable read-ahead (default: %(default)s)',
+                        type=int, default=2048, dest='readahead')
+    parser.add_argument('--readahead-low', help='Resume streaming ahead once less than'
+                        ' N KB are buffered (default: %(default)s)',
+                        type=int, default=512, dest='readahead_low')
+    parser.add_argument('--diskcache', help='Disk space used to cache track audio in the'
+                        ' cache directory, in MB, 0 to disable (default: %(default)s)',
+                        type=int, default=1024, dest='diskcache')
+    parser.add_argument('--urlprefetch', help='Resolve the stream URLs of the first N'
+                        ' tracks of an album or playlist when its directory is opened,'
+                        ' 0 to disable (default: %(default)s)',
+                        type=int, default=5, dest='urlprefetch')
+    parser.add_argument('--warmup', help='When a track is opened, prepare the next N'
+                        ' tracks of its album or playlist, 0 to disable (default: %(default)s)',
+                        type=int, default=1, dest='warmup')
+    parser.add_argument('--warmup-size', help='Download the first N KB of the tracks'
+                        ' being prepared (default: %(default)s)',
+                        type=int, default=256, dest='warmup_size')
+    parser.add_argument('--warmup-budget', help='Memory used to keep the downloads of'
+                        ' prepared tracks, in MB (default: %(default)s)',
+                        type=int, default=8, dest='warmup_budget')
+    parser.add_argument('--httptimeout', help='Seconds to wait for Google Music servers'
+                        ' (default: %(default)s)',
+                        type=float, default=30, dest='httptimeout')
+    parser.add_argument('--httpconns', help='Idle connections kept open per server for'
+                        ' the next requests (default: %(default)s)',
+                        type=int, default=4, dest='httpconns')
+    parser.add_argument('--entry-timeout', help='Seconds the kernel may cache name'
+                        ' lookups (default: %(default)s)',
+                        type=float, default=30, dest='entry_timeout')
+    parser.add_argument('--attr-timeout', help='Seconds the kernel may cache file'
+                        ' attributes (default: %(default)s)',
+                        type=float, default=30, dest='attr_timeout')
+    parser.add_argument('--negative-timeout', help='Seconds the kernel may remember'
+                        ' that a path does not exist (default: %(default)s)',
+                        type=float, default=10, dest='negative_timeout')
+    parser.add_argument('--nothreads', help='Serve one filesystem request at a time'
+                        ' instead of running them concurrently',
+                        action='store_true', dest='nothreads')
 
     args = parser.parse_args()
 
@@ -1092,10 +2049,26 @@ def main():
         logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
         verbosity = 0
 
-    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, scan_library= not args.nolibrary, lowercase=args.lowercase)
+    transport.shared.timeout = args.httptimeout
+    streamengine.shared.timeout = args.httptimeout
+    transport.shared.max_idle = args.httpconns
+
+    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, scan_library= not args.nolibrary, lowercase=args.lowercase,
+                  cache_dir=args.cachedir, use_snapshot=not args.rescan,
+                  scan_workers=args.scanworkers,
+                  sync_interval=args.syncinterval * 60, sync_fd=install_sync_signal(),
+                  tag_cache_size=args.tagcache * 1024**2,
+                  readahead_high=args.readahead * 1024, readahead_low=args.readahead_low * 1024,
+                  block_cache_size=args.diskcache * 1024**2,
+                  url_prefetch=args.urlprefetch, warmup_depth=args.warmup,
+                  warmup_size=args.warmup_size * 1024,
+                  warmup_budget=args.warmup_budget * 1024**2,
+                  lazy_scan=args.lazyscan)
     try:
-        fuse = FUSE(fs, mountpoint, foreground=args.foreground,
-                    ro=True, nothreads=True, allow_other=args.allusers)
+        fuse = GMusicFUSE(fs, mountpoint, foreground=args.foreground,
+                          ro=True, nothreads=args.nothreads, allow_other=args.allusers,
+                          entry_timeout=args.entry_timeout, attr_timeout=args.attr_timeout,
+                          negative_timeout=args.negative_timeout, use_ino=True)
     finally:
         fs.cleanup()
 
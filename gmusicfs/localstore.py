@@ -0,0 +1,118 @@
+# Local store of whole tracks, filled by `gmusicfs prefetch`.
+#
+# A track is kept as <directory>/<track id>.mp3, its audio as streamed:
+# the ID3 tags are rendered at read time, as for streamed tracks. It is
+# downloaded to <track id>.part first and renamed once complete, so the
+# filesystem only ever serves complete tracks, and an interrupted download
+# resumes from the end of its .part file. Nothing is evicted, tracks stay
+# until they are removed from the directory.
+
+import os
+import re
+import threading
+import logging
+
+import stats
+
+log = logging.getLogger('gmusicfs')
+
+class LocalStore(object):
+    """
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> store = LocalStore(directory)
+    >>> store.has('T1'), store.open('T1') is None
+    (False, True)
+    >>> open(store.part_path('T1'), 'wb').write('abcdef')
+    >>> store.commit('T1'), store.has('T1')
+    (6, True)
+    >>> store.sizes(['T1', 'T2'])
+    {'T1': 6}
+    >>> s = store.open('T1')
+    >>> s.read(2, 3), s.read(4, 10), s.read(6, 10)
+    ('cde', 'ef', '')
+    >>> s.close()
+    >>> shutil.rmtree(directory)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+    def __name(self, trackid):
+        return re.sub('[^A-Za-z0-9_.-]', '_', trackid)
+
+    def path(self, trackid):
+        return os.path.join(self.directory, self.__name(trackid) + '.mp3')
+
+    def part_path(self, trackid):
+        """Where a track is downloaded to until it is complete"""
+        return os.path.join(self.directory, self.__name(trackid) + '.part')
+
+    def size(self, trackid):
+        """Return the size of a stored track, or None"""
+        try:
+            return os.path.getsize(self.path(trackid))
+        except OSError:
+            return None
+
+    def sizes(self, trackids):
+        """Return a dict trackid -> size of the stored tracks among trackids,
+        the directory is listed once instead of looking for every track"""
+        try:
+            names = set(os.listdir(self.directory))
+        except OSError:
+            return {}
+        sizes = {}
+        for trackid in trackids:
+            if self.__name(trackid) + '.mp3' in names:
+                size = self.size(trackid)
+                if size is not None:
+                    sizes[trackid] = size
+        return sizes
+
+    def part_size(self, trackid):
+        """Return how much of a track was downloaded so far, 0 if nothing"""
+        try:
+            return os.path.getsize(self.part_path(trackid))
+        except OSError:
+            return 0
+
+    def has(self, trackid):
+        return os.path.isfile(self.path(trackid))
+
+    def commit(self, trackid):
+        """Move a completely downloaded track in place, returns its size"""
+        os.rename(self.part_path(trackid), self.path(trackid))
+        return self.size(trackid)
+
+    def open(self, trackid):
+        """Return a LocalStream on a stored track, or None"""
+        try:
+            f = open(self.path(trackid), 'rb')
+        except IOError:
+            return None
+        stats.shared.count('local.opens')
+        return LocalStream(f)
+
+    def __repr__(self):
+        return '<LocalStore %s>' % self.directory
+
+class LocalStream(object):
+    """Random access reader for a stored track, with the interface of
+    stream.RangeStream"""
+
+    def __init__(self, f):
+        self.__file = f
+        self.__lock = threading.Lock()
+
+    def read(self, offset, size):
+        """Return up to size bytes at offset, fewer only at the end of the track"""
+        with self.__lock:
+            self.__file.seek(offset)
+            data = self.__file.read(size)
+        stats.shared.count('local.bytes', len(data))
+        return data
+
+    def close(self):
+        self.__file.close()
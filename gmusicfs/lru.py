@@ -0,0 +1,81 @@
+# Thread safe least-recently-used cache, bounded by the number of entries
+# or by the total size of the values.
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    >>> c = LRUCache(max_size=6, sizeof=len)
+    >>> c.put('a', 'xxx')
+    >>> c.put('b', 'yyy')
+    >>> c.get('a')
+    'xxx'
+    >>> c.put('c', 'zzz')
+    >>> c.get('b') is None
+    True
+    >>> sorted(c.keys())
+    ['a', 'c']
+    >>> c.pop('a')
+    'xxx'
+    >>> len(c), c.size
+    (1, 3)
+    """
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        # Without sizeof, every entry counts as 1 and max_size is a count:
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            if size > self.max_size:
+                return
+            self.__entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.__entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            value = self.__entries.pop(key, None)
+            if value is None:
+                return default
+            self.size -= self.sizeof(value)
+            return value
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def keys(self):
+        with self.__lock:
+            return self.__entries.keys()
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
@@ -0,0 +1,123 @@
+# Normalization of the names coming from Google Music: file and directory
+# names, track titles and artist lists.
+#
+# The same strings are normalized over and over (every scan, sync, readdir
+# and index build), so the patterns are compiled once and the results of
+# the pure functions are memoized in bounded caches.
+
+import re
+
+# Entries kept by each memo before it starts over
+MEMO_SIZE = 65536
+
+def memoize(max_size=MEMO_SIZE):
+    """Cache the results of a function of one hashable argument. The
+    cache is simply emptied when full, which is cheap and good enough for
+    names that are seen in bursts (a scan, a directory listing)."""
+    def decorator(func):
+        memo = {}
+        def memoized(value):
+            try:
+                return memo[value]
+            except KeyError:
+                pass
+            result = func(value)
+            if len(memo) >= max_size:
+                memo.clear()
+            memo[value] = result
+            return result
+        memoized.__name__ = func.__name__
+        memoized.__doc__ = func.__doc__
+        memoized.memo = memo
+        return memoized
+    return decorator
+
+_UNSAFE_CHARS = re.compile('[?"`]')
+
+@memoize()
+def format_name(name):
+    """Format a name to make it suitable to use as a filename
+
+    >>> format_name(u'Live: "Best of" 1/2?')
+    u'Live - Best of 1-2'
+    """
+    name = name.replace(": ", " - ")
+    name = name.replace(":", "-")
+    name = name.replace("/", "-")
+    return _UNSAFE_CHARS.sub('', name)
+
+def split_artists(artist):
+    """Split an artist field listing several artists
+
+    >>> split_artists(u'Simon & Garfunkel')
+    [u'Simon', u'Garfunkel']
+    >>> split_artists(u'Crosby, Stills, Nash and Young')
+    [u'Crosby', u'Stills', u'Nash', u'Young']
+    """
+    if artist.find(" and ") > -1 or artist.find(" & ") > -1:
+        artist = artist.replace(', ', ';')
+    artist = artist.replace(' & ', ';')
+    artist = artist.replace(' and ', ';')
+    return artist.split(';')
+
+def cleanup_artist(artist):
+    """Remove a leading 'featuring' from an artist name"""
+    if artist.startswith("featuring"):
+        artist = artist[len("featuring"):].strip()
+    if artist.startswith("feat"):
+        artist = artist[len("feat"):].strip()
+    return artist
+
+# For each kind of brackets: "name (... Version)" (a dash works as the
+# opening bracket too), "name (feat. artist)postfix" and "name ()"
+_TITLE_PATTERNS = [
+    (re.compile('^(?P<name>(.*))([ ]+[%s-]([^%s]*)[Vv]ersion[%s]?[ ]*)$' % (opening, closing, closing)),
+     re.compile('^(?P<name>(.*))([ ]+[%s][ ]*[Ff]eat[\.]?[ ]*(?P<artist>(.*))[%s]+)(?P<postfix>(.*))$' % (opening, closing)),
+     re.compile('^(?P<name>(.*))([ ]*[%s][ ]?[%s][ ]*)$' % (opening, closing)))
+    for opening, closing in (('\[', '\]'), ('\{', '\}'), ('\(', '\)'))]
+
+def _cleanup_title(name, featured):
+    for version_re, feat_re, empty_re in _TITLE_PATTERNS:
+        # Remove (xxx Album Version) from track names
+        match = version_re.match(name)
+        if match is not None:
+            name = _cleanup_title(match.group('name'), featured)
+
+        # Pull (feat. <artist>) out of name and add to artist list
+        match = feat_re.match(name)
+        if match is not None:
+            name = match.group('name')
+            artist = match.group('artist')
+            if match.group('postfix') is not None:
+                name += match.group('postfix')
+            artist = artist.strip()
+            if artist and artist[-1] in ")}]":
+                # The pattern misses the last bracket when there are two
+                artist = artist[:-1]
+            featured.extend(a.strip() for a in split_artists(artist))
+            name = _cleanup_title(name, featured)
+
+        # Remove () or ( ) from track names
+        match = empty_re.match(name)
+        if match is not None:
+            name = _cleanup_title(match.group('name'), featured)
+
+    # Strip any extra whitespace from the name
+    return name.strip()
+
+@memoize()
+def cleanup_title(title):
+    """Return (title, featured artists) for a track title
+
+    >>> cleanup_title(u'Song (feat. Someone & Other) [Album Version]')
+    (u'Song', (u'Someone', u'Other'))
+    >>> cleanup_title(u'Plain title ')
+    (u'Plain title', ())
+    """
+    if 'ersion' not in title and '(' not in title and '[' not in title \
+            and '{' not in title:
+        # No pattern can match, skip them (most titles)
+        return title.strip(), ()
+    featured = []
+    title = _cleanup_title(title, featured)
+    return title, tuple(featured)
@@ -0,0 +1,66 @@
+# Index of every path of the filesystem, built along with the library, so
+# that resolving a path is a single dict lookup instead of a chain of
+# regular expressions followed by linear scans of the albums.
+#
+# Keys are lowercased, so paths resolve whatever their case (the
+# --lowercase option only changes how names are listed).
+#
+# Nodes also get inode numbers derived from the IDs of what they stand
+# for, so they stay the same across syncs and mounts.
+
+import hashlib
+import struct
+
+# Node kinds, the first item of every node
+DIR = 'dir'                 # ('dir', name) for /, /artists and /playlists
+ARTIST = 'artist'           # ('artist', Artist)
+ALBUM = 'album'             # ('album', Album)
+TRACK = 'track'             # ('track', Album, track)
+COVER = 'cover'             # ('cover', Album)
+PLAYLIST = 'playlist'       # ('playlist', Playlist)
+PLAYLIST_TRACK = 'playlist_track' # ('playlist_track', Album or None, track,
+                                  #  Playlist, position from 1)
+STATS = 'stats'             # ('stats', reset) for /.stats and /.stats-reset
+
+def inode(kind, key):
+    """Return the inode number of a node, from its kind and a key
+    identifying it (a track id for a track). The root is 1
+
+    >>> inode(DIR, u'/')
+    1
+    >>> inode(TRACK, u'T1') == inode(TRACK, 'T1') != inode(COVER, u'T1')
+    True
+    """
+    if kind == DIR and key == u'/':
+        return 1
+    digest = hashlib.md5((u'%s:%s' % (kind, key)).encode('utf-8')).digest()
+    # 63 bits so that it fits in a signed 64-bit integer, never 0 or 1
+    return (struct.unpack('!Q', digest[:8])[0] >> 1) | 2
+
+class PathIndex(object):
+    """
+    >>> index = PathIndex()
+    >>> index.add(u'/artists/Foo', ARTIST, 'foo')
+    >>> index.lookup('/ARTISTS/foo')
+    ('artist', 'foo')
+    >>> index.add(u'/artists/FOO', ARTIST, 'other')
+    >>> index.lookup('/artists/foo')
+    ('artist', 'foo')
+    >>> index.lookup('/artists/bar') is None
+    True
+    """
+    def __init__(self):
+        self.__nodes = {} # lowercased path -> node
+
+    def add(self, path, kind, *items):
+        """Add a node, the first one added wins when two paths collide"""
+        self.__nodes.setdefault(path.lower(), (kind,) + items)
+
+    def lookup(self, path):
+        """Return the node of a path, or None"""
+        if isinstance(path, str):
+            path = path.decode('utf-8', 'replace')
+        return self.__nodes.get(path.lower(), None)
+
+    def __len__(self):
+        return len(self.__nodes)
@@ -0,0 +1,195 @@
+# Bulk download of tracks into the local store, for `gmusicfs prefetch`.
+#
+# Tracks are downloaded `concurrency` at a time, within an optional
+# bandwidth limit shared by all the downloads, with a progress line.
+# Tracks already stored are skipped and partial downloads resume where
+# they stopped, so running it again after an interruption (or a failure)
+# finishes the job.
+
+import sys
+import time
+import threading
+import logging
+
+import stream
+import workers
+
+log = logging.getLogger('gmusicfs')
+
+READ_CHUNK = 64 * 1024
+
+class RateLimiter(object):
+    """Paces the bytes going through it to `rate` bytes per second, 0 for
+    no limit. Shared by several threads, they get the rate between them
+
+    >>> limiter = RateLimiter(256 * 1024)
+    >>> start = time.time()
+    >>> for i in range(3):
+    ...     limiter.consume(64 * 1024)
+    >>> 1.0 > time.time() - start >= 0.75
+    True
+    """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.__next = time.time() # When the next bytes may go through
+        self.__lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Wait until nbytes more are allowed through"""
+        if self.rate <= 0:
+            return
+        with self.__lock:
+            now = time.time()
+            self.__next = max(self.__next, now) + nbytes / float(self.rate)
+            delay = self.__next - now
+        if delay > 0:
+            time.sleep(delay)
+
+class Progress(object):
+    """Progress of a prefetch, shown on one line updated in place on a
+    terminal, or as a log line every `interval` seconds otherwise"""
+
+    def __init__(self, total_tracks, total_bytes, out=sys.stderr, interval=10):
+        self.total_tracks = total_tracks
+        self.total_bytes = total_bytes
+        self.tracks = 0
+        self.failed = 0
+        self.bytes = 0
+        self.out = out
+        self.interval = interval
+        self.__tty = hasattr(out, 'isatty') and out.isatty()
+        self.__start = time.time()
+        self.__shown = 0
+        self.__lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.__lock:
+            self.bytes += nbytes
+
+    def done(self):
+        with self.__lock:
+            self.tracks += 1
+
+    def render(self):
+        """Return the progress line
+
+        >>> p = Progress(10, 20 * 1024**2)
+        >>> p.add(5 * 1024**2); p.done(); p.done()
+        >>> p.failed = 1
+        >>> p.render().startswith('2/10 tracks (1 failed), 5.0/20.0 MB, 25%, ')
+        True
+        """
+        elapsed = time.time() - self.__start
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        line = '%d/%d tracks' % (self.tracks, self.total_tracks)
+        if self.failed:
+            line += ' (%d failed)' % self.failed
+        line += ', %.1f/%.1f MB, %d%%, ' % (self.bytes / 1024.0**2, self.total_bytes / 1024.0**2,
+                                            100 * self.bytes / max(self.total_bytes, 1))
+        if rate > 0 and self.tracks < self.total_tracks:
+            eta = max(self.total_bytes - self.bytes, 0) / rate
+            line += '%.1f MB/s, ETA %dm%02ds' % (rate / 1024**2, eta / 60, eta % 60)
+        elif rate > 0:
+            line += '%.1f MB/s' % (rate / 1024**2)
+        else:
+            line += '...'
+        return line
+
+    def show(self, final=False):
+        now = time.time()
+        if self.__tty:
+            self.out.write('\r\033[K' + self.render() + ('\n' if final else ''))
+            self.out.flush()
+        elif final or now - self.__shown >= self.interval:
+            self.__shown = now
+            self.out.write(self.render() + '\n')
+            self.out.flush()
+
+class Prefetcher(object):
+    """Downloads tracks into a localstore.LocalStore, get_url(trackid,
+    refused=None) resolves their stream URLs"""
+
+    def __init__(self, store, get_url, concurrency=4, rate=0, out=sys.stderr):
+        self.store = store
+        self.get_url = get_url
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.out = out
+
+    def download(self, trackid, progress=None):
+        """Download a track, from where a previous attempt stopped. Returns
+        its size once it is in the store. A download that ends before the
+        length the server announced raises IOError, what was received is
+        kept for the next attempt"""
+        offset = self.store.part_size(trackid)
+        f = open(self.store.part_path(trackid), 'ab')
+        u = stream.RangeStream(lambda refused=None: self.get_url(trackid, refused))
+        try:
+            if offset:
+                log.debug('Resuming %s at %d bytes' % (trackid, offset))
+            while True:
+                data = u.read(offset, READ_CHUNK)
+                if not data:
+                    break
+                f.write(data)
+                offset += len(data)
+                if progress is not None:
+                    progress.add(len(data))
+                self.limiter.consume(len(data))
+        finally:
+            u.close()
+            f.close()
+        if u.length is not None and offset < u.length:
+            # The connection was closed early, without an error
+            raise IOError('%s: download stopped at %d of %d bytes' % (trackid, offset, u.length))
+        return self.store.commit(trackid)
+
+    def run(self, tracks, prepare=None):
+        """Download tracks, a list of (trackid, expected size), skipping the
+        ones already stored. prepare(trackid) is called for each of them
+        first, eg. to get what their tags need. Returns a dict trackid ->
+        size of the tracks stored, failed ones are left out"""
+        sizes = {}
+        todo = []
+        remaining = 0 # Bytes left to download, as far as expected sizes go
+        for trackid, expected in tracks:
+            size = self.store.size(trackid)
+            if size is not None:
+                sizes[trackid] = size
+            else:
+                todo.append(trackid)
+                remaining += max(expected - self.store.part_size(trackid), 0)
+        if prepare is not None:
+            # Stored tracks may have been downloaded by an older run
+            for trackid in sizes:
+                prepare(trackid)
+        log.info('%d tracks stored already, %d to download' % (len(sizes), len(todo)))
+        if not todo:
+            return sizes
+        progress = Progress(len(todo), remaining, self.out)
+
+        def fetch(trackid):
+            if prepare is not None:
+                prepare(trackid)
+            return self.download(trackid, progress)
+
+        def done(count, total):
+            # Called once per track, after its last attempt
+            progress.done()
+        finished = threading.Event()
+        def show():
+            while not finished.wait(1):
+                progress.show()
+        thread = threading.Thread(target=show, name='prefetch-progress')
+        thread.daemon = True
+        thread.start()
+        try:
+            pool = workers.WorkerPool(self.concurrency, name='prefetch')
+            downloaded = pool.map(fetch, todo, progress=done)
+        finally:
+            finished.set()
+            thread.join()
+        sizes.update(downloaded)
+        progress.failed = len(todo) - len(downloaded)
+        progress.show(final=True)
+        return sizes
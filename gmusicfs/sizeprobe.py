@@ -0,0 +1,107 @@
+# Background size probing for --truefilesize.
+#
+# The exact size of a track is only known from a HEAD request on its
+# stream URL, itself resolved with an API call, and the size of a cover
+# from downloading it. Instead of one round trip after the other inside
+# readdir and getattr, the sizes a directory needs are requested at once
+# and probed by a bounded set of background threads. Sizes are estimated
+# until they arrive. A failed probe is not tried again for a while, or
+# every getattr of the path would send the request again.
+
+import time
+import Queue
+import threading
+import logging
+
+log = logging.getLogger('gmusicfs')
+
+# Seconds before a failed probe may be submitted again
+RETRY_DELAY = 60
+
+class SizeProber(object):
+    """Runs probes in `concurrency` background threads, at most one at a
+    time per key, and none for retry_delay seconds after one failed.
+    on_idle() is called whenever all the probes are done.
+
+    >>> import time
+    >>> sizes = {}
+    >>> prober = SizeProber(concurrency=2)
+    >>> for key in 'abcb':
+    ...     prober.submit(key, lambda key=key: sizes.__setitem__(key, len(key)))
+    >>> while prober.pending:
+    ...     time.sleep(0.01)
+    >>> sorted(sizes.items()), prober.probed + prober.skipped
+    ([('a', 1), ('b', 1), ('c', 1)], 4)
+    >>> prober.submit('d', lambda: 1 / 0)
+    >>> while prober.pending:
+    ...     time.sleep(0.01)
+    >>> prober.submit('d', lambda: sizes.__setitem__('d', 1))
+    >>> prober.pending, prober.failed, 'd' in sizes
+    (0, 1, False)
+    """
+    def __init__(self, concurrency=8, on_idle=None, retry_delay=RETRY_DELAY):
+        self.concurrency = max(1, concurrency)
+        self.on_idle = on_idle
+        self.retry_delay = retry_delay
+        self.probed = 0
+        self.failed = 0
+        self.skipped = 0 # Submitted while already pending, or failed recently
+        self.__queue = Queue.Queue()
+        self.__pending = set() # Keys queued or being probed
+        self.__failed = {} # Key -> when its last probe failed
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return len(self.__pending)
+
+    def submit(self, key, probe):
+        """Run probe() in the background, unless key is pending already or
+        its last probe failed less than retry_delay seconds ago"""
+        with self.__lock:
+            if key in self.__pending:
+                self.skipped += 1
+                return
+            failed_at = self.__failed.get(key, None)
+            if failed_at is not None:
+                if time.time() - failed_at < self.retry_delay:
+                    self.skipped += 1
+                    return
+                del self.__failed[key]
+            self.__pending.add(key)
+            if len(self.__threads) < self.concurrency:
+                # Started on first use, threads do not survive daemonizing
+                thread = threading.Thread(target=self.__run,
+                                          name='size-probe-%d' % len(self.__threads))
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+        self.__queue.put((key, probe))
+
+    def __run(self):
+        while True:
+            key, probe = self.__queue.get()
+            failed = False
+            try:
+                probe()
+            except Exception, e:
+                failed = True
+                log.debug('Size probe of %r failed: %s' % (key, e))
+            with self.__lock:
+                self.__pending.discard(key)
+                if failed:
+                    self.failed += 1
+                    self.__failed[key] = time.time()
+                else:
+                    self.probed += 1
+                idle = not self.__pending
+            if idle and self.on_idle is not None:
+                try:
+                    self.on_idle()
+                except Exception:
+                    log.exception('Size probe idle callback failed')
+
+    def __repr__(self):
+        return '<SizeProber probed=%d failed=%d pending=%d>' % (
+            self.probed, self.failed, len(self.__pending))
@@ -0,0 +1,75 @@
+# On-disk snapshot of a scanned library, so that a warm mount does not
+# have to rescan Google Music before it becomes usable.
+#
+# File layout: a fixed header (magic, format version, marshal version,
+# SHA1 of the payload, payload length) followed by the zlib compressed,
+# marshalled library state. marshal is used instead of pickle because the
+# state only holds plain dicts/lists/strings and it loads several times
+# faster.
+
+import os
+import struct
+import marshal
+import zlib
+import hashlib
+import tempfile
+
+MAGIC = 'GMFSSNAP'
+# Bump whenever the layout of the state saved by MusicLibrary changes:
+VERSION = 2
+HEADER = struct.Struct('!8sHH20sQ')
+
+class SnapshotError(Exception):
+    pass
+
+def save(path, state):
+    """Atomically write the library state to path"""
+    payload = zlib.compress(marshal.dumps(state, marshal.version), 6)
+    header = HEADER.pack(MAGIC, VERSION, marshal.version,
+                         hashlib.sha1(payload).digest(), len(payload))
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname, 0700)
+    # Write to a temporary file first, so a crash never leaves a
+    # truncated snapshot behind:
+    tmpfd, tmpfile = tempfile.mkstemp(dir=dirname or '.', prefix='.snapshot-')
+    try:
+        f = os.fdopen(tmpfd, 'wb')
+        try:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpfile, path)
+    except:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+
+def load(path):
+    """Read back a library state written by save()
+
+    Raises IOError if there is no snapshot and SnapshotError if the
+    snapshot is corrupt or was written by an incompatible version"""
+    f = open(path, 'rb')
+    try:
+        header = f.read(HEADER.size)
+        payload = f.read()
+    finally:
+        f.close()
+    if len(header) != HEADER.size:
+        raise SnapshotError('Truncated snapshot header: %s' % path)
+    magic, version, marshal_version, checksum, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise SnapshotError('Not a library snapshot: %s' % path)
+    if version != VERSION or marshal_version != marshal.version:
+        raise SnapshotError('Snapshot version %d.%d is not supported: %s'
+                            % (version, marshal_version, path))
+    if len(payload) != length or hashlib.sha1(payload).digest() != checksum:
+        raise SnapshotError('Snapshot checksum mismatch: %s' % path)
+    try:
+        return marshal.loads(zlib.decompress(payload))
+    except (zlib.error, ValueError, EOFError, TypeError), e:
+        raise SnapshotError('Snapshot could not be decoded: %s (%s)' % (path, e))
@@ -0,0 +1,151 @@
+# Performance counters: call counts and latency histograms of the FUSE
+# operations and of the remote calls (API, HTTP, album art, streams), and
+# byte counters. They are served as JSON in the /.stats virtual file.
+
+import bisect
+import json
+import time
+import threading
+import contextlib
+from collections import OrderedDict
+
+# Upper bounds of the latency buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class Histogram(object):
+    """Latency distribution of one kind of call
+
+    >>> h = Histogram()
+    >>> for ms in (0.5, 3, 3, 4, 1500):
+    ...     h.add(ms / 1000.0)
+    >>> h.count, h.buckets[:4], h.percentile(50), h.percentile(99)
+    (5, [1, 0, 3, 0], 5, 2000)
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0 # Seconds
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+
+    def percentile(self, percent):
+        """Return the upper bound, in ms, of the bucket holding a percentile"""
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return int(self.max * 1000) + 1
+
+    def to_dict(self):
+        histogram = OrderedDict()
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            histogram['<=%d' % bound] = count
+        histogram['>%d' % BUCKETS_MS[-1]] = self.buckets[-1]
+        return OrderedDict([
+            ('count', self.count),
+            ('errors', self.errors),
+            ('total_ms', round(self.total * 1000, 3)),
+            ('mean_ms', round(self.total * 1000 / self.count, 3) if self.count else 0),
+            ('max_ms', round(self.max * 1000, 3)),
+            ('p50_ms', self.percentile(50)),
+            ('p90_ms', self.percentile(90)),
+            ('p99_ms', self.percentile(99)),
+            ('histogram_ms', histogram)])
+
+class Stats(object):
+    """Timings and counters by name, eg. 'fuse.read' or 'stream.bytes'"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start counting from zero"""
+        with self.__lock:
+            self.__timings = {} # name -> Histogram()
+            self.__counters = {} # name -> int
+            self.__since = time.time()
+
+    def record(self, name, seconds, error=False):
+        with self.__lock:
+            histogram = self.__timings.get(name, None)
+            if histogram is None:
+                histogram = self.__timings[name] = Histogram()
+            histogram.add(seconds, error)
+
+    def count(self, name, n=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Record the time spent in a with block, as an error if it raises"""
+        start = time.time()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.record(name, time.time() - start, error)
+
+    def snapshot(self, reset=False, **sections):
+        """Return the timings and counters, plus extra sections, as a dict
+        ready for JSON. With reset, counting starts over atomically"""
+        now = time.time()
+        with self.__lock:
+            timings = sorted((name, h.to_dict()) for name, h in self.__timings.items())
+            counters = sorted(self.__counters.items())
+            since = self.__since
+            if reset:
+                self.__timings = {}
+                self.__counters = {}
+                self.__since = now
+        result = OrderedDict([
+            ('uptime', round(now - self.started, 3)),
+            ('interval', round(now - since, 3)), # Seconds since the last reset
+            ('timings', OrderedDict(timings)),
+            ('counters', OrderedDict(counters))])
+        for name in sorted(sections):
+            result[name] = sections[name]
+        return result
+
+    def render(self, reset=False, **sections):
+        """Return the snapshot as JSON text"""
+        return json.dumps(self.snapshot(reset, **sections), indent=2) + '\n'
+
+class TimedCalls(object):
+    """Proxy recording every method call of an object as '<prefix><method>'
+
+    >>> s = Stats()
+    >>> api = TimedCalls({'a': 1}, 'api.', s)
+    >>> api.get('a'), api.keys()
+    (1, ['a'])
+    >>> s.snapshot()['timings'].keys()
+    ['api.get', 'api.keys']
+    """
+    def __init__(self, target, prefix, stats=None):
+        self.__target = target
+        self.__prefix = prefix
+        self.__stats = stats or shared
+
+    def __getattr__(self, name):
+        value = getattr(self.__target, name)
+        if not callable(value):
+            return value
+        def call(*args, **kwargs):
+            with self.__stats.timed(self.__prefix + name):
+                return value(*args, **kwargs)
+        return call
+
+# Used by every part of gmusicfs
+shared = Stats()
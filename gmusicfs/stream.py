@@ -0,0 +1,381 @@
+# Random access to a remote audio stream.
+#
+# Sequential reads are served from a single open HTTP response; when the
+# reader jumps (player seek, a tool reading the end of the file) the
+# connection is replaced by a new one using a Range request.
+
+import urllib2
+import threading
+import logging
+
+import fifo
+import stats
+import transport
+import streamengine
+
+log = logging.getLogger('gmusicfs')
+
+# Forward jumps up to this many bytes are cheaper to read through than
+# to open a new connection for:
+SKIP_LIMIT = 128 * 1024
+READ_CHUNK = 64 * 1024
+
+def stream_length(offset, code, headers):
+    """Return the length of a whole stream from the headers of a response
+    to a request at offset, None if they do not tell
+
+    >>> import mimetools, StringIO
+    >>> def h(text): return mimetools.Message(StringIO.StringIO(text))
+    >>> stream_length(0, 200, h('Content-Length: 1000\\n'))
+    1000
+    >>> stream_length(400, 206, h('Content-Range: bytes 400-999/1000\\nContent-Length: 600\\n'))
+    1000
+    >>> stream_length(1000, 416, h('Content-Range: bytes */1000\\n'))
+    1000
+    >>> stream_length(0, 200, h('Transfer-Encoding: chunked\\n')) is None
+    True
+    """
+    content_range = headers.getheader('Content-Range')
+    if content_range is not None:
+        total = content_range.rpartition('/')[2].strip()
+        return int(total) if total.isdigit() else None
+    content_length = headers.getheader('Content-Length')
+    if code != 206 and content_length is not None and content_length.strip().isdigit():
+        # The whole stream, the Range header was ignored or not sent
+        return int(content_length)
+    return None
+
+class RangeStream(object):
+    """Random access reader for a stream URL.
+
+    get_url(refused=None) is called to resolve the URL when the first
+    connection is made, and again with the refused URL when a reconnection
+    is refused (stream URLs expire)."""
+
+    def __init__(self, get_url, url=None, http=None):
+        self.get_url = get_url
+        self.url = url
+        self.http = http or transport.shared
+        self.position = 0 # Offset of the next byte of the open response
+        self.length = None # Length of the whole stream, once a response told
+        self.bytes_read = 0
+        self.requests = 0
+        self.__response = None
+
+    def __connect(self, offset):
+        """Open a response starting at offset"""
+        self.close()
+        if self.url is None:
+            self.url = self.get_url()
+        try:
+            response = self.__open(offset)
+        except urllib2.HTTPError, e:
+            if e.code == 416:
+                # Nothing at offset: the stream is shorter than the size it
+                # was estimated at (see --truefilesize)
+                self.position = offset
+                self.length = stream_length(offset, e.code, e.info()) or self.length
+                return
+            if e.code not in (401, 403, 404, 410):
+                raise
+            # The signed URL expired, get a new one
+            log.debug('Stream URL refused (%d), resolving it again' % e.code)
+            self.url = self.get_url(refused=self.url)
+            response = self.__open(offset)
+        self.__response = response
+        self.length = stream_length(offset, response.getcode(), response.info()) or self.length
+        self.position = 0
+        if offset == 0 or response.getcode() == 206:
+            self.position = offset
+        else:
+            # The server ignored the Range header
+            self.__skip(offset)
+
+    def __open(self, offset):
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+        self.requests += 1
+        with stats.shared.timed('stream.connect'):
+            return self.http.get(self.url, headers)
+
+    def __skip(self, offset):
+        """Read and discard data up to offset on the open response"""
+        while self.position < offset:
+            data = self.__response.read(min(READ_CHUNK, offset - self.position))
+            if not data:
+                break
+            self.position += len(data)
+
+    def read(self, offset, size):
+        """Return up to size bytes at offset, fewer only at the end of the stream"""
+        if self.__response is None or offset < self.position \
+                or offset - self.position > SKIP_LIMIT:
+            self.__connect(offset)
+            if self.__response is None:
+                return ''
+        elif offset > self.position:
+            self.__skip(offset)
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            data = self.__response.read(remaining)
+            if not data:
+                break
+            chunks.append(data)
+            remaining -= len(data)
+        data = ''.join(chunks)
+        self.position += len(data)
+        self.bytes_read += len(data)
+        stats.shared.count('stream.bytes', len(data))
+        return data
+
+    def open(self, offset):
+        """Open a response at offset, to be read with read_available()"""
+        self.__connect(offset)
+
+    def fileno(self):
+        """The socket of the open response, or None at the end of the stream"""
+        if self.__response is None:
+            return None
+        return self.__response.fileno()
+
+    def pending(self):
+        return self.__response.pending() if self.__response is not None else 0
+
+    def pollable(self):
+        """Tell whether the open response can be read with read_available()"""
+        return self.__response is not None and self.__response.pollable()
+
+    def read_available(self, size):
+        """Return up to size bytes that arrived on the open response, without
+        waiting (see transport.Response.read_available), '' at the end"""
+        if self.__response is None:
+            return ''
+        data = self.__response.read_available(size)
+        self.position += len(data)
+        self.bytes_read += len(data)
+        stats.shared.count('stream.bytes', len(data))
+        return data
+
+    def close(self):
+        if self.__response is not None:
+            self.__response.close()
+            self.__response = None
+
+class ReadAheadStats(object):
+    """Read-ahead counters shared by all the open files"""
+
+    def __init__(self):
+        self.hits = 0 # Reads served entirely from data already buffered
+        self.misses = 0 # Reads that had to wait for the network
+        self.restarts = 0 # Read-ahead restarted because the reader jumped
+        self.bytes = 0
+        self.__lock = threading.Lock()
+
+    def count(self, hit=False, miss=False, restart=False, nbytes=0):
+        with self.__lock:
+            self.hits += hit
+            self.misses += miss
+            self.restarts += restart
+            self.bytes += nbytes
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        return '<ReadAheadStats hits=%d misses=%d (%.1f%% hit) restarts=%d bytes=%d>' % (
+            self.hits, self.misses, 100.0 * self.hits / total if total else 0,
+            self.restarts, self.bytes)
+
+class _ReadAheadRun(object):
+    """One response streamed into one buffer from a given offset, pumped
+    by the I/O thread of the engine (see streamengine.StreamEngine)"""
+
+    def __init__(self, stream, start, high_water, low_water):
+        self.stream = stream
+        self.start = start
+        self.high_water = high_water
+        self.low_water = low_water
+        # Pumping stops at high_water, the buffer only has to hold the
+        # chunk that crossed it, so writing to it never blocks. Its memory
+        # grows with what is buffered, a run stopped early costs little
+        self.buffer = fifo.Buffer(high_water + READ_CHUNK)
+        self.produced = 0
+        self.consumed = 0
+        self.paused = False
+        self.error = None
+        self.__lock = threading.Lock()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def pending(self):
+        return self.stream.pending()
+
+    def wants_data(self):
+        return not self.paused
+
+    def available(self):
+        with self.__lock:
+            return self.produced - self.consumed
+
+    def pump(self):
+        data = self.stream.read_available(READ_CHUNK)
+        if not data:
+            return False
+        try:
+            self.buffer.write(data)
+        except fifo.BufferClosed:
+            # The reader went away
+            return False
+        with self.__lock:
+            self.produced += len(data)
+            if self.produced - self.consumed >= self.high_water:
+                self.paused = True
+        return True
+
+    def want(self, nbytes):
+        """Tell that the reader waits for nbytes (at most high_water). Returns
+        True when pumping should resume for that, the engine has to be woken
+        up then"""
+        with self.__lock:
+            if self.paused and self.produced - self.consumed < nbytes:
+                self.paused = False
+                return True
+        return False
+
+    def consume(self, nbytes):
+        """Account for bytes read from the buffer. Returns True when pumping
+        should resume, the engine has to be woken up then"""
+        with self.__lock:
+            self.consumed += nbytes
+            if self.paused and self.produced - self.consumed <= self.low_water:
+                self.paused = False
+                return True
+        return False
+
+    def fail(self, error):
+        log.warning('Read-ahead failed: %s' % error)
+        self.error = error
+
+    def close(self):
+        self.buffer.close()
+        self.stream.close()
+
+class ReadAhead(object):
+    """Random access reader that streams ahead of the reader.
+
+    The engine copies the stream into a fifo.Buffer until high_water
+    bytes are buffered, and resumes once the reader drained it below
+    low_water. Sequential reads are served from the buffer; a read at any
+    other offset restarts streaming there (with a Range request, see
+    RangeStream). A response without a Content-Length cannot be read
+    without blocking: it is read by the reader instead, like RangeStream
+    does, without streaming ahead."""
+
+    def __init__(self, get_url, high_water=2 * 1024**2, low_water=512 * 1024,
+                 stats=None, engine=None):
+        self.get_url = get_url
+        self.high_water = high_water
+        self.low_water = min(low_water, high_water)
+        self.stats = stats or ReadAheadStats()
+        self.engine = engine or streamengine.shared
+        self.url = None
+        self.__run = None
+        self.__direct = None # The RangeStream the reader reads itself, if any
+
+    def __start(self, offset):
+        """Open a run streaming from offset, None when the response has to
+        be read by the reader (see __direct)"""
+        self.__stop()
+        stream = RangeStream(self.__refresh_url, self.url)
+        run = self.__run = _ReadAheadRun(stream, offset, self.high_water, self.low_water)
+        try:
+            # Blocking, so not in the I/O thread
+            stream.open(offset)
+        except Exception, e:
+            run.fail(e)
+            run.close()
+            return run
+        if stream.fileno() is None:
+            # Nothing left at offset
+            run.close()
+        elif not stream.pollable():
+            # Keeping the I/O thread of the engine out of httplib's blocking
+            # reads, a stalled response would stall every open file
+            log.debug('No Content-Length for %s, not streaming ahead' % self.url)
+            self.__run = None
+            self.__direct = stream
+            return None
+        else:
+            self.engine.add(run)
+        return run
+
+    def __refresh_url(self, refused=None):
+        # Only called when there is no URL yet or it was refused
+        self.url = self.get_url(refused=refused)
+        return self.url
+
+    def __stop(self):
+        run = self.__run
+        if run is not None:
+            # A reader restarting elsewhere is not waiting on this buffer,
+            # the engine closes the rest
+            run.buffer.close()
+            self.engine.remove(run)
+            self.__run = None
+
+    def read(self, offset, size):
+        """Return up to size bytes at offset, fewer only at the end of the stream"""
+        if self.__direct is not None:
+            self.stats.count(miss=True)
+            return self.__read_direct(offset, size)
+        run = self.__run
+        if run is None or run.error is not None or offset != run.start + run.consumed:
+            self.stats.count(miss=True, restart=run is not None)
+            if run is None and self.url is None:
+                # First read: resolve the URL here, so errors reach the reader
+                self.url = self.get_url()
+            run = self.__start(offset)
+            if run is None:
+                return self.__read_direct(offset, size)
+        else:
+            available = run.available()
+            self.stats.count(hit=available >= size, miss=available < size)
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            # Never more than the buffer holds once pumping pauses
+            wanted = min(remaining, self.high_water)
+            if run.want(wanted):
+                self.engine.wake()
+            data = run.buffer.read(wanted)
+            if run.consume(len(data)):
+                self.engine.wake()
+            chunks.append(data)
+            remaining -= len(data)
+            if len(data) < wanted:
+                break
+        data = ''.join(chunks)
+        if len(data) < size and run.error is not None:
+            raise run.error
+        self.stats.count(nbytes=len(data))
+        return data
+
+    def __read_direct(self, offset, size):
+        data = self.__direct.read(offset, size)
+        self.stats.count(nbytes=len(data))
+        return data
+
+    @property
+    def length(self):
+        """Length of the whole stream, once a response told it, or None"""
+        if self.__direct is not None:
+            return self.__direct.length
+        run = self.__run
+        return run.stream.length if run is not None else None
+
+    def close(self):
+        self.__stop()
+        if self.__direct is not None:
+            self.__direct.close()
+            self.__direct = None
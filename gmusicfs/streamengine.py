@@ -0,0 +1,162 @@
+# Streaming engine shared by all the open files.
+#
+# Read-ahead used to take a producer thread per open file, blocked in a
+# socket read most of the time. Instead, one I/O thread waits on the
+# connections of all the streams at once with poll() and moves whatever
+# arrived into their buffers: open files cost no thread of their own, and
+# streaming goes on between reads, whichever FUSE thread serves them.
+# Opening a connection blocks, so the reading thread does it (it waits
+# for the first bytes anyway) and hands it over to the engine.
+
+import os
+import errno
+import fcntl
+import select
+import socket
+import threading
+import time
+import logging
+
+log = logging.getLogger('gmusicfs')
+
+# How often, in seconds, the I/O thread checks for stalled connections
+POLL_INTERVAL = 1
+
+class StreamEngine(object):
+    """Runs channels in one I/O thread. A channel has:
+
+    fileno()     the socket to wait on, None once there is nothing left
+    pending()    bytes that can be read without waiting on the socket
+    wants_data() False while it has no room for more
+    pump()       reads what arrived, returns False at the end
+    fail(error)  called when pump() raised or nothing arrived for `timeout`
+    close()      called from the I/O thread once the channel is removed
+
+    Only the I/O thread calls pump() and close(), so a channel is never
+    read and closed at the same time."""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.pumped = 0 # Calls to pump()
+        self.__channels = {} # channel -> time data last arrived
+        self.__removed = [] # Channels for the I/O thread to close
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__wakeup = None # (read fd, write fd) of a pipe
+
+    def __len__(self):
+        return len(self.__channels)
+
+    def add(self, channel):
+        """Start pumping a channel"""
+        with self.__lock:
+            self.__channels[channel] = time.time()
+            if self.__thread is None:
+                # Started on first use, threads do not survive daemonizing
+                self.__wakeup = os.pipe()
+                for fd in self.__wakeup:
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                self.__thread = threading.Thread(target=self.__run, name='stream-engine')
+                self.__thread.daemon = True
+                self.__thread.start()
+        self.wake()
+
+    def remove(self, channel):
+        """Stop pumping a channel, the I/O thread closes it"""
+        with self.__lock:
+            if self.__channels.pop(channel, None) is None:
+                return
+            self.__removed.append(channel)
+        self.wake()
+
+    def wake(self):
+        """Have the I/O thread look at the channels again, eg. when one
+        wants data again"""
+        if self.__wakeup is None:
+            return
+        try:
+            os.write(self.__wakeup[1], 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            # The pipe is full, the I/O thread is woken up already
+
+    def __close(self, channel):
+        try:
+            channel.close()
+        except Exception:
+            log.exception('Closing stream %r failed' % channel)
+
+    def __pump(self, channel):
+        try:
+            alive = channel.pump()
+        except Exception, e:
+            channel.fail(e)
+            alive = False
+        self.pumped += 1
+        with self.__lock:
+            if alive:
+                if channel in self.__channels:
+                    self.__channels[channel] = time.time()
+                return
+            if self.__channels.pop(channel, None) is None:
+                # Removed meanwhile, closed already or about to be
+                return
+        self.__close(channel)
+
+    def __run(self):
+        wakeup_fd = self.__wakeup[0]
+        while True:
+            with self.__lock:
+                removed, self.__removed = self.__removed, []
+                channels = self.__channels.items()
+            for channel in removed:
+                self.__close(channel)
+
+            now = time.time()
+            ready = []
+            waiting = {} # fd -> channel
+            for channel, last_data in channels:
+                if not channel.wants_data():
+                    # The reader is behind, not the network: the stall
+                    # timeout starts over once it wants data again
+                    with self.__lock:
+                        if channel in self.__channels:
+                            self.__channels[channel] = now
+                    continue
+                fd = channel.fileno()
+                if fd is None or channel.pending():
+                    ready.append(channel)
+                elif now - last_data > self.timeout:
+                    channel.fail(socket.timeout('No data for %ds' % self.timeout))
+                    self.remove(channel)
+                else:
+                    waiting[fd] = channel
+
+            poller = select.poll()
+            poller.register(wakeup_fd, select.POLLIN)
+            for fd in waiting:
+                poller.register(fd, select.POLLIN)
+            try:
+                events = poller.poll(0 if ready else POLL_INTERVAL * 1000)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                if fd == wakeup_fd:
+                    try:
+                        while os.read(wakeup_fd, 4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    ready.append(waiting[fd])
+            for channel in ready:
+                self.__pump(channel)
+
+    def __repr__(self):
+        return '<StreamEngine streams=%d pumped=%d>' % (len(self.__channels), self.pumped)
+
+# Used by every part of gmusicfs, see main() for its settings
+shared = StreamEngine()
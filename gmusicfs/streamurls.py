@@ -0,0 +1,133 @@
+# Cache of signed stream URLs by track ID.
+#
+# Google Music stream URLs are signed and only valid for a while, the
+# expiry time is part of the URL (the `expire` query parameter, in seconds
+# since the epoch). Resolving one is a blocking API call, so URLs are kept
+# until shortly before they expire, refreshed in the background when they
+# get close to it, and resolved ahead of time for the tracks of a directory
+# being browsed.
+
+import time
+import threading
+import urlparse
+import logging
+
+import workers
+
+log = logging.getLogger('gmusicfs')
+
+# URLs without an expiry are assumed to be valid this long, in seconds
+DEFAULT_TTL = 60
+
+def url_expiry(url, default=None):
+    """Return the expiry time embedded in a signed URL, or default
+
+    >>> url_expiry('http://host/videoplayback?id=1&expire=1400000000&sig=x')
+    1400000000
+    >>> url_expiry('http://host/file.mp3', 42)
+    42
+    """
+    query = urlparse.parse_qs(urlparse.urlparse(url).query)
+    try:
+        return int(query['expire'][0])
+    except (KeyError, IndexError, ValueError):
+        return default
+
+class StreamURLCache(object):
+    """Stream URLs by track ID, resolved with resolve(trackid).
+
+    get() returns a cached URL as long as it stays valid for more than
+    `margin` seconds. Within `refresh_margin` seconds of its expiry the
+    cached URL is still returned, and a new one is resolved in the
+    background for the next caller."""
+
+    def __init__(self, resolve, margin=10, refresh_margin=30, concurrency=4):
+        self.resolve = resolve
+        self.margin = margin
+        self.refresh_margin = max(refresh_margin, margin)
+        self.concurrency = concurrency
+        self.hits = 0
+        self.misses = 0
+        self.__urls = {} # 'trackId' -> (url, expiry time)
+        self.__pending = {} # 'trackId' -> threading.Event() set once resolved
+        self.__lock = threading.Lock()
+
+    def __resolve(self, trackid):
+        """Resolve a URL, only once at a time per track"""
+        with self.__lock:
+            pending = self.__pending.get(trackid, None)
+            if pending is None:
+                pending = self.__pending[trackid] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Another thread is resolving it, use its result
+            pending.wait()
+            with self.__lock:
+                entry = self.__urls.get(trackid, None)
+            if entry is not None:
+                return entry[0]
+            return self.__resolve(trackid)
+        try:
+            url = self.resolve(trackid)
+            expiry = url_expiry(url, int(time.time()) + DEFAULT_TTL)
+            with self.__lock:
+                self.__urls[trackid] = (url, expiry)
+            return url
+        finally:
+            with self.__lock:
+                del self.__pending[trackid]
+            pending.set()
+
+    def get(self, trackid, refused=None):
+        """Return a stream URL for a track.
+
+        refused is a URL the server did not accept any more, it is never
+        returned again"""
+        now = time.time()
+        with self.__lock:
+            entry = self.__urls.get(trackid, None)
+            if entry is not None and (entry[0] == refused or entry[1] - now <= self.margin):
+                del self.__urls[trackid]
+                entry = None
+            refresh = entry is not None and entry[1] - now <= self.refresh_margin \
+                and trackid not in self.__pending
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is None:
+            return self.__resolve(trackid)
+        if refresh:
+            self.__in_background(self.__resolve, [trackid])
+        return entry[0]
+
+    def __in_background(self, func, trackids):
+        def run():
+            try:
+                workers.WorkerPool(self.concurrency, name='stream-url').map(func, trackids, retries=0)
+            except Exception:
+                log.exception('Stream URL prefetch failed')
+        thread = threading.Thread(target=run, name='stream-url')
+        thread.daemon = True
+        thread.start()
+
+    def prefetch(self, trackids):
+        """Resolve, in the background, the URLs of tracks that are not cached"""
+        now = time.time()
+        with self.__lock:
+            missing = [tid for tid in trackids if tid not in self.__pending and
+                       (tid not in self.__urls or
+                        self.__urls[tid][1] - now <= self.refresh_margin)]
+            # Forget the URLs that expired, they would only pile up
+            for tid, (url, expiry) in self.__urls.items():
+                if expiry <= now:
+                    del self.__urls[tid]
+        if missing:
+            log.debug('Prefetching %d stream URLs' % len(missing))
+            self.__in_background(self.__resolve, missing)
+
+    def __repr__(self):
+        return '<StreamURLCache urls=%d hits=%d misses=%d>' % (
+            len(self.__urls), self.hits, self.misses)
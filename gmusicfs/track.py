@@ -0,0 +1,164 @@
+# Compact representation of a track.
+#
+# The API returns every track as a dict of a few dozen keys, most of them
+# never used here, with numbers as strings. A Track keeps only the fields
+# gmusicfs uses, in __slots__: numbers are ints, IDs are byte strings and
+# the names shared by many tracks (artists, albums, genres) are stored
+# once. It keeps the dict interface the rest of the code is written
+# against: track['title'], track.get('year'), 'tagSize' in track...
+
+from stat import S_IFREG
+
+# Fields stored as ints, the API gives most of them as strings
+INT_FIELDS = frozenset(('trackNumber', 'discNumber', 'year', 'estimatedSize',
+                        'bytes', 'tagSize', 'creationTimestamp',
+                        'recentTimestamp', 'lastModifiedTimestamp'))
+# Fields holding identifiers, ASCII in practice
+ID_FIELDS = frozenset(('id', 'albumId'))
+# Fields shared by many tracks, every distinct value is kept once
+SHARED_FIELDS = frozenset(('album', 'albumArtist', 'albumKey', 'genre', 'albumArtUrl'))
+
+# Distinct shared strings. intern() only takes byte strings and names are
+# unicode, so this is a plain table; it only grows with the number of
+# distinct names in the library
+_strings = {}
+
+def shared_string(value):
+    """Return the one copy of a string kept for every track using it"""
+    return _strings.setdefault(value, value)
+
+def compact_id(value):
+    """Return an identifier as a byte string when it is ASCII. A byte
+    string takes a quarter of the memory of the unicode one, and they
+    compare and hash the same, so dict lookups work with either
+
+    >>> compact_id(u'Tabc'), compact_id(u'T\\xe9'), compact_id('Tabc')
+    ('Tabc', u'T\\xe9', 'Tabc')
+    """
+    # Not str(value): with the default encoding set to UTF-8 (see gmusicfs),
+    # it turns non-ASCII ids into UTF-8 bytes, which hash differently
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    return value
+
+class Track(object):
+    """
+    >>> t = Track.from_dict({'id': u'T1', 'title': u'Song', 'artist': [u'A', u'B'],
+    ...                      'year': '1999', 'unused': 42,
+    ...                      'albumArtRef': [{'url': 'http://art'}]})
+    >>> t['id'], t['year'], t['artist'], t['albumArtUrl']
+    ('T1', 1999, (u'A', u'B'), 'http://art')
+    >>> 'tagSize' in t, t.get('tagSize'), 'unused' in t
+    (False, None, False)
+    >>> t['tagSize'] = '1234'
+    >>> t['tagSize']
+    1234
+    >>> c = t.copy()
+    >>> del c['tagSize']
+    >>> 'tagSize' in c, t['tagSize'], c['artist'] is t['artist']
+    (False, 1234, True)
+    >>> Track.from_state(t.get_state()).get_state() == t.get_state()
+    True
+    >>> t['creationTimestamp'] = '1500000000000000'
+    >>> st = t.to_stat()
+    >>> st['st_size'], st['st_mtime'], st['st_atime']
+    (1234, 1500000000, 0)
+    """
+    __slots__ = ('id', 'title', 'artist', 'albumArtist', 'album', 'albumId',
+                 'albumKey', 'albumArtUrl', 'trackNumber', 'discNumber', 'year',
+                 'genre', 'estimatedSize', 'bytes', 'tagSize', 'creationTimestamp',
+                 'recentTimestamp', 'lastModifiedTimestamp')
+
+    FIELDS = frozenset(__slots__)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a Track from a track dict of the API, unused keys are dropped"""
+        track = cls()
+        for key, value in data.iteritems():
+            if key in cls.FIELDS:
+                track[key] = value
+        try:
+            track['albumArtUrl'] = data['albumArtRef'][0]['url']
+        except (KeyError, IndexError, TypeError):
+            pass
+        return track
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a Track from get_state()"""
+        track = cls()
+        for key, value in zip(cls.__slots__, state):
+            if value is not None:
+                track[key] = value
+        return track
+
+    def copy(self):
+        """Return a copy of the track, the values are shared"""
+        track = Track()
+        for key in self.keys():
+            setattr(track, key, getattr(self, key))
+        return track
+
+    def to_stat(self):
+        """Return the stat of the track file, its tagSize must be known
+        (see Album.calc_size)"""
+        st = {'st_mode': S_IFREG | 0444,
+              'st_size': self.tagSize,
+              'st_nlink': 1,
+              'st_ctime': 0, 'st_mtime': 0, 'st_atime': 0}
+        if 'creationTimestamp' in self:
+            st['st_ctime'] = st['st_mtime'] = self.creationTimestamp / 1000000
+        if 'recentTimestamp' in self:
+            st['st_atime'] = self.recentTimestamp / 1000000
+        return st
+
+    def get_state(self):
+        """Return the track as plain data for the library snapshot"""
+        return tuple(getattr(self, key, None) for key in self.__slots__)
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        if key in INT_FIELDS:
+            value = int(value)
+        elif key in ID_FIELDS:
+            value = compact_id(value)
+        elif key in SHARED_FIELDS:
+            value = shared_string(value)
+        elif key == 'artist':
+            value = tuple(shared_string(artist) for artist in value)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and hasattr(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def __repr__(self):
+        return '<Track %s>' % ', '.join('%s=%r' % (key, self[key]) for key in self.keys())
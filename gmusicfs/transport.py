@@ -0,0 +1,219 @@
+# Shared HTTP client with keep-alive connection pools.
+#
+# urllib2.urlopen opens a new connection (DNS, TCP, TLS handshake) for every
+# request. Streams, HEAD requests and album art downloads all go through
+# the Transport here instead, which keeps idle connections per host and
+# reuses them for the next request to that host.
+
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+import logging
+
+import stats
+
+log = logging.getLogger('gmusicfs')
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+class Response(object):
+    """A response, with the part of the urllib2 response interface we use.
+
+    Its connection goes back to the pool once the body was read to the
+    end and the response closed; closing it earlier drops the connection."""
+
+    def __init__(self, transport, key, connection, response, url):
+        self.transport = transport
+        self.url = url
+        self.code = response.status
+        self.headers = response.msg
+        self.__key = key
+        self.__connection = connection
+        self.__response = response
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=None):
+        if self.__response is None:
+            return ''
+        if size is None:
+            return self.__response.read()
+        return self.__response.read(size)
+
+    def fileno(self):
+        """The socket of the response, to wait for it with poll(), or None
+        once the response is closed"""
+        sock = self.__socket()
+        return sock.fileno() if sock is not None else None
+
+    def __socket(self):
+        # Responses are not buffered (see httplib.HTTPResponse), the body
+        # can be read from the socket directly
+        response = self.__response
+        if response is None or response.fp is None:
+            return None
+        return response.fp._sock
+
+    def pending(self):
+        """Return how many bytes of the body were received but are held by
+        the TLS layer, where poll() does not see them"""
+        sock = self.__socket()
+        if sock is None or not hasattr(sock, 'pending'):
+            return 0
+        return sock.pending()
+
+    def pollable(self):
+        """Tell whether the body can be read with read_available(). It takes
+        a Content-Length: httplib would block in the middle of a chunk, or
+        of a body that ends with the connection"""
+        response = self.__response
+        return response is not None and not response.chunked and response.length is not None
+
+    def read_available(self, size):
+        """Return up to size bytes of the body that arrived already, without
+        waiting for more, or '' at the end of the body. Only call it on a
+        pollable() response, once poll() reported the socket readable or
+        pending() is not 0"""
+        response = self.__response
+        sock = self.__socket()
+        if sock is None:
+            return ''
+        data = sock.recv(min(size, response.length))
+        response.length -= len(data)
+        if not data or not response.length:
+            # Like httplib, a body shorter than announced simply ends early
+            response.close()
+        return data
+
+    def close(self):
+        if self.__response is None:
+            return
+        response, self.__response = self.__response, None
+        reusable = response.isclosed() and not response.will_close
+        response.close()
+        if reusable:
+            self.transport._release(self.__key, self.__connection)
+        else:
+            self.__connection.close()
+
+class Transport(object):
+    """HTTP(S) client keeping up to max_idle idle connections per host"""
+
+    def __init__(self, timeout=30, max_idle=4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.requests = 0
+        self.connections = 0 # New connections opened
+        self.reused = 0 # Requests sent on a kept-alive connection
+        self.__idle = {} # (scheme, host, port) -> [connection, ...]
+        self.__lock = threading.Lock()
+
+    def __acquire(self, key):
+        """Return (connection, reused) for a host"""
+        with self.__lock:
+            idle = self.__idle.get(key, None)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.connections += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def __send(self, method, url, headers):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL: %s' % url)
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            connection, reused = self.__acquire(key)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused:
+                    # The server closed the kept-alive connection meanwhile
+                    log.debug('Retrying %s %s on a new connection: %s' % (method, url, e))
+                    continue
+                raise urllib2.URLError(e)
+            return Response(self, key, connection, response, url)
+
+    def request(self, method, url, headers=None):
+        """Send a request, following redirects. Returns a Response, raises
+        urllib2.HTTPError for error statuses and URLError when the server
+        cannot be reached"""
+        headers = dict(headers or {})
+        for redirect in range(MAX_REDIRECTS + 1):
+            with self.__lock:
+                self.requests += 1
+            with stats.shared.timed('http.' + method.lower()):
+                response = self.__send(method, url, headers)
+            if response.code in REDIRECT_CODES and response.headers.get('location'):
+                location = urlparse.urljoin(url, response.headers['location'])
+                response.read()
+                response.close()
+                url = location
+                continue
+            if response.code >= 400:
+                response.close()
+                raise urllib2.HTTPError(url, response.code, 'HTTP error %d' % response.code,
+                                        response.headers, None)
+            return response
+        raise urllib2.URLError('Too many redirects: %s' % url)
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers)
+
+    def get_data(self, url):
+        """Return the whole body at url"""
+        response = self.get(url)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def get_size(self, url):
+        """Return the Content-Length of url, with a HEAD request"""
+        response = self.request('HEAD', url)
+        try:
+            response.read()
+            return int(response.headers['content-length'])
+        finally:
+            response.close()
+
+    def close(self):
+        """Close all the idle connections"""
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def __repr__(self):
+        return '<Transport requests=%d connections=%d reused=%d>' % (
+            self.requests, self.connections, self.reused)
+
+# Used by every part of gmusicfs, see main() for its settings
+shared = Transport()
@@ -0,0 +1,123 @@
+# Next-track warmup.
+#
+# Players go through an album or a playlist in order, so when a track is
+# opened the next ones are prepared in the background: stream URL
+# resolved, tags rendered and the first few hundred KB downloaded. The
+# downloaded heads are kept in memory, within a budget, until the tracks
+# are opened.
+
+import Queue
+import threading
+import logging
+
+import lru
+
+log = logging.getLogger('gmusicfs')
+
+class Warmer(object):
+    """Runs warmup jobs in one background thread and keeps their results.
+
+    A job is called with the number of bytes wanted and returns the head
+    of the track, or None if there is nothing to keep (eg. it is already
+    on disk)."""
+
+    def __init__(self, head_size=256 * 1024, budget=8 * 1024**2):
+        self.head_size = head_size
+        self.warmed = 0 # Heads downloaded
+        self.hits = 0 # Opened tracks whose head was warm
+        self.misses = 0
+        self.__heads = lru.LRUCache(budget, sizeof=lambda head: len(head[0]))
+        self.__queue = Queue.Queue()
+        self.__queued = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def warm(self, trackid, job):
+        """Schedule a job for a track, unless it is warm or scheduled already"""
+        with self.__lock:
+            if trackid in self.__queued or trackid in self.__heads:
+                return
+            self.__queued.add(trackid)
+            if self.__thread is None:
+                # Started on first use, threads do not survive daemonizing
+                self.__thread = threading.Thread(target=self.__run, name='warmup')
+                self.__thread.daemon = True
+                self.__thread.start()
+        self.__queue.put((trackid, job))
+
+    def __run(self):
+        while True:
+            trackid, job = self.__queue.get()
+            try:
+                head = job(self.head_size)
+                if head is not None:
+                    # A short head is the whole track
+                    self.__heads.put(trackid, (head, len(head) < self.head_size))
+                    with self.__lock:
+                        self.warmed += 1
+            except Exception, e:
+                log.debug('Warmup of %s failed: %s' % (trackid, e))
+            finally:
+                with self.__lock:
+                    self.__queued.discard(trackid)
+
+    def get_head(self, trackid):
+        """Return (head, complete) for a warm track, or None"""
+        head = self.__heads.get(trackid)
+        with self.__lock:
+            if head is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return head
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        return '<Warmer warmed=%d hits=%d misses=%d (%.1f%% hit)>' % (
+            self.warmed, self.hits, self.misses,
+            100.0 * self.hits / total if total else 0)
+
+class HeadStream(object):
+    """Random access reader serving the head of a track from memory and
+    the rest from a stream, only opened (with open_stream) when needed.
+
+    >>> class Stream(object):
+    ...     def read(self, offset, size):
+    ...         return '0123456789'[offset:offset + size]
+    >>> s = HeadStream('0123', False, Stream)
+    >>> s.read(1, 2), s.read(2, 4), s.read(8, 10)
+    ('12', '2345', '89')
+    >>> HeadStream('0123', True, None).read(2, 10)
+    '23'
+    """
+    def __init__(self, head, complete, open_stream):
+        self.head = head
+        self.complete = complete
+        self.open_stream = open_stream
+        self.__stream = None
+
+    def read(self, offset, size):
+        """Return up to size bytes at offset, fewer only at the end of the stream"""
+        head_size = len(self.head)
+        data = ''
+        if offset < head_size:
+            data = self.head[offset:offset + size]
+            offset += len(data)
+            size -= len(data)
+        if size <= 0 or self.complete:
+            return data
+        if self.__stream is None:
+            self.__stream = self.open_stream()
+        return data + self.__stream.read(offset, size)
+
+    @property
+    def length(self):
+        """Length of the whole stream, if known (see RangeStream)"""
+        if self.complete:
+            return len(self.head)
+        return getattr(self.__stream, 'length', None)
+
+    def close(self):
+        if self.__stream is not None:
+            self.__stream.close()
+            self.__stream = None
@@ -0,0 +1,71 @@
+# Bounded thread pool, used to run many blocking Google Music API or
+# HTTP calls concurrently instead of one round trip at a time.
+
+import Queue
+import threading
+import time
+import logging
+
+log = logging.getLogger('gmusicfs')
+
+class WorkerPool(object):
+    """
+    >>> pool = WorkerPool(concurrency=4)
+    >>> sorted(pool.map(lambda x: x * 2, [1, 2, 3]).items())
+    [(1, 2), (2, 4), (3, 6)]
+    >>> pool.map(lambda x: 1 / x, [0], retries=1, retry_delay=0)
+    {}
+    """
+    def __init__(self, concurrency=8, name='worker'):
+        self.concurrency = max(1, concurrency)
+        self.name = name
+
+    def map(self, func, items, retries=2, retry_delay=0.5, progress=None):
+        """Call func(item) for every item, at most `concurrency` at a time.
+
+        Failing calls are retried `retries` times with a growing delay.
+        Returns a dict item -> result, items that kept failing are left
+        out. progress(done, total) is called after every item."""
+        items = list(items)
+        results = {}
+        if not items:
+            return results
+        work = Queue.Queue()
+        for item in items:
+            work.put(item)
+        lock = threading.Lock()
+        done = [0]
+
+        def worker():
+            while True:
+                try:
+                    item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                for attempt in range(retries + 1):
+                    try:
+                        result = func(item)
+                    except Exception, e:
+                        if attempt == retries:
+                            log.warning('%s: giving up on %r: %s' % (self.name, item, e))
+                        else:
+                            log.debug('%s: retrying %r: %s' % (self.name, item, e))
+                            time.sleep(retry_delay * (attempt + 1))
+                    else:
+                        with lock:
+                            results[item] = result
+                        break
+                with lock:
+                    done[0] += 1
+                    if progress is not None:
+                        progress(done[0], len(items))
+
+        threads = []
+        for i in range(min(self.concurrency, len(items))):
+            thread = threading.Thread(target=worker, name='%s-%d' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+# Read-ahead against a local fakeserver.FakeServer, see benchmarks.
+#
+#   python -m unittest discover tests
+
+import os
+import sys
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'gmusicfs'), os.path.join(HERE, '..', 'benchmarks')]
+import stream
+import fakeserver
+
+TRACK_SIZE = 1024 * 1024
+
+class StalledChunkedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Sends the first chunk of a chunked response, then nothing until
+    resume is set"""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StalledChunkedHandler)
+        self.resume = threading.Event()
+        self.url = 'http://127.0.0.1:%d/chunked.mp3' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.resume.set()
+        self.shutdown()
+        self.server_close()
+
+class StalledChunkedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.write('5\r\nfirst\r\n')
+        self.wfile.flush()
+        self.server.resume.wait()
+        self.wfile.write('4\r\nlast\r\n0\r\n\r\n')
+
+class ReadAheadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakeserver.FakeServer()
+        self.url = '%s/stream/t.mp3?size=%d' % (self.server.url, TRACK_SIZE)
+
+    def tearDown(self):
+        self.server.close()
+
+    def read(self, reader, offset, size, timeout=10):
+        """reader.read() in a thread, None if it is still waiting after timeout"""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(reader.read(offset, size)))
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        return result[0] if result else None
+
+    def test_read_larger_than_high_water(self):
+        # Pumping pauses at high_water, a read asking for more than that
+        # used to wait forever for the rest
+        reader = stream.ReadAhead(lambda refused=None: self.url,
+                                  high_water=64 * 1024, low_water=16 * 1024)
+        try:
+            data = self.read(reader, 0, 256 * 1024)
+            self.assertIsNotNone(data, 'read did not return')
+            self.assertEqual(data, fakeserver.content(0, 256 * 1024))
+            data = self.read(reader, 256 * 1024, TRACK_SIZE)
+            self.assertEqual(data, fakeserver.content(256 * 1024, TRACK_SIZE - 256 * 1024))
+        finally:
+            reader.close()
+
+    def test_stalled_chunked_response(self):
+        # A chunked body cannot be read without blocking, the I/O thread
+        # of the engine read it anyway and every other stream waited
+        stalled = StalledChunkedServer()
+        chunked = stream.ReadAhead(lambda refused=None: stalled.url)
+        reader = stream.ReadAhead(lambda refused=None: self.url)
+        try:
+            result = []
+            thread = threading.Thread(target=lambda: result.append(chunked.read(0, 100)))
+            thread.daemon = True
+            thread.start()
+            data = self.read(reader, 0, 256 * 1024)
+            self.assertIsNotNone(data, 'read stalled by another response')
+            self.assertEqual(data, fakeserver.content(0, 256 * 1024))
+            stalled.resume.set()
+            thread.join(10)
+            self.assertEqual(result, ['firstlast'])
+        finally:
+            reader.close()
+            chunked.close()
+            stalled.close()
+
+if __name__ == '__main__':
+    unittest.main()
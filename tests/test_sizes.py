@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+# Reported sizes against the fake Google Music API and a local
+# fakeserver.FakeServer, see benchmarks.
+#
+#   python -m unittest discover tests
+
+import logging
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'gmusicfs'), os.path.join(HERE, '..', 'benchmarks')]
+import gmusicfs
+import fakeapi
+import fakeserver
+
+# gmusicfs logs everything at import, quiet it the way main() does
+logging.getLogger().setLevel(logging.WARNING)
+
+TRACK = u'/artists/Artist 0/1960_Album 0 - the record/01_Track number 0.mp3'.encode('utf-8')
+
+class SizesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakeserver.FakeServer()
+        fakeapi.FakeMobileclient.tracks = fakeapi.make_tracks(10, base_url=self.server.url)
+        fakeapi.FakeMobileclient.base_url = self.server.url
+        self.api = gmusicfs.GoogleMusicAPI
+        gmusicfs.GoogleMusicAPI = fakeapi.FakeMobileclient
+        self.fs = gmusicfs.GMusicFS('/mnt', username='user', password='password',
+                                    cache_dir=None, lowercase=False, use_snapshot=False)
+
+    def tearDown(self):
+        self.fs.cleanup()
+        gmusicfs.GoogleMusicAPI = self.api
+        self.server.close()
+
+    def read_all(self, path):
+        fh = self.fs.open(path, os.O_RDONLY)
+        try:
+            data = []
+            offset = 0
+            while True:
+                chunk = self.fs.read(path, 128 * 1024, offset, fh)
+                if not chunk:
+                    return ''.join(data)
+                data.append(chunk)
+                offset += len(chunk)
+        finally:
+            self.fs.release(path, fh)
+
+    def test_size_before_open(self):
+        # The size of the cover is not known yet when the track is stat'ed,
+        # the file read afterwards must still have the size reported
+        size = self.fs.getattr(TRACK)['st_size']
+        data = self.read_all(TRACK)
+        self.assertEqual(len(data), size)
+        self.assertEqual(self.fs.getattr(TRACK)['st_size'], size)
+        self.assertEqual(data[:3], 'ID3')
+        self.assertEqual(data[-128:-125], 'TAG')
+
+if __name__ == '__main__':
+    unittest.main()